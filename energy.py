@@ -1,6 +1,13 @@
 import cv2
 import numpy as np
 
+
+# 缝合线求解方式 图割 / 动态规划求单调竖直缝合线 / OpenCV的动态规划缝合线 / 由粗到精的图割
+SEAM_BACKEND_GRAPH_CUT = 'graphcut'
+SEAM_BACKEND_DP = 'dp'
+SEAM_BACKEND_OPENCV_DP = 'opencv_dp'
+SEAM_BACKEND_COARSE_TO_FINE = 'coarse_to_fine'
+
 def get_energy_map(img1, img2):
     img1 = cv2.cvtColor(img1, cv2.COLOR_BGR2GRAY)
     img2 = cv2.cvtColor(img2, cv2.COLOR_BGR2GRAY)
@@ -34,8 +41,8 @@ def get_energy_map(img1, img2):
     # 第三部分的权重，也即相交部分的权重设置为0
     # 构建权重输入：
     # 左到右的边的权重
-    pre = img1_overlap-img2_overlap
-    pre = pre.astype(np.float64)
+    # 先转为浮点再相减 uint8直接相减会回绕 img2略亮处的差异变为接近255
+    pre = img1_overlap.astype(np.float64)-img2_overlap
     pre = pre*pre
     # 从左到右的权重
     left = (pre+np.concatenate((pre[:,1:],np.expand_dims(pre[:,0],1)),axis=1))/2
@@ -50,3 +57,314 @@ def get_energy_map(img1, img2):
 
     # 计算相交部分的平滑项
     return img_pixel1,img_pixel2,left,right,up,down
+
+
+# 重叠区域包围盒 向外扩一个像素 该范围之外的像素归属固定 不必参与图割
+def get_seam_band(img1, img2):
+    img1 = cv2.cvtColor(img1, cv2.COLOR_BGR2GRAY)
+    img2 = cv2.cvtColor(img2, cv2.COLOR_BGR2GRAY)
+    _, mask1 = cv2.threshold(src=img1, thresh=2, maxval=255, type=cv2.THRESH_BINARY)
+    _, mask2 = cv2.threshold(src=img2, thresh=2, maxval=255, type=cv2.THRESH_BINARY)
+
+    mask = mask1 & mask2
+    overlap_rows = np.flatnonzero(mask.any(axis=1))
+    overlap_cols = np.flatnonzero(mask.any(axis=0))
+    if len(overlap_rows) == 0:
+        return mask1, None
+
+    height, width = mask.shape
+    band = (slice(max(overlap_rows[0] - 1, 0), min(overlap_rows[-1] + 2, height)),
+            slice(max(overlap_cols[0] - 1, 0), min(overlap_cols[-1] + 2, width)))
+    return mask1, band
+
+
+# 图割的边结构 水平边连向右侧像素 竖直边连向下方像素
+HORIZONTAL_STRUCTURE = np.array([[0,0,0],
+                                 [0,0,1],
+                                 [0,0,0]])
+VERTICAL_STRUCTURE = np.array([[0,0,0],
+                               [0,0,0],
+                               [0,1,0]])
+
+
+# 图割的终端边与相邻像素间边的容量
+# fixed_labels不为None时 其值为1/0的像素强制取img1/img2 -1的像素由图割决定
+def get_seam_capacities(img1, img2, fixed_labels=None):
+    img_pixel1,img_pixel2,left,right,up,down = get_energy_map(img1, img2)
+    if fixed_labels is not None:
+        img_pixel1 = np.where(fixed_labels == 1, 255, np.where(fixed_labels == 0, 0, img_pixel1))
+        img_pixel2 = np.where(fixed_labels == 0, 255, np.where(fixed_labels == 1, 0, img_pixel2))
+
+    source_capacities = img_pixel1.astype(float)*1e10
+    sink_capacities = img_pixel2.astype(float)*1e10
+    # 向右与向左的边权重相同(right向左错开一列即为left) 上下同理 合并为对称边
+    # 最后一列/行是首尾相接的边 超出网格不会加入图中
+    horizontal_capacities = left.copy()
+    horizontal_capacities[:, -1] = 0
+    vertical_capacities = up.copy()
+    vertical_capacities[-1, :] = 0
+    return source_capacities, sink_capacities, horizontal_capacities, vertical_capacities
+
+
+# 图割求解缝合线 返回取img1的像素为1的模板
+def get_seam_mask_in_band(img1, img2, fixed_labels=None):
+    return get_seam_mask_from_capacities(*get_seam_capacities(img1, img2, fixed_labels))
+
+
+def get_seam_mask_from_capacities(source_capacities, sink_capacities, horizontal_capacities, vertical_capacities):
+    import maxflow
+    g = maxflow.GraphFloat()
+    nodeids = g.add_grid_nodes(source_capacities.shape)
+    g.add_grid_tedges(nodeids,source_capacities,sink_capacities)
+    g.add_grid_edges(nodeids,weights=horizontal_capacities,structure=HORIZONTAL_STRUCTURE,symmetric=True)
+    g.add_grid_edges(nodeids,weights=vertical_capacities,structure=VERTICAL_STRUCTURE,symmetric=True)
+    g.maxflow()
+    sgm = g.get_grid_segments(nodeids)
+
+    # The labels should be 1 where sgm is False and 0 otherwise.
+    return np.logical_not(sgm).astype(np.uint8)
+
+
+# 动态规划求从上到下的单调缝合线 每行缝合线位于第c列与第c+1列之间 相邻两行的c最多相差1
+# 代价与图割相同 每行割断的水平边权重 加上c变化时割断的竖直边权重
+# 假设img1在左 img2在右 且每行重叠区域连续 重叠区域外的像素归属由模板决定
+def get_seam_mask_in_band_by_dp(img1, img2):
+    img_pixel1,img_pixel2,left,right,up,down = get_energy_map(img1, img2)
+    overlap = (img_pixel1 == 0) & (img_pixel2 == 0)
+    height, width = overlap.shape
+    columns = np.arange(width)
+
+    # 缝合线在重叠区域左侧或右侧时 重叠区域整行归img2或img1 代价等于紧贴重叠区域边界时
+    first_columns = np.argmax(overlap, axis=1)
+    last_columns = width - 1 - np.argmax(overlap[:, ::-1], axis=1)
+    row_costs = left.copy()
+    row_costs[:, -1] = 0
+    row_costs = np.take_along_axis(row_costs, np.clip(columns, first_columns[:, None] - 1, last_columns[:, None]), axis=1)
+    row_costs[~overlap.any(axis=1)] = 0
+
+    # 逐行累计最小代价 steps记录从上一行的哪一列转移而来(-1/0/1)
+    costs = row_costs[0].copy()
+    steps = np.zeros((height, width), dtype=np.int8)
+    for row in range(1, height):
+        candidates = np.full((3, width), np.inf)
+        candidates[0, 1:] = costs[:-1] + up[row - 1, 1:]
+        candidates[1] = costs
+        candidates[2, :-1] = costs[1:] + up[row - 1, 1:]
+        best = np.argmin(candidates, axis=0)
+        steps[row] = best - 1
+        costs = candidates[best, columns] + row_costs[row]
+
+    seam_columns = np.zeros(height, dtype=int)
+    seam_columns[-1] = np.argmin(costs)
+    for row in range(height - 1, 0, -1):
+        seam_columns[row - 1] = seam_columns[row] + steps[row, seam_columns[row]]
+
+    # The labels should be 1 left of the seam in the overlap and follow img1's mask elsewhere.
+    return np.where(overlap, columns <= seam_columns[:, None], img_pixel1 > 0).astype(np.uint8)
+
+
+# OpenCV的动态规划缝合线 代价为其自身的颜色差异 不使用get_energy_map
+def get_seam_mask_in_band_by_opencv_dp(img1, img2):
+    gray1 = cv2.cvtColor(img1, cv2.COLOR_BGR2GRAY)
+    gray2 = cv2.cvtColor(img2, cv2.COLOR_BGR2GRAY)
+    _, mask1 = cv2.threshold(src=gray1, thresh=2, maxval=255, type=cv2.THRESH_BINARY)
+    _, mask2 = cv2.threshold(src=gray2, thresh=2, maxval=255, type=cv2.THRESH_BINARY)
+
+    seam_finder = cv2.detail.DpSeamFinder('COLOR')
+    masks = seam_finder.find([img1, img2], [(0, 0), (0, 0)], [cv2.UMat(mask1), cv2.UMat(mask2)])
+    return (masks[0].get() > 0).astype(np.uint8)
+
+
+# 整幅画布的缝合线模板 只在重叠区域包围盒(外扩一个像素)内求解
+# 包围盒外没有重叠像素 其能量为0且终端边固定 与整幅画布建图的结果相同
+# coarse_scale为由粗到精求解时的缩小倍数
+def get_seam_mask(img1, img2, backend=SEAM_BACKEND_GRAPH_CUT, coarse_scale=4):
+    if backend == SEAM_BACKEND_GRAPH_CUT:
+        get_seam_mask_in_band_by_backend = get_seam_mask_in_band
+    elif backend == SEAM_BACKEND_DP:
+        get_seam_mask_in_band_by_backend = get_seam_mask_in_band_by_dp
+    elif backend == SEAM_BACKEND_OPENCV_DP:
+        get_seam_mask_in_band_by_backend = get_seam_mask_in_band_by_opencv_dp
+    elif backend == SEAM_BACKEND_COARSE_TO_FINE:
+        get_seam_mask_in_band_by_backend = lambda band_img1, band_img2: get_seam_mask_in_band_coarse_to_fine(band_img1, band_img2, coarse_scale)
+    else:
+        raise ValueError(
+            'Invalid value for `backend`. Expecting value of `energy.SEAM_BACKEND_GRAPH_CUT`, '
+            '`energy.SEAM_BACKEND_DP`, `energy.SEAM_BACKEND_OPENCV_DP` or `energy.SEAM_BACKEND_COARSE_TO_FINE`.'
+        )
+
+    mask1, band = get_seam_band(img1, img2)
+    # 包围盒外 img1有像素处取img1 其余取img2
+    seam_mask = (mask1 // 255).astype(np.uint8)
+    if band is not None:
+        seam_mask[band] = get_seam_mask_in_band_by_backend(img1[band], img2[band])
+    return seam_mask
+
+
+# 缝合线所在的像素 与相邻像素归属不同的重叠像素(相邻像素可在重叠区域之外)
+def get_seam_boundary(seam_mask, overlap):
+    boundary = np.zeros(seam_mask.shape, dtype=bool)
+    horizontal = seam_mask[:, 1:] != seam_mask[:, :-1]
+    boundary[:, 1:] |= horizontal & overlap[:, 1:]
+    boundary[:, :-1] |= horizontal & overlap[:, :-1]
+    vertical = seam_mask[1:, :] != seam_mask[:-1, :]
+    boundary[1:, :] |= vertical & overlap[1:, :]
+    boundary[:-1, :] |= vertical & overlap[:-1, :]
+    return boundary
+
+
+# 在引导缝合线附近corridor_width范围的通道内求解 通道外的重叠像素沿用引导缝合线的归属
+# 只在通道包围盒(外扩一个像素)内建图 返回缝合线模板与其是否触及通道边界
+# 引导缝合线不经过重叠区域时返回(None, False)
+def get_seam_mask_in_corridor(img1, img2, guide_seam_mask, corridor_width):
+    gray1 = cv2.cvtColor(img1, cv2.COLOR_BGR2GRAY)
+    gray2 = cv2.cvtColor(img2, cv2.COLOR_BGR2GRAY)
+    _, mask1 = cv2.threshold(src=gray1, thresh=2, maxval=255, type=cv2.THRESH_BINARY)
+    _, mask2 = cv2.threshold(src=gray2, thresh=2, maxval=255, type=cv2.THRESH_BINARY)
+    overlap = (mask1 & mask2) > 0
+
+    # 重叠区域外的归属由模板决定
+    guide_seam_mask = np.where(overlap, guide_seam_mask, mask1 // 255).astype(np.uint8)
+    guide_boundary = get_seam_boundary(guide_seam_mask, overlap)
+    if not guide_boundary.any():
+        return None, False
+
+    kernel = np.ones((2 * corridor_width + 1, 2 * corridor_width + 1), dtype=np.uint8)
+    corridor = (cv2.dilate(guide_boundary.astype(np.uint8), kernel) > 0) & overlap
+
+    height, width = overlap.shape
+    fixed_labels = np.where(overlap & ~corridor, guide_seam_mask.astype(np.int8), np.int8(-1))
+    corridor_rows = np.flatnonzero(corridor.any(axis=1))
+    corridor_cols = np.flatnonzero(corridor.any(axis=0))
+    band = (slice(max(corridor_rows[0] - 1, 0), min(corridor_rows[-1] + 2, height)),
+            slice(max(corridor_cols[0] - 1, 0), min(corridor_cols[-1] + 2, width)))
+
+    seam_mask = guide_seam_mask.copy()
+    seam_mask[band] = get_seam_mask_in_band(img1[band], img2[band], fixed_labels[band])
+
+    corridor_edge = corridor & (cv2.dilate((overlap & ~corridor).astype(np.uint8), np.ones((3, 3), dtype=np.uint8)) > 0)
+    return seam_mask, (get_seam_boundary(seam_mask, overlap) & corridor_edge).any()
+
+
+# 由粗到精求解缝合线 先在scale*scale的块组成的粗网格上图割 放大后在其附近band_width范围的通道内全分辨率图割
+# 粗网格相邻两块间边的权重取缝合线在块内任一列(行)穿过时割断的边权重的平均值
+# 缝合线触及通道边界时 以其为引导将通道加宽一倍重新求解 加宽max_corridor_doublings次后仍触及则在整个重叠区域求解
+# band_width为None时取8*scale 覆盖粗缝合线放大后的位置误差
+def get_seam_mask_in_band_coarse_to_fine(img1, img2, scale=4, band_width=None, max_corridor_doublings=2):
+    if band_width is None:
+        band_width = 8 * scale
+
+    height, width = img1.shape[:2]
+    if min(height, width) < 4 * scale:
+        return get_seam_mask_in_band(img1, img2)
+
+    # 补零到scale的整数倍 补出的像素不固定归属且边权重为0
+    coarse_height, coarse_width = -(-height // scale), -(-width // scale)
+    padding = ((0, coarse_height * scale - height), (0, coarse_width * scale - width))
+    source_capacities, sink_capacities, horizontal_capacities, vertical_capacities = (
+        np.pad(capacities, padding).reshape(coarse_height, scale, coarse_width, scale) for capacities in get_seam_capacities(img1, img2))
+    # 块内有必定属于img1/img2的像素时 整块固定归属
+    coarse_source_capacities = source_capacities.max(axis=(1, 3))
+    coarse_sink_capacities = sink_capacities.max(axis=(1, 3))
+    # 只取块交界处一列(行)的边时 细缝合线在块内绕开的低代价路径会被漏掉
+    coarse_horizontal_capacities = horizontal_capacities.sum(axis=(1, 3)) / scale
+    coarse_vertical_capacities = vertical_capacities.sum(axis=(1, 3)) / scale
+    coarse_horizontal_capacities[:, -1] = 0
+    coarse_vertical_capacities[-1, :] = 0
+    coarse_seam_mask = get_seam_mask_from_capacities(coarse_source_capacities, coarse_sink_capacities,
+                                                     coarse_horizontal_capacities, coarse_vertical_capacities)
+    seam_mask = np.repeat(np.repeat(coarse_seam_mask, scale, axis=0), scale, axis=1)[:height, :width]
+
+    corridor_width = band_width
+    for _ in range(max_corridor_doublings + 1):
+        seam_mask, touches_corridor_edge = get_seam_mask_in_corridor(img1, img2, seam_mask, corridor_width)
+        if seam_mask is None:
+            break
+        if not touches_corridor_edge:
+            return seam_mask
+        corridor_width *= 2
+    return get_seam_mask_in_band(img1, img2)
+
+
+# 缝合线模板在get_energy_map能量下的代价 即割断的相邻像素间边的权重之和 违反固定归属时为无穷大
+# 用于比较近似解(由粗到精 动态规划)与图割全局最优解的差距
+def get_seam_cost(img1, img2, seam_mask):
+    source_capacities, sink_capacities, horizontal_capacities, vertical_capacities = get_seam_capacities(img1, img2)
+    seam_mask = seam_mask.astype(bool)
+    if ((source_capacities > 0) & ~seam_mask).any() or ((sink_capacities > 0) & seam_mask).any():
+        return np.inf
+    return (horizontal_capacities[:, :-1][seam_mask[:, 1:] != seam_mask[:, :-1]].sum()
+            + vertical_capacities[:-1, :][seam_mask[1:, :] != seam_mask[:-1, :]].sum())
+
+
+class SeamTracker:
+    '''
+    Temporally coherent seams for one pair of videos.
+
+    The first frame, every keyframe_interval-th frame after a full solve, and any frame whose seam
+    reaches the edge of its corridor are solved over the whole overlap (get_seam_mask). Every other
+    frame is solved only in a corridor of corridor_width pixels around the previous frame's seam;
+    overlap pixels outside the corridor keep the side they were on in the previous frame, and the
+    graph is built over the corridor's bounding box only. Between full solves the seam stays within
+    corridor_width pixels of the previous one, so it does not jump between equally cheap paths.
+
+    Canvases of consecutive frames are assumed to share their top left origin, as in the stitching
+    pipelines where only the canvas width changes with the overlap; the previous seam is cropped or
+    padded with img2 on the right and bottom.
+    '''
+
+    def __init__(self, corridor_width=16, keyframe_interval=30):
+        '''
+        Constructor.
+
+        Input:
+
+        * corridor_width: The distance in pixels from the previous seam that the seam may move
+            per frame.
+        * keyframe_interval: The maximum number of frames between full-overlap solves.
+
+        Output:
+
+        (A SeamTracker object.)
+        '''
+
+        self.corridor_width = corridor_width
+        self.keyframe_interval = keyframe_interval
+        self.previous_seam_mask = None
+        self.frames_since_keyframe = 0
+        self.num_full_solves = 0
+
+
+    # 当前帧的缝合线模板 取img1的像素为1
+    def get_seam_mask(self, img1, img2):
+        seam_mask = None
+        if self.previous_seam_mask is not None and self.frames_since_keyframe < self.keyframe_interval:
+            seam_mask = self._get_seam_mask_in_corridor(img1, img2)
+
+        if seam_mask is None:
+            # 关键帧 或缝合线触及通道边界 在整个重叠区域求解
+            seam_mask = get_seam_mask(img1, img2)
+            self.frames_since_keyframe = 0
+            self.num_full_solves += 1
+        else:
+            self.frames_since_keyframe += 1
+
+        self.previous_seam_mask = seam_mask
+        return seam_mask
+
+
+    # 在上一帧缝合线附近的通道内求解 需要重新全局求解时返回None
+    def _get_seam_mask_in_corridor(self, img1, img2):
+        # 上一帧缝合线对齐到当前画布 左上角对齐 新增区域归img2
+        height, width = img1.shape[:2]
+        previous_seam_mask = np.zeros((height, width), dtype=np.uint8)
+        previous_height, previous_width = self.previous_seam_mask.shape
+        previous_seam_mask[:min(height, previous_height), :min(width, previous_width)] = \
+            self.previous_seam_mask[:min(height, previous_height), :min(width, previous_width)]
+
+        # 缝合线触及通道与固定像素的交界 说明被通道限制 需要全局求解
+        seam_mask, touches_corridor_edge = get_seam_mask_in_corridor(img1, img2, previous_seam_mask, self.corridor_width)
+        if touches_corridor_edge:
+            return None
+        return seam_mask
+
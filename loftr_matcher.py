@@ -0,0 +1,555 @@
+import os
+import time
+import contextlib
+import cv2
+import numpy as np
+import kornia.feature as KF
+import torch
+
+
+# 本地LoFTR权重 可通过环境变量LOFTR_WEIGHTS指定
+DEFAULT_WEIGHTS_PATH = os.environ.get(
+    'LOFTR_WEIGHTS', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'weights', 'loftr_outdoor.ckpt'))
+
+
+##  自动选择推理设备  ##
+def get_default_device():
+    '''
+    Return the CUDA device when one is available, otherwise the CPU.
+    '''
+
+    return torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+
+##  读取本地LoFTR权重  ##
+def load_state_dict(weights_path):
+    '''
+    Load a LoFTR state dict from a local checkpoint without touching the network.
+
+    The checkpoint is memory-mapped when the installed torch supports it (torch >= 2.1), so
+    several processes loading the same file share its pages. Both kornia's released
+    checkpoints (a dict with a 'state_dict' entry) and bare state dicts are accepted.
+
+    Input:
+
+    * weights_path: The path of the checkpoint file.
+
+    Output:
+
+    * state_dict: The state dict to pass to LoFTR.load_state_dict.
+    '''
+
+    try:
+        checkpoint = torch.load(weights_path, map_location='cpu', mmap=True, weights_only=True)
+    except TypeError:
+        # 旧版torch不支持mmap参数
+        checkpoint = torch.load(weights_path, map_location='cpu')
+
+    if isinstance(checkpoint, dict) and 'state_dict' in checkpoint:
+        return checkpoint['state_dict']
+    return checkpoint
+
+
+PRECISION_FLOAT32 = 'float32'
+PRECISION_BFLOAT16 = 'bfloat16'
+PRECISION_DYNAMIC_INT8 = 'dynamic_int8'
+
+# 自动选择匹配尺度时的候选尺度
+MATCH_SCALE_AUTO = 'auto'
+MATCH_SCALES = (0.5, 0.625, 0.75, 0.875, 1.0)
+
+
+##  将缩小后图像上的特征点坐标还原到原分辨率  ##
+def get_full_resolution_keypoints(keypoints, match_scale):
+    '''
+    Map (x, y) keypoints found in a frame resized by match_scale back to the original frame,
+    treating pixel coordinates as pixel centers (as cv2.resize does).
+    '''
+
+    if match_scale == 1:
+        return keypoints
+    return (keypoints + 0.5) / match_scale - 0.5
+
+
+class TracedBackbone(torch.nn.Module):
+    '''
+    Drop-in replacement for LoFTR's CNN backbone that runs a TorchScript trace of it.
+
+    One trace is made per input shape and saved in cache_dir, so later runs load it instead of
+    tracing again. Only the backbone is traced: the rest of LoFTR selects a data-dependent number
+    of matches, which a trace would freeze.
+    '''
+
+    def __init__(self, backbone, cache_dir, cache_key):
+        '''
+        Constructor.
+
+        Input:
+
+        * backbone: The backbone module of the LoFTR model.
+        * cache_dir: The directory holding the saved traces.
+        * cache_key: A string naming the model configuration (precision, device, torch version);
+            it is combined with the input shape to name each saved trace.
+
+        Output:
+
+        (A TracedBackbone object.)
+        '''
+
+        super().__init__()
+        self.backbone = backbone
+        self.cache_dir = cache_dir
+        self.cache_key = cache_key
+        self.traced_backbones = {}
+
+
+    ##  按输入尺寸获取(读取或生成)TorchScript模块  ##
+    def get_traced_backbone(self, image):
+        '''
+        Return the traced backbone for inputs shaped like image, loading it from cache_dir or
+        tracing and saving it on first use.
+        '''
+
+        shape = tuple(image.shape)
+        if shape not in self.traced_backbones:
+            trace_path = os.path.join(self.cache_dir, 'loftr_backbone_{}_{}.pt'.format(
+                self.cache_key, 'x'.join(str(size) for size in shape)))
+            if os.path.isfile(trace_path):
+                traced_backbone = torch.jit.load(trace_path, map_location=image.device)
+            else:
+                # 在推理模式外用普通张量追踪 避免inference tensor被记录进计算图
+                with torch.inference_mode(False), torch.no_grad():
+                    example_image = torch.zeros(shape, dtype=image.dtype, device=image.device)
+                    traced_backbone = torch.jit.trace(self.backbone, example_image)
+                os.makedirs(self.cache_dir, exist_ok=True)
+                torch.jit.save(traced_backbone, trace_path)
+            self.traced_backbones[shape] = traced_backbone
+
+        return self.traced_backbones[shape]
+
+
+    def forward(self, image):
+        return self.get_traced_backbone(image)(image)
+
+
+class LoFTRMatcher:
+    '''
+    A LoFTR model that is built once and reused for every frame pair.
+
+    The model is created lazily on the first match, loads its weights from a local checkpoint
+    and runs on the CUDA device when one is available, otherwise on the CPU.
+    '''
+
+    def __init__(self, weights_path=DEFAULT_WEIGHTS_PATH, pretrained='outdoor', device=None, batch_size=4,
+                 num_threads=None, precision=PRECISION_FLOAT32, trace_cache_dir=None,
+                 match_scale=1.0, target_match_count=None, match_time_budget=None,
+                 max_window_pixels=None, window_overlap=32):
+        '''
+        Constructor.
+
+        Input:
+
+        * weights_path: The local LoFTR checkpoint. If the file does not exist, kornia's
+            pretrained weights are used instead (downloaded once into the torch hub cache).
+        * pretrained: The kornia pretrained weights used when weights_path does not exist.
+        * device: The torch device to run on, or None to pick one with get_default_device.
+        * batch_size: The maximum number of frame pairs per forward pass in match_batch.
+        * num_threads: The number of intra-op threads torch uses on the CPU, or None to keep
+            torch's default. NOTE this is a process-wide torch setting, applied when the model is
+            created.
+        * precision: PRECISION_FLOAT32, PRECISION_BFLOAT16 (autocast the forward pass to
+            bfloat16) or PRECISION_DYNAMIC_INT8 (dynamically quantize the Linear layers of the
+            LoFTR transformers; CPU only).
+        * trace_cache_dir: If not None, the CNN backbone runs as a TorchScript trace saved in this
+            directory (see TracedBackbone), so later runs skip tracing.
+        * match_scale: The factor by which frames are downsampled before matching (e.g. 0.5),
+            or MATCH_SCALE_AUTO to pick it from MATCH_SCALES after every match so that the
+            number of matches stays near target_match_count and the time per pair stays under
+            match_time_budget. Keypoints are always returned in full-resolution coordinates.
+        * target_match_count: With MATCH_SCALE_AUTO, the desired number of matches per pair.
+        * match_time_budget: With MATCH_SCALE_AUTO, the desired matching time per pair in
+            seconds.
+        * max_window_pixels: If not None, frames with more pixels than this (after
+            downsampling) are matched in vertically stacked windows of at most this many pixels
+            (see get_match_windows), which caps the peak memory of matching.
+        * window_overlap: The number of rows shared by adjacent windows.
+
+        Output:
+
+        (A LoFTRMatcher object.)
+        '''
+
+        self.weights_path = weights_path
+        self.pretrained = pretrained
+        self.device = get_default_device() if device is None else torch.device(device)
+        self.batch_size = batch_size
+        self.num_threads = num_threads
+        self.precision = precision
+        self.trace_cache_dir = trace_cache_dir
+        self.match_scale = match_scale
+        self.target_match_count = target_match_count
+        self.match_time_budget = match_time_budget
+        self.max_window_pixels = max_window_pixels
+        self.window_overlap = window_overlap
+        # 自动模式从全分辨率开始
+        self.auto_match_scale_index = len(MATCH_SCALES) - 1
+        self.model = None
+
+        if precision not in (PRECISION_FLOAT32, PRECISION_BFLOAT16, PRECISION_DYNAMIC_INT8):
+            raise ValueError(
+                'Invalid value for `precision`. Expecting value of `loftr_matcher.PRECISION_FLOAT32`, '
+                '`loftr_matcher.PRECISION_BFLOAT16` or `loftr_matcher.PRECISION_DYNAMIC_INT8`.'
+            )
+        if precision == PRECISION_DYNAMIC_INT8 and self.device.type != 'cpu':
+            raise ValueError('`loftr_matcher.PRECISION_DYNAMIC_INT8` is only supported on the CPU.')
+        if match_scale == MATCH_SCALE_AUTO:
+            if target_match_count is None and match_time_budget is None:
+                raise ValueError('`loftr_matcher.MATCH_SCALE_AUTO` needs `target_match_count` or `match_time_budget`.')
+        elif not 0 < match_scale <= 1:
+            raise ValueError('`match_scale` must be in (0, 1] or `loftr_matcher.MATCH_SCALE_AUTO`.')
+
+
+    ##  首次使用时创建模型  ##
+    def get_model(self):
+        '''
+        Return the LoFTR model, creating it and loading its weights on the first call.
+        '''
+
+        if self.model is None:
+            if self.num_threads is not None and self.device.type == 'cpu':
+                torch.set_num_threads(self.num_threads)
+
+            if self.weights_path is not None and os.path.isfile(self.weights_path):
+                model = KF.LoFTR(pretrained=None)
+                model.load_state_dict(load_state_dict(self.weights_path))
+            else:
+                model = KF.LoFTR(pretrained=self.pretrained)
+            model = model.to(self.device).eval()
+
+            if self.precision == PRECISION_DYNAMIC_INT8:
+                # 仅量化Transformer中的线性层 卷积主干保持float32
+                model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+            if self.trace_cache_dir is not None:
+                model.backbone = TracedBackbone(model.backbone, self.trace_cache_dir, '{}_{}_torch{}'.format(
+                    self.precision, self.device.type, torch.__version__.replace('+', '_')))
+            self.model = model
+
+        return self.model
+
+
+    ##  BGR图像转为LoFTR输入的灰度张量  ##
+    def get_input_tensor(self, frame, match_scale=1.0):
+        '''
+        Return the BGR frame, downsampled by match_scale, as a (1, 1, height, width) grayscale
+        float tensor in [0, 1] on the matcher's device.
+
+        The grayscale image comes straight from cv2.cvtColor (and cv2.resize) and is wrapped by
+        torch.from_numpy without a copy; the only copy is the conversion to float on the device.
+        '''
+
+        # cvtColor的输出为连续内存 可直接共享给torch
+        gray_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        if match_scale != 1:
+            frame_height, frame_width = gray_frame.shape
+            gray_frame = cv2.resize(gray_frame, (max(1, round(frame_width * match_scale)), max(1, round(frame_height * match_scale))),
+                                    interpolation=cv2.INTER_AREA)
+        image = torch.from_numpy(gray_frame)[None, None]
+        return image.to(self.device, dtype=torch.float32).div_(255.)
+
+
+    ##  当前匹配尺度  ##
+    def get_match_scale(self):
+        '''
+        Return the scale used for the next match: match_scale, or the current automatic choice
+        from MATCH_SCALES.
+        '''
+
+        if self.match_scale == MATCH_SCALE_AUTO:
+            return MATCH_SCALES[self.auto_match_scale_index]
+        return self.match_scale
+
+
+    ##  影响匹配结果的配置 用作匹配缓存键的一部分  ##
+    def get_config(self):
+        '''
+        Return a tuple of the settings that change what match returns: the weights (the local
+        checkpoint's path, size and modification time, or the kornia pretrained name), the
+        device type, the precision, the scale of the next match and the windowing. Used in the
+        keys of match_cache.MatchCache.
+        '''
+
+        if self.weights_path is not None and os.path.isfile(self.weights_path):
+            weights_stat = os.stat(self.weights_path)
+            weights = (os.path.abspath(self.weights_path), weights_stat.st_size, weights_stat.st_mtime_ns)
+        else:
+            weights = ('pretrained', self.pretrained)
+
+        return (weights, self.device.type, self.precision, self.get_match_scale(), self.max_window_pixels, self.window_overlap)
+
+
+    ##  根据匹配点数与耗时调整自动匹配尺度  ##
+    def update_match_scale(self, num_matches, elapsed_time):
+        '''
+        With MATCH_SCALE_AUTO, step the match scale one entry of MATCH_SCALES down when matching
+        was over its time budget or produced more than twice target_match_count matches, and one
+        entry up when it produced fewer than target_match_count matches (or, with only a time
+        budget, took less than half of it).
+
+        Input:
+
+        * num_matches: The number of matches per pair in the last match.
+        * elapsed_time: The matching time per pair in seconds.
+        '''
+
+        if self.match_scale != MATCH_SCALE_AUTO:
+            return
+
+        too_slow = self.match_time_budget is not None and elapsed_time > self.match_time_budget
+        if self.target_match_count is not None:
+            scale_down = too_slow or num_matches > 2 * self.target_match_count
+            scale_up = not too_slow and num_matches < self.target_match_count
+        else:
+            scale_down = too_slow
+            scale_up = elapsed_time < 0.5 * self.match_time_budget
+
+        if scale_down:
+            self.auto_match_scale_index = max(0, self.auto_match_scale_index - 1)
+        elif scale_up:
+            self.auto_match_scale_index = min(len(MATCH_SCALES) - 1, self.auto_match_scale_index + 1)
+
+
+    ##  推理上下文 inference_mode 以及bfloat16自动混合精度  ##
+    def get_inference_context(self):
+        '''
+        Return the context manager used around every forward pass.
+        '''
+
+        context = contextlib.ExitStack()
+        context.enter_context(torch.inference_mode())
+        if self.precision == PRECISION_BFLOAT16:
+            context.enter_context(torch.autocast(device_type=self.device.type, dtype=torch.bfloat16))
+
+        return context
+
+
+    ##  LoFTR前向推理  ##
+    def run_model(self, input_dict):
+        '''
+        Run LoFTR on the given input dict and return its correspondences, with keypoints as
+        float32 tensors.
+        '''
+
+        model = self.get_model()
+        with self.get_inference_context():
+            correspondences = model(input_dict)
+
+        return {key: value.float() if value.is_floating_point() else value for key, value in correspondences.items()}
+
+
+    ##  LoFTR特征匹配  ##
+    def match(self, early_frame, late_frame):
+        '''
+        Match two BGR frames with LoFTR.
+
+        Input:
+
+        * early_frame: A BGR frame as a NumPy array.
+        * late_frame: A BGR frame as a NumPy array.
+
+        Output:
+
+        A tuple of the following items in order.
+
+        * early_keypoints: A NumPy array of shape (num_matches, 2) with the matched (x, y)
+            positions in early_frame.
+        * late_keypoints: A NumPy array of the same shape with the positions in late_frame.
+        '''
+
+        return self.match_batch([(early_frame, late_frame)])[0]
+
+
+    ##  批量LoFTR特征匹配  ##
+    def match_batch(self, frame_pairs, batch_size=None):
+        '''
+        Match several pairs of BGR frames with LoFTR, running up to batch_size pairs through the
+        model in each forward pass.
+
+        Pairs are batched only with pairs of the same frame sizes; their matches are split back
+        per pair using the 'batch_indexes' output of LoFTR. With max_window_pixels set, each
+        pair is first split into windows (see get_match_windows) which are matched as separate
+        pairs and merged back.
+
+        Input:
+
+        * frame_pairs: A list of (early_frame, late_frame) tuples of BGR frames.
+        * batch_size: The maximum number of pairs per forward pass, or None to use the matcher's
+            batch_size.
+
+        Output:
+
+        * keypoints_by_pair: A list with one (early_keypoints, late_keypoints) tuple per pair, in
+            the order of frame_pairs (see match).
+        '''
+
+        batch_size = self.batch_size if batch_size is None else batch_size
+        # 同一次调用内所有图像对使用相同尺度
+        match_scale = self.get_match_scale()
+        start_time = time.perf_counter()
+
+        # 各图像对拆分为纵向排列且相互重叠的窗口 每个窗口作为独立的图像对匹配
+        window_pairs = []
+        windows_by_pair = []
+        for early_frame, late_frame in frame_pairs:
+            windows = self.get_match_windows(min(early_frame.shape[0], late_frame.shape[0]),
+                                             max(early_frame.shape[1], late_frame.shape[1]), match_scale)
+            windows_by_pair.append(windows)
+            if len(windows) == 1:
+                window_pairs.append((early_frame, late_frame))
+            else:
+                window_pairs.extend((early_frame[window_top_y:window_bottom_y], late_frame[window_top_y:window_bottom_y])
+                                    for window_top_y, window_bottom_y, _, _ in windows)
+
+        keypoints_by_window_pair = self.match_windows(window_pairs, batch_size, match_scale)
+
+        # 合并各窗口的匹配 重叠带内的匹配只保留所属窗口的一份
+        keypoints_by_pair = []
+        window_pair_index = 0
+        for windows in windows_by_pair:
+            if len(windows) == 1:
+                keypoints_by_pair.append(keypoints_by_window_pair[window_pair_index])
+                window_pair_index += 1
+                continue
+
+            early_keypoints_by_window = []
+            late_keypoints_by_window = []
+            for window_top_y, _, owned_top_y, owned_bottom_y in windows:
+                early_keypoints, late_keypoints = keypoints_by_window_pair[window_pair_index]
+                window_pair_index += 1
+                early_keypoints = early_keypoints + [0, window_top_y]
+                late_keypoints = late_keypoints + [0, window_top_y]
+                owned = (early_keypoints[:, 1] >= owned_top_y) & (early_keypoints[:, 1] < owned_bottom_y)
+                early_keypoints_by_window.append(early_keypoints[owned])
+                late_keypoints_by_window.append(late_keypoints[owned])
+            keypoints_by_pair.append((np.concatenate(early_keypoints_by_window), np.concatenate(late_keypoints_by_window)))
+
+        if len(frame_pairs) > 0:
+            self.update_match_scale(sum(len(keypoints[0]) for keypoints in keypoints_by_pair) / len(frame_pairs),
+                                    (time.perf_counter() - start_time) / len(frame_pairs))
+
+        return keypoints_by_pair
+
+
+    ##  划分匹配窗口 限制单次匹配的像素数  ##
+    def get_match_windows(self, frame_height, frame_width, match_scale=1.0):
+        '''
+        Split the rows of a frame into vertically stacked windows of at most max_window_pixels
+        pixels each (after downsampling by match_scale), overlapping by window_overlap rows.
+
+        LoFTR's coarse matching memory grows with the square of the pixels of its input, so
+        bounding the pixels per window bounds the peak memory of matching regardless of the frame
+        size.
+
+        Input:
+
+        * frame_height: The height of the frames.
+        * frame_width: The width of the frames.
+        * match_scale: The scale the frames are matched at.
+
+        Output:
+
+        * windows: A list of (window_top_y, window_bottom_y, owned_top_y, owned_bottom_y)
+            tuples, all in full-resolution rows (bottoms exclusive). Each window is matched on
+            rows [window_top_y, window_bottom_y) and keeps the matches whose early keypoint lies
+            in rows [owned_top_y, owned_bottom_y); the owned rows of all windows tile the frame.
+        '''
+
+        if self.max_window_pixels is None or frame_height * frame_width * match_scale ** 2 <= self.max_window_pixels:
+            return [(0, frame_height, 0, frame_height)]
+
+        window_height = int(self.max_window_pixels / (frame_width * match_scale ** 2))
+        if window_height <= 2 * self.window_overlap:
+            raise ValueError('`max_window_pixels` is too small for the frame width and `window_overlap`.')
+
+        # 窗口数取最少 再在图像高度内均匀分布
+        num_windows = -(-(frame_height - self.window_overlap) // (window_height - self.window_overlap))
+        window_tops = [round(window_index * (frame_height - window_height) / (num_windows - 1)) for window_index in range(num_windows)]
+
+        windows = []
+        for window_index, window_top_y in enumerate(window_tops):
+            window_bottom_y = window_top_y + window_height
+            # 重叠带以中线划分归属 首尾窗口延伸至图像边缘
+            owned_top_y = 0 if window_index == 0 else (window_top_y + windows[-1][1]) // 2
+            owned_bottom_y = frame_height if window_index == len(window_tops) - 1 else None
+            windows.append([window_top_y, window_bottom_y, owned_top_y, owned_bottom_y])
+        for window_index in range(len(windows) - 1):
+            windows[window_index][3] = windows[window_index + 1][2]
+
+        return [tuple(window) for window in windows]
+
+
+    ##  按批次进行LoFTR推理  ##
+    def match_windows(self, frame_pairs, batch_size, match_scale):
+        '''
+        Helper method for match_batch.
+
+        Run LoFTR on the given pairs at match_scale, batch_size pairs per forward pass, and
+        return one (early_keypoints, late_keypoints) tuple per pair in full-resolution
+        coordinates.
+        '''
+
+        keypoints_by_pair = [None] * len(frame_pairs)
+
+        # 按图像尺寸分组 同组内才能拼成一个批次
+        pair_indexes_by_shape = {}
+        for pair_index, (early_frame, late_frame) in enumerate(frame_pairs):
+            pair_indexes_by_shape.setdefault((early_frame.shape[:2], late_frame.shape[:2]), []).append(pair_index)
+
+        for pair_indexes in pair_indexes_by_shape.values():
+            for batch_start in range(0, len(pair_indexes), batch_size):
+                batch_pair_indexes = pair_indexes[batch_start:batch_start + batch_size]
+                input_dict = {  # LofTR works on grayscale images only
+                    "image0": torch.cat([self.get_input_tensor(frame_pairs[pair_index][0], match_scale) for pair_index in batch_pair_indexes]),
+                    "image1": torch.cat([self.get_input_tensor(frame_pairs[pair_index][1], match_scale) for pair_index in batch_pair_indexes])}
+
+                # 在不计算梯度的上下文中进行特征匹配，以节省内存和计算资源。
+                correspondences = self.run_model(input_dict)
+
+                keypoints0 = get_full_resolution_keypoints(correspondences['keypoints0'].cpu().numpy(), match_scale)
+                keypoints1 = get_full_resolution_keypoints(correspondences['keypoints1'].cpu().numpy(), match_scale)
+                batch_indexes = correspondences['batch_indexes'].cpu().numpy()
+                # 按batch_indexes拆分回各图像对
+                for batch_index, pair_index in enumerate(batch_pair_indexes):
+                    pair_mask = batch_indexes == batch_index
+                    keypoints_by_pair[pair_index] = (keypoints0[pair_mask], keypoints1[pair_mask])
+
+        return keypoints_by_pair
+
+
+# 进程内共享的匹配器
+_shared_matcher = None
+
+##  获取进程内共享的LoFTR匹配器  ##
+def get_shared_matcher():
+    '''
+    Return the LoFTRMatcher shared by every stitcher and stabilizer in this process, creating it
+    on the first call.
+    '''
+
+    global _shared_matcher
+    if _shared_matcher is None:
+        _shared_matcher = LoFTRMatcher()
+
+    return _shared_matcher
+
+
+##  配置进程内共享的LoFTR匹配器(设备 线程数 精度等)  ##
+def configure_shared_matcher(**matcher_kwargs):
+    '''
+    Replace the matcher returned by get_shared_matcher with LoFTRMatcher(**matcher_kwargs) and
+    return it. Call this before the first match so the default matcher is never built.
+    '''
+
+    global _shared_matcher
+    _shared_matcher = LoFTRMatcher(**matcher_kwargs)
+
+    return _shared_matcher
@@ -0,0 +1,172 @@
+import os
+import time
+import hashlib
+import sqlite3
+import threading
+import numpy as np
+
+
+# 缓存文件的默认位置与大小上限
+DEFAULT_CACHE_PATH = os.environ.get('MATCH_CACHE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'matches.sqlite'))
+DEFAULT_MAX_SIZE_BYTES = 1 << 30
+
+
+##  由图像内容、裁切位置、匹配器配置与误匹配剔除参数生成缓存键  ##
+def get_match_key(early_subframe, late_subframe, subframe_offset, matcher_config, filter_config):
+    '''
+    Return the cache key of the filtered matches of one subframe pair.
+
+    The key is a 16-byte BLAKE2b digest of both subframes' pixels and shapes, the subframe offset
+    (the crop position in the full frame), the matcher configuration (see
+    loftr_matcher.LoFTRMatcher.get_config) and the outlier filter parameters, so a change to any
+    of them is a miss.
+    '''
+
+    digest = hashlib.blake2b(digest_size=16)
+    for subframe in (early_subframe, late_subframe):
+        subframe = np.ascontiguousarray(subframe)
+        digest.update(repr((subframe.shape, subframe.dtype.str)).encode())
+        digest.update(subframe.data)
+    digest.update(repr((tuple(subframe_offset), matcher_config, filter_config)).encode())
+
+    return digest.digest()
+
+
+class MatchCache:
+    '''
+    A content-addressed on-disk store of filtered LoFTR matches, backed by sqlite.
+
+    Each entry holds the early and late keypoints of one subframe pair as a single float32 blob.
+    When the stored blobs exceed max_size_bytes, the least recently used entries are evicted.
+    The cache may be shared by threads.
+    '''
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_size_bytes=DEFAULT_MAX_SIZE_BYTES):
+        '''
+        Constructor.
+
+        Input:
+
+        * path: The sqlite file of the cache. It is created (with its directory) if missing.
+        * max_size_bytes: The maximum total size of the stored keypoints.
+
+        Output:
+
+        (A MatchCache object.)
+        '''
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.path = path
+        self.max_size_bytes = max_size_bytes
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        # WAL下读写互不阻塞 每次写入不必同步到磁盘
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS matches (key BLOB PRIMARY KEY, keypoints BLOB NOT NULL, size INTEGER NOT NULL, last_used INTEGER NOT NULL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS matches_last_used ON matches (last_used)')
+        self.connection.commit()
+        self.size_bytes = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM matches').fetchone()[0]
+
+
+    ##  读取缓存 命中时更新最近使用时间  ##
+    def get(self, key):
+        '''
+        Return the (early_features, late_features) stored under key, two CV_32FC2 arrays of shape
+        (num_features, 1, 2), or None on a miss.
+        '''
+
+        with self.lock:
+            row = self.connection.execute('SELECT keypoints FROM matches WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute('UPDATE matches SET last_used = ? WHERE key = ?', (time.time_ns(), key))
+            self.connection.commit()
+
+        keypoints = np.frombuffer(row[0], dtype=np.float32).reshape((2, -1, 1, 2))
+        return (keypoints[0].copy(), keypoints[1].copy())
+
+
+    ##  写入缓存 超出大小上限时按最近最少使用淘汰  ##
+    def put(self, key, early_features, late_features):
+
+        keypoints = np.stack([np.float32(early_features).reshape((-1, 1, 2)), np.float32(late_features).reshape((-1, 1, 2))]).tobytes()
+
+        with self.lock:
+            row = self.connection.execute('SELECT size FROM matches WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                self.size_bytes -= row[0]
+            self.connection.execute('INSERT OR REPLACE INTO matches VALUES (?, ?, ?, ?)', (key, keypoints, len(keypoints), time.time_ns()))
+            self.size_bytes += len(keypoints)
+
+            while self.size_bytes > self.max_size_bytes:
+                evicted = self.connection.execute('SELECT key, size FROM matches ORDER BY last_used LIMIT 64').fetchall()
+                if not evicted:
+                    break
+                self.connection.executemany('DELETE FROM matches WHERE key = ?', [(evicted_key,) for evicted_key, _ in evicted])
+                self.size_bytes -= sum(size for _, size in evicted)
+            self.connection.commit()
+
+
+    def close(self):
+
+        with self.lock:
+            self.connection.close()
+
+
+##  先查缓存 只对未命中的图像对批量进行LoFTR匹配  ##
+def match_subframes_with_cache(match_cache, matcher, subframe_pairs, subframe_offsets, filter_config):
+    '''
+    Look up the filtered matches of subframe pairs and LoFTR-match the pairs that miss.
+
+    The caller filters the returned keypoints of the missed pairs and passes the results to
+    store_filtered_matches.
+
+    Input:
+
+    * match_cache: A MatchCache, or None to match every pair.
+    * matcher: The loftr_matcher.LoFTRMatcher used on misses.
+    * subframe_pairs: A list of (early_subframe, late_subframe) tuples.
+    * subframe_offsets: The offset of each pair's subframes in their full frames.
+    * filter_config: A tuple of the caller's outlier filter parameters, part of the cache key.
+
+    Output:
+
+    A tuple of the following items in order.
+
+    * keys: The cache key of each pair, or None if match_cache is None.
+    * features_by_pair: The cached (early_features, late_features) of each pair, or None where
+        the pair missed.
+    * keypoints_by_pair: The unfiltered LoFTR (mkpts0, mkpts1) of each missed pair, or None
+        where the pair hit.
+    '''
+
+    if match_cache is None:
+        keys = None
+        features_by_pair = [None] * len(subframe_pairs)
+    else:
+        matcher_config = matcher.get_config()
+        keys = [get_match_key(early_subframe, late_subframe, subframe_offset, matcher_config, filter_config)
+                for (early_subframe, late_subframe), subframe_offset in zip(subframe_pairs, subframe_offsets)]
+        features_by_pair = [match_cache.get(key) for key in keys]
+
+    keypoints_by_pair = [None] * len(subframe_pairs)
+    missed_indexes = [pair_index for pair_index, features in enumerate(features_by_pair) if features is None]
+    if missed_indexes:
+        for pair_index, keypoints in zip(missed_indexes, matcher.match_batch([subframe_pairs[pair_index] for pair_index in missed_indexes])):
+            keypoints_by_pair[pair_index] = keypoints
+
+    return (keys, features_by_pair, keypoints_by_pair)
+
+
+##  写入本次新匹配的图像对过滤后的特征点对  ##
+def store_filtered_matches(match_cache, keys, features_by_pair, keypoints_by_pair):
+
+    if match_cache is None:
+        return
+    for key, (early_features, late_features), keypoints in zip(keys, features_by_pair, keypoints_by_pair):
+        if keypoints is not None:
+            match_cache.put(key, early_features, late_features)
@@ -0,0 +1,287 @@
+import math
+import cv2
+import numpy as np
+
+
+##  网格变形映射表 各网格只处理其在目标图像中的包围盒  ##
+def get_mesh_warp_maps(frame_width, frame_height, row_col_to_unstabilized_vertex_x_y, row_col_to_stabilized_vertex_x_y, x_displacement=0):
+    '''
+    Return the maps that warp a frame from its unstabilized mesh to its stabilized mesh, for
+    use with cv2.remap.
+
+    Every mesh cell gets the homography between its unstabilized and stabilized corners. A
+    stabilized pixel takes its source position from the homography of the last cell (in
+    row-major order) whose warped mask covers it; pixels covered by no cell keep the
+    out-of-frame values (frame_width + 1, frame_height + 1).
+
+    The result is the same as warping a full-frame mask and transforming every pixel for every
+    cell, but each cell only touches the bounding box of its projected quad (grown by the
+    bilinear footprint of the mask), so the cost is about one frame instead of one frame per
+    cell.
+
+    Input:
+
+    * frame_width: the width of the frame.
+    * frame_height: the height of the frame.
+    * row_col_to_unstabilized_vertex_x_y: A NumPy array of shape
+        (mesh_row_count + 1, mesh_col_count + 1, 2) containing the vertex positions in the
+        unstabilized frame.
+    * row_col_to_stabilized_vertex_x_y: A NumPy array of the same shape containing the vertex
+        positions in the stabilized frame.
+    * x_displacement: A horizontal translation applied after the mesh warp (used when stitching).
+
+    Output:
+
+    A tuple of the following items in order.
+
+    * map_x: A float32 NumPy array of shape (frame_height, frame_width) where map_x[y_s, x_s] is
+        the x-coordinate in the unstabilized frame of stabilized pixel (x_s, y_s).
+    * map_y: The corresponding y-coordinates.
+    '''
+
+    mesh_row_count = row_col_to_unstabilized_vertex_x_y.shape[0] - 1
+    mesh_col_count = row_col_to_unstabilized_vertex_x_y.shape[1] - 1
+
+    # 平移矩阵
+    transform_array = np.array([[1, 0, x_displacement], [0, 1, 0], [0, 0, 1]])
+    transform_array1 = np.array([[1, 0, -x_displacement], [0, 1, 0], [0, 0, 1]])
+
+    # 默认值落在原图像外 remap时填充背景色
+    map_x = np.full((frame_height, frame_width), frame_width + 1, dtype=np.float32)
+    map_y = np.full((frame_height, frame_width), frame_height + 1, dtype=np.float32)
+
+    # shape(frame_stabilized_y_x_to_stabilized_x_y) = (frame_height, frame_width, 2)
+    # 转为连续内存 便于按包围盒切片
+    frame_stabilized_y_x_to_stabilized_x_y = np.ascontiguousarray(np.swapaxes(
+        np.indices((frame_width, frame_height), dtype=np.float32), 0, 2))
+
+    unstabilized_to_stabilized_homographies, stabilized_to_unstabilized_homographies = get_cell_homographies(
+        row_col_to_unstabilized_vertex_x_y, row_col_to_stabilized_vertex_x_y)
+
+    for cell_top_left_row in range(mesh_row_count):
+        for cell_top_left_col in range(mesh_col_count):
+
+            # top_left, top_right, bottom_left, bottom_right
+            unstabilized_cell_bounds = row_col_to_unstabilized_vertex_x_y[
+                cell_top_left_row:cell_top_left_row+2, cell_top_left_col:cell_top_left_col+2].reshape(-1, 2)
+            unstabilized_to_stabilized_homography = unstabilized_to_stabilized_homographies[cell_top_left_row, cell_top_left_col]
+            stabilized_to_unstabilized_homography = stabilized_to_unstabilized_homographies[cell_top_left_row, cell_top_left_col]
+
+            unstabilized_cell_x_bounds, unstabilized_cell_y_bounds = np.transpose(unstabilized_cell_bounds)
+            cell_bounds = (math.floor(np.min(unstabilized_cell_x_bounds)), math.floor(np.min(unstabilized_cell_y_bounds)),
+                           math.ceil(np.max(unstabilized_cell_x_bounds)), math.ceil(np.max(unstabilized_cell_y_bounds)))
+
+            _update_maps_with_cell(map_x, map_y, frame_stabilized_y_x_to_stabilized_x_y, cell_bounds,
+                                   transform_array.dot(unstabilized_to_stabilized_homography),
+                                   stabilized_to_unstabilized_homography.dot(transform_array1))
+
+    return (map_x, map_y)
+
+
+##  将单个网格写入映射表  ##
+def _update_maps_with_cell(map_x, map_y, frame_stabilized_y_x_to_stabilized_x_y, cell_bounds,
+                           unstabilized_to_stabilized_homography, stabilized_to_unstabilized_homography):
+    '''
+    Helper method for get_mesh_warp_maps.
+
+    Warp the rectangular mask of one unstabilized cell into the stabilized frame and, where it
+    is nonzero, overwrite map_x and map_y with the cell's stabilized-to-unstabilized transform.
+
+    Input:
+
+    * map_x, map_y: The float32 maps being built, updated in place.
+    * frame_stabilized_y_x_to_stabilized_x_y: A float32 NumPy array of shape
+        (frame_height, frame_width, 2) where entry [y, x] is [x, y].
+    * cell_bounds: (left_x, top_y, right_x, bottom_y), all inclusive, of the unstabilized cell.
+    * unstabilized_to_stabilized_homography: The homography applied to the cell mask.
+    * stabilized_to_unstabilized_homography: The homography applied to the stabilized pixels.
+    '''
+
+    frame_height, frame_width = map_x.shape
+    cell_left_x, cell_top_y, cell_right_x, cell_bottom_y = cell_bounds
+
+    # 掩膜只取网格周围2像素(双线性插值最多向外扩展1像素)
+    source_left_x = max(0, cell_left_x - 2)
+    source_top_y = max(0, cell_top_y - 2)
+    source_right_x = min(frame_width, cell_right_x + 3)
+    source_bottom_y = min(frame_height, cell_bottom_y + 3)
+    if source_left_x >= source_right_x or source_top_y >= source_bottom_y:
+        return
+    unstabilized_cell_mask = np.zeros((source_bottom_y - source_top_y, source_right_x - source_left_x))
+    unstabilized_cell_mask[max(0, cell_top_y) - source_top_y:cell_bottom_y + 1 - source_top_y,
+                           max(0, cell_left_x) - source_left_x:cell_right_x + 1 - source_left_x] = 255
+
+    # 掩膜非零区域为外扩1像素的网格经单应变换后的四边形 取其包围盒
+    footprint_x_y = np.array([[[cell_left_x - 1, cell_top_y - 1]], [[cell_right_x + 1, cell_top_y - 1]],
+                              [[cell_left_x - 1, cell_bottom_y + 1]], [[cell_right_x + 1, cell_bottom_y + 1]]], dtype=np.float64)
+    footprint_w = footprint_x_y[:, 0, :].dot(unstabilized_to_stabilized_homography[2, :2]) + unstabilized_to_stabilized_homography[2, 2]
+    if np.all(footprint_w > 0):
+        projected_footprint_x_y = cv2.perspectiveTransform(footprint_x_y, unstabilized_to_stabilized_homography).reshape(-1, 2)
+        box_left_x = max(0, math.floor(np.min(projected_footprint_x_y[:, 0])) - 2)
+        box_top_y = max(0, math.floor(np.min(projected_footprint_x_y[:, 1])) - 2)
+        box_right_x = min(frame_width, math.ceil(np.max(projected_footprint_x_y[:, 0])) + 3)
+        box_bottom_y = min(frame_height, math.ceil(np.max(projected_footprint_x_y[:, 1])) + 3)
+    else:
+        # 四边形跨越无穷远线 退回整幅图像
+        box_left_x, box_top_y, box_right_x, box_bottom_y = 0, 0, frame_width, frame_height
+    if box_left_x >= box_right_x or box_top_y >= box_bottom_y:
+        return
+
+    # 把源图像与目标图像的裁切偏移并入单应矩阵
+    roi_homography = np.array([[1, 0, -box_left_x], [0, 1, -box_top_y], [0, 0, 1]]).dot(
+        unstabilized_to_stabilized_homography).dot(np.array([[1, 0, source_left_x], [0, 1, source_top_y], [0, 0, 1]]))
+    stabilized_cell_mask = cv2.warpPerspective(
+        unstabilized_cell_mask, roi_homography, (box_right_x - box_left_x, box_bottom_y - box_top_y))
+
+    box_stabilized_x_y = frame_stabilized_y_x_to_stabilized_x_y[box_top_y:box_bottom_y, box_left_x:box_right_x].reshape((-1, 1, 2))
+    cell_unstabilized_x_y = cv2.perspectiveTransform(box_stabilized_x_y, stabilized_to_unstabilized_homography)
+    cell_stabilized_y_x_to_unstabilized_x, cell_stabilized_y_x_to_unstabilized_y = np.moveaxis(
+        cell_unstabilized_x_y.reshape(stabilized_cell_mask.shape + (2,)), 2, 0)
+
+    box_map_x = map_x[box_top_y:box_bottom_y, box_left_x:box_right_x]
+    box_map_y = map_y[box_top_y:box_bottom_y, box_left_x:box_right_x]
+    np.copyto(box_map_x, cell_stabilized_y_x_to_unstabilized_x, where=stabilized_cell_mask != 0)
+    np.copyto(box_map_y, cell_stabilized_y_x_to_unstabilized_y, where=stabilized_cell_mask != 0)
+
+
+##  四点单应矩阵的批量闭式解  ##
+def get_four_point_homographies(source_quads, destination_quads):
+    '''
+    Return the homographies that map each quad of source_quads exactly onto the matching quad of
+    destination_quads, normalized so that H[2, 2] = 1 (like cv2.findHomography).
+
+    All quads are solved together as one stack of 8x8 linear systems. Each quad is first
+    translated to its centroid and scaled to unit mean radius, which keeps the systems well
+    conditioned at pixel coordinates.
+
+    Input:
+
+    * source_quads: A NumPy array of shape (..., 4, 2).
+    * destination_quads: A NumPy array of the same shape.
+
+    Output:
+
+    * homographies: A float64 NumPy array of shape (..., 3, 3).
+    '''
+
+    source_quads = np.asarray(source_quads, dtype=np.float64)
+    destination_quads = np.asarray(destination_quads, dtype=np.float64)
+
+    def get_normalization(quads):
+        centroids = np.mean(quads, axis=-2)
+        scales = np.sqrt(2) / np.maximum(np.mean(np.linalg.norm(quads - centroids[..., np.newaxis, :], axis=-1), axis=-1), 1e-12)
+        normalization = np.zeros(quads.shape[:-2] + (3, 3))
+        normalization[..., 0, 0] = scales
+        normalization[..., 1, 1] = scales
+        normalization[..., :2, 2] = -scales[..., np.newaxis] * centroids
+        normalization[..., 2, 2] = 1
+        return (scales[..., np.newaxis, np.newaxis] * (quads - centroids[..., np.newaxis, :]), normalization)
+
+    normalized_source_quads, source_normalization = get_normalization(source_quads)
+    normalized_destination_quads, destination_normalization = get_normalization(destination_quads)
+
+    # 每对对应点贡献两行方程 未知量为h00 h01 h02 h10 h11 h12 h20 h21 (h22 = 1)
+    # x' = (h00 x + h01 y + h02) / (h20 x + h21 y + 1)
+    # y' = (h10 x + h11 y + h12) / (h20 x + h21 y + 1)
+    x, y = normalized_source_quads[..., 0], normalized_source_quads[..., 1]
+    x_prime, y_prime = normalized_destination_quads[..., 0], normalized_destination_quads[..., 1]
+    ones = np.ones_like(x)
+    zeros = np.zeros_like(x)
+    x_rows = np.stack((x, y, ones, zeros, zeros, zeros, -x * x_prime, -y * x_prime), axis=-1)
+    y_rows = np.stack((zeros, zeros, zeros, x, y, ones, -x * y_prime, -y * y_prime), axis=-1)
+    # shape (..., 8, 8) 与 (..., 8, 1)
+    coefficient_matrices = np.stack((x_rows, y_rows), axis=-2).reshape(x.shape[:-1] + (8, 8))
+    right_hand_sides = np.stack((x_prime, y_prime), axis=-1).reshape(x.shape[:-1] + (8, 1))
+
+    solutions = np.linalg.solve(coefficient_matrices, right_hand_sides)[..., 0]
+    normalized_homographies = np.concatenate((solutions, np.ones(solutions.shape[:-1] + (1,))), axis=-1).reshape(
+        solutions.shape[:-1] + (3, 3))
+
+    # 还原归一化 H = T_dst^(-1) H_norm T_src
+    homographies = np.matmul(np.linalg.inv(destination_normalization), np.matmul(normalized_homographies, source_normalization))
+    return homographies / homographies[..., 2:3, 2:3]
+
+
+##  各网格的单应矩阵(正向与逆向)  ##
+def get_cell_homographies(row_col_to_unstabilized_vertex_x_y, row_col_to_stabilized_vertex_x_y):
+    '''
+    Return the homography of every mesh cell from its unstabilized corners to its stabilized
+    corners, and the inverse direction, for a whole mesh or a whole sequence of meshes.
+
+    The forward and inverse systems of every cell are solved as one batch by
+    get_four_point_homographies instead of two cv2.findHomography calls per cell.
+
+    Input:
+
+    * row_col_to_unstabilized_vertex_x_y: A NumPy array of shape
+        (..., mesh_row_count + 1, mesh_col_count + 1, 2), e.g. with a leading num_frames axis.
+    * row_col_to_stabilized_vertex_x_y: A NumPy array of the same shape (the unstabilized
+        vertices are broadcast against it).
+
+    Output:
+
+    A tuple of the following items in order.
+
+    * unstabilized_to_stabilized_homographies: A NumPy array of shape
+        (..., mesh_row_count, mesh_col_count, 3, 3).
+    * stabilized_to_unstabilized_homographies: A NumPy array of the same shape.
+    '''
+
+    row_col_to_unstabilized_vertex_x_y, row_col_to_stabilized_vertex_x_y = np.broadcast_arrays(
+        np.asarray(row_col_to_unstabilized_vertex_x_y, dtype=np.float64),
+        np.asarray(row_col_to_stabilized_vertex_x_y, dtype=np.float64))
+
+    def get_cell_quads(row_col_to_vertex_x_y):
+        # top_left, top_right, bottom_left, bottom_right
+        return np.stack((row_col_to_vertex_x_y[..., :-1, :-1, :], row_col_to_vertex_x_y[..., :-1, 1:, :],
+                         row_col_to_vertex_x_y[..., 1:, :-1, :], row_col_to_vertex_x_y[..., 1:, 1:, :]), axis=-2)
+
+    unstabilized_cell_quads = get_cell_quads(row_col_to_unstabilized_vertex_x_y)
+    stabilized_cell_quads = get_cell_quads(row_col_to_stabilized_vertex_x_y)
+
+    # 正向与逆向一并求解
+    homographies = get_four_point_homographies(
+        np.stack((unstabilized_cell_quads, stabilized_cell_quads)),
+        np.stack((stabilized_cell_quads, unstabilized_cell_quads)))
+
+    return (homographies[0], homographies[1])
+
+
+MAP_FORMAT_FLOAT = 'float'
+MAP_FORMAT_FIXED = 'fixed'
+
+##  网格变形映射表 按指定格式返回  ##
+def get_warp_maps(frame_width, frame_height, row_col_to_unstabilized_vertex_x_y, row_col_to_stabilized_vertex_x_y, x_displacement=0,
+                  map_format=MAP_FORMAT_FLOAT):
+    '''
+    Return (map_x, map_y) from get_mesh_warp_maps in the format given by map_format
+    (see convert_warp_maps).
+    '''
+
+    warp_maps = get_mesh_warp_maps(frame_width, frame_height, row_col_to_unstabilized_vertex_x_y, row_col_to_stabilized_vertex_x_y, x_displacement)
+    return convert_warp_maps(*warp_maps, map_format)
+
+
+##  映射表格式 浮点或定点  ##
+def convert_warp_maps(map_x, map_y, map_format):
+    '''
+    Return the float32 maps (map_x, map_y) in the given format, ready to pass to cv2.remap.
+
+    MAP_FORMAT_FLOAT returns the float32 maps unchanged. MAP_FORMAT_FIXED converts them with
+    cv2.convertMaps to CV_16SC2 integer positions plus a uint16 index into OpenCV's table of
+    1/32-pixel interpolation weights: 6 bytes per pixel instead of 8, and remap no longer
+    converts float coordinates for every frame.
+    Out-of-frame values (frame_width + 1, frame_height + 1) stay out of frame, and values beyond
+    the int16 range saturate, so they still fall back to the border color. Use
+    MAP_FORMAT_FLOAT when the maps are also read as coordinates (e.g. for cropping).
+    '''
+
+    if map_format == MAP_FORMAT_FLOAT:
+        return (map_x, map_y)
+    elif map_format == MAP_FORMAT_FIXED:
+        return cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+    else:
+        raise ValueError(
+            'Invalid value for `map_format`. Expecting value of '
+            '`mesh_warp.MAP_FORMAT_FLOAT` or `mesh_warp.MAP_FORMAT_FIXED`.'
+        )
@@ -0,0 +1,107 @@
+import numpy as np
+from scipy.linalg import lapack
+
+
+def banded_matmul(band_coefficients, x):
+    '''
+    Return A x for a banded matrix A without forming A.
+
+    Input:
+
+    * band_coefficients: A NumPy array of shape (2 * radius + 1, num_frames) where
+        band_coefficients[radius + offset, t] = A[t, t + offset].
+        Entries that would fall outside the matrix are ignored.
+    * x: A NumPy array of shape (num_frames, ...).
+
+    Output:
+
+    * y: A NumPy array with the same shape as x.
+    '''
+
+    radius = (band_coefficients.shape[0] - 1) // 2
+    num_frames = x.shape[0]
+    trailing_shape = (1,) * (np.ndim(x) - 1)
+    y = np.zeros(np.shape(x), dtype=np.result_type(band_coefficients, x))
+    for offset in range(-min(radius, num_frames - 1), min(radius, num_frames - 1) + 1):
+        if offset >= 0:
+            y[:num_frames - offset] += band_coefficients[radius + offset, :num_frames - offset].reshape((-1,) + trailing_shape) * x[offset:]
+        else:
+            y[-offset:] += band_coefficients[radius + offset, -offset:].reshape((-1,) + trailing_shape) * x[:num_frames + offset]
+
+    return y
+
+
+class BandedPathSolver:
+    '''
+    Direct solver for the banded linear system A p = b produced by the MeshFlow energy function.
+
+    Every mesh vertex and both velocity components share the same matrix A, so A is LU-factored
+    once (LAPACK gbtrf) and all right-hand sides are solved together (LAPACK gbtrs).
+    '''
+
+    def __init__(self, band_coefficients):
+        '''
+        Constructor.
+
+        Input:
+
+        * band_coefficients: A NumPy array of shape (2 * radius + 1, num_frames) as returned by
+            banded_matmul, i.e. band_coefficients[radius + offset, t] = A[t, t + offset].
+
+        Output:
+
+        (A BandedPathSolver object holding the factorization of A.)
+        '''
+
+        band_radius = (band_coefficients.shape[0] - 1) // 2
+        self.num_frames = band_coefficients.shape[1]
+        # diagonals further than num_frames - 1 from the main diagonal are empty
+        self.radius = min(band_radius, self.num_frames - 1)
+        band_coefficients = band_coefficients[band_radius - self.radius:band_radius + self.radius + 1]
+
+        # LAPACK band storage: lapack_band[2 * radius + i - j, j] = A[i, j],
+        # the first radius rows are workspace for the fill-in of partial pivoting
+        lapack_band = np.zeros((3 * self.radius + 1, self.num_frames))
+        for offset in range(-self.radius, self.radius + 1):
+            row = 2 * self.radius - offset
+            if offset >= 0:
+                lapack_band[row, offset:] = band_coefficients[self.radius + offset, :self.num_frames - offset]
+            else:
+                lapack_band[row, :self.num_frames + offset] = band_coefficients[self.radius + offset, -offset:]
+
+        self.lu, self.pivots, info = lapack.dgbtrf(lapack_band, self.radius, self.radius)
+        if info != 0:
+            raise np.linalg.LinAlgError(f'Smoothing system is singular (gbtrf info = {info}).')
+
+    @classmethod
+    def from_jacobi_coefficients(cls, off_diagonal_coefficients, on_diagonal_coefficients, radius):
+        '''
+        Build a solver from the (off_diagonal_coefficients, on_diagonal_coefficients) pair used by
+        the Jacobi method, where off_diagonal_coefficients is banded with half-bandwidth radius and
+        A = diag(on_diagonal_coefficients) + off_diagonal_coefficients.
+        '''
+
+        band_coefficients = np.array(off_diagonal_coefficients, dtype=np.float64)
+        band_coefficients[radius] += on_diagonal_coefficients
+        return cls(band_coefficients)
+
+    def solve(self, b):
+        '''
+        Solve A p = b for every right-hand side at once.
+
+        Input:
+
+        * b: A NumPy array of shape (num_frames, ...). Every trailing index (e.g. mesh row, mesh
+            col and velocity component) is an independent right-hand side.
+
+        Output:
+
+        * p: A NumPy array with the same shape as b.
+        '''
+
+        right_hand_sides = np.asarray(b, dtype=np.float64).reshape((self.num_frames, -1))
+        p, info = lapack.dgbtrs(self.lu, self.radius, self.radius, right_hand_sides, self.pivots)
+        if info != 0:
+            raise ValueError(f'Invalid argument to gbtrs (info = {info}).')
+
+        return p.reshape(np.shape(b))
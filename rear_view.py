@@ -5,6 +5,8 @@ import tqdm
 import argparse
 import time
 import stitch_utils
+import match_cache
+from energy import SeamTracker, SEAM_BACKEND_GRAPH_CUT, SEAM_BACKEND_DP, SEAM_BACKEND_OPENCV_DP, SEAM_BACKEND_COARSE_TO_FINE
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
 
@@ -37,43 +39,12 @@ def measure_performance(method):
     return timed
 
 # @measure_performance
-def seamcut(src, dst):
-
-    import maxflow
-    from energy import get_energy_map
-    img_pixel1,img_pixel2,left,right,up,down = get_energy_map(src, dst)
-
-    g = maxflow.GraphFloat()
-    img_pixel1 = img_pixel1.astype(float)
-    img_pixel1 = img_pixel1*1e10
-    img_pixel2 = img_pixel2.astype(float)
-    img_pixel2 = img_pixel2*1e10
-    nodeids = g.add_grid_nodes(img_pixel1.shape)
-    # print(img_pixel1.shape)
-    g.add_grid_tedges(nodeids,img_pixel1,img_pixel2)
-    structure_left = np.array([[0,0,0],
-                            [0,0,1],
-                            [0,0,0]])
-    g.add_grid_edges(nodeids,weights=left,structure=structure_left,symmetric=False)
-    structure_right = np.array([[0,0,0],
-                            [1,0,0],
-                            [0,0,0]])
-    g.add_grid_edges(nodeids,weights=right,structure=structure_right,symmetric=False)
-    structure_up = np.array([[0,0,0],
-                            [0,0,0],
-                            [0,1,0]])
-    g.add_grid_edges(nodeids,weights=up,structure=structure_up,symmetric=False)
-    structure_down = np.array([[0,1,0],
-                            [0,0,0],
-                            [0,0,0]])
-    g.add_grid_edges(nodeids,weights=down,structure=structure_down,symmetric=False)
-    g.maxflow()
-    sgm = g.get_grid_segments(nodeids)
-
-    # The labels should be 1 where sgm is False and 0 otherwise.
-    img2 = np.int_(np.logical_not(sgm))
-    src_mask = img2.astype(np.uint8)
-    dst_mask = np.logical_not(img2).astype(np.uint8)
+def seamcut(src, dst, seam_solver=None, seam_backend=SEAM_BACKEND_GRAPH_CUT, seam_coarse_scale=4):
+
+    from energy import get_seam_mask
+    # 只在重叠区域包围盒内求解缝合线 视频中可由seam_solver沿用上一帧缝合线 只在其附近的通道内求解
+    src_mask = seam_solver.get_seam_mask(src, dst) if seam_solver is not None else get_seam_mask(src, dst, seam_backend, seam_coarse_scale)
+    dst_mask = np.logical_not(src_mask).astype(np.uint8)
     src_mask = np.stack((src_mask,src_mask,src_mask),axis=-1)
     dst_mask = np.stack((dst_mask,dst_mask,dst_mask),axis=-1)
 
@@ -211,7 +182,21 @@ if __name__=='__main__':
     ap.add_argument("-m", "--mid", type=str, default="data/video4.mp4", help="path to the mid video")
     ap.add_argument("-r", "--right", type=str, default="data/video3.mp4", help="path to the right video")
     ap.add_argument("-rr", "--right_right", type=str, default="data/video2.mp4", help="path to the right video")
+    # 匹配结果磁盘缓存 反复运行同一段录像时跳过LoFTR
+    ap.add_argument("--match-cache", type=str, default=None, help="sqlite file caching the filtered LoFTR matches across runs")
+    ap.add_argument("--match-cache-size", type=int, default=1024, help="maximum size of the match cache in MB")
+    # 缝合线求解方式 实时处理可用动态规划 离线渲染用图割
+    ap.add_argument("--seam-backend", type=str, default=SEAM_BACKEND_GRAPH_CUT,
+                    choices=[SEAM_BACKEND_GRAPH_CUT, SEAM_BACKEND_DP, SEAM_BACKEND_OPENCV_DP, SEAM_BACKEND_COARSE_TO_FINE],
+                    help="seam solver: graph cut, vertical seam by dynamic programming over the same cost, OpenCV's DP seam finder, "
+                         "or graph cut on a downsampled overlap refined at full resolution around the coarse seam")
+    ap.add_argument("--seam-coarse-scale", type=int, default=4, choices=[4, 8], help="downsampling factor of the coarse-to-fine seam")
+    # 视频缝合线 在上一帧缝合线附近的通道内求解 0为逐帧在整个重叠区域求解
+    ap.add_argument("--seam-corridor", type=int, default=0, help="width in pixels of the corridor around the previous seam that the next seam is searched in (graph cut only; 0: solve every frame over the whole overlap)")
+    ap.add_argument("--seam-keyframe-interval", type=int, default=30, help="maximum number of frames between full-overlap seam solves")
     args = vars(ap.parse_args())
+    if args["seam_backend"] != SEAM_BACKEND_GRAPH_CUT and args["seam_corridor"] > 0:
+        ap.error("--seam-corridor needs --seam-backend %s" % SEAM_BACKEND_GRAPH_CUT)
 
     # 读取视频
     vs = cv2.VideoCapture(args["left_left"])
@@ -335,29 +320,33 @@ if __name__=='__main__':
     # rright_frame_base = cv2.imread("real_09/final_5/video2/180.jpg")
 
     stitcher = stitch_utils.stitch_utils(mesh_row_count=mesh_row_count, mesh_col_count=mesh_col_count, 
-                                         feature_ellipse_row_count=feature_ellipse_row_count, feature_ellipse_col_count=feature_ellipse_col_count)
+                                         feature_ellipse_row_count=feature_ellipse_row_count, feature_ellipse_col_count=feature_ellipse_col_count,
+                                         match_cache=match_cache.MatchCache(args["match_cache"], args["match_cache_size"] << 20) if args["match_cache"] is not None else None)
+
+    # 所有相邻相机对一次批量匹配
+    matches_by_pair = stitcher.get_matched_features_and_homography_for_stitch_batch([(lleft_frame_base, left_frame_base), (left_frame_base, mid_frame_base), (mid_frame_base, right_frame_base), (right_frame_base, rright_frame_base)])
 
     # 获取匹配特征点 特征点对中点 以及全局单应矩阵
-    left_features, right_features, middle_features, early_to_late_homography_l, early_to_late_homography_r = stitcher.get_matched_features_and_homography_for_stitch(lleft_frame_base, left_frame_base) 
+    left_features, right_features, middle_features, early_to_late_homography_l, early_to_late_homography_r = matches_by_pair[0]
     # 获取拼接使用的网格运动场
     left_velocity_1, _ = stitcher.get_velocities_for_stitch(lleft_frame_base, left_features, middle_features, early_to_late_homography_l)
     right_velocity_1, _ = stitcher.get_velocities_for_stitch(lleft_frame_base, right_features, middle_features, early_to_late_homography_r)
    
 
     # 获取匹配特征点 特征点对中点 以及全局单应矩阵
-    left_features, right_features, middle_features, early_to_late_homography_l, early_to_late_homography_r = stitcher.get_matched_features_and_homography_for_stitch(left_frame_base, mid_frame_base) 
+    left_features, right_features, middle_features, early_to_late_homography_l, early_to_late_homography_r = matches_by_pair[1]
     # 获取拼接使用的网格运动场
     left_velocity_2, _ = stitcher.get_velocities_for_stitch(left_frame_base, left_features, middle_features, early_to_late_homography_l)
     right_velocity_2, _ = stitcher.get_velocities_for_stitch(mid_frame_base, right_features, middle_features, early_to_late_homography_r)
 
     # 获取匹配特征点 特征点对中点 以及全局单应矩阵
-    left_features, right_features, middle_features, early_to_late_homography_l, early_to_late_homography_r = stitcher.get_matched_features_and_homography_for_stitch(mid_frame_base, right_frame_base) 
+    left_features, right_features, middle_features, early_to_late_homography_l, early_to_late_homography_r = matches_by_pair[2]
     # 获取拼接使用的网格运动场
     left_velocity_3, _ = stitcher.get_velocities_for_stitch(mid_frame_base, left_features, middle_features, early_to_late_homography_l)
     right_velocity_3, _ = stitcher.get_velocities_for_stitch(right_frame_base, right_features, middle_features, early_to_late_homography_r)
     
     # 获取匹配特征点 特征点对中点 以及全局单应矩阵
-    left_features, right_features, middle_features, early_to_late_homography_l, early_to_late_homography_r = stitcher.get_matched_features_and_homography_for_stitch(right_frame_base, rright_frame_base) 
+    left_features, right_features, middle_features, early_to_late_homography_l, early_to_late_homography_r = matches_by_pair[3]
     # 获取拼接使用的网格运动场
     left_velocity_4, _ = stitcher.get_velocities_for_stitch(right_frame_base, left_features, middle_features, early_to_late_homography_l)
     right_velocity_4, _ = stitcher.get_velocities_for_stitch(rright_frame_base, right_features, middle_features, early_to_late_homography_r)
@@ -487,6 +476,9 @@ if __name__=='__main__':
     O_4 = O_4 + 42 
 
     ## 视频处理 ##
+    # 每条缝合线一个求解器 未启用时逐帧独立求解
+    seam_solvers = [SeamTracker(args["seam_corridor"], args["seam_keyframe_interval"]) if args["seam_corridor"] > 0 else None
+                    for _ in range(4)]
     with tqdm.trange(num_frames) as t:
         t.set_description(f'stitching frames')
         stitched_frames = []
@@ -519,25 +511,25 @@ if __name__=='__main__':
             r = np.zeros((H, W + 2 * O_1, 3), np.uint8)
             l[:, :W, :] = img_l_1
             r[:, 2 * O_1:, :] = img_r_1
-            stitched_seam_1 = seamcut(l, r)
+            stitched_seam_1 = seamcut(l, r, seam_solvers[0], args["seam_backend"], args["seam_coarse_scale"])
 
             l = np.zeros((H, W + 2 * O_2, 3), np.uint8)
             r = np.zeros((H, W + 2 * O_2, 3), np.uint8)
             l[:, :W, :] = img_l_2
             r[:, 2 * O_2:, :] = img_r_2
-            stitched_seam_2 = seamcut(l, r)
+            stitched_seam_2 = seamcut(l, r, seam_solvers[1], args["seam_backend"], args["seam_coarse_scale"])
 
             l = np.zeros((H, W + 2 * O_3, 3), np.uint8)
             r = np.zeros((H, W + 2 * O_3, 3), np.uint8)
             l[:, :W, :] = img_l_3
             r[:, 2 * O_3:, :] = img_r_3
-            stitched_seam_3 = seamcut(l, r)
+            stitched_seam_3 = seamcut(l, r, seam_solvers[2], args["seam_backend"], args["seam_coarse_scale"])
 
             l = np.zeros((H, W + 2 * O_4, 3), np.uint8)
             r = np.zeros((H, W + 2 * O_4, 3), np.uint8)
             l[:, :W, :] = img_l_4
             r[:, 2 * O_4:, :] = img_r_4
-            stitched_seam_4 = seamcut(l, r)
+            stitched_seam_4 = seamcut(l, r, seam_solvers[3], args["seam_backend"], args["seam_coarse_scale"])
 
             # 多频段融合
             flag_half = False
@@ -2,14 +2,21 @@ import os
 import cv2
 import math
 import numpy as np
-import statistics
 import tqdm
 import multiprocessing as mp
 from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 import time
 import matplotlib.pyplot as plt
 import argparse
+from collections import OrderedDict, deque
 import stitch_utils
+import path_solver
+import mesh_warp
+import loftr_matcher
+import stitch_lut
+import match_cache
+from energy import SeamTracker, SEAM_BACKEND_GRAPH_CUT, SEAM_BACKEND_DP, SEAM_BACKEND_OPENCV_DP, SEAM_BACKEND_COARSE_TO_FINE
 from multiband import multi_band_blending
 
 from scipy.ndimage import uniform_filter
@@ -18,6 +25,8 @@ from scipy.ndimage import median_filter
 mesh_row_count = 10
 mesh_col_count = 16
 multicore = 4
+# 拼接阶段映射表格式 见mesh_warp.convert_warp_maps
+warp_map_format = mesh_warp.MAP_FORMAT_FIXED
 W = 1358
 H = 540
 # W = 720
@@ -35,6 +44,17 @@ class MeshFlowStabilizer:
     ADAPTIVE_WEIGHTS_DEFINITION_CONSTANT_HIGH_VALUE = 80
     ADAPTIVE_WEIGHTS_DEFINITION_CONSTANT_LOW_VALUE = 2
 
+    # 拼接特征匹配方式 逐帧LoFTR 或仅关键帧LoFTR且其余帧用LK光流跟踪 或卡尔曼预测且不确定度过大时才匹配
+    STITCH_MATCHING_EVERY_FRAME = 0
+    STITCH_MATCHING_KEYFRAME_TRACKING = 1
+    STITCH_MATCHING_KALMAN_PREDICTION = 2
+
+    # 拼接时左图右侧与右图左侧的重叠区域宽度
+    STITCH_COMMON_FIELD = 800
+
+    # 拼接匹配点MAGSAC剔除误匹配的参数(阈值, 置信度, 最大迭代次数)
+    STITCH_MAGSAC_PARAMETERS = (0.4, 0.999, 100000)
+
     ##  初始化参数  ##
     def __init__(self, mesh_row_count=10, mesh_col_count=16,  # 网格行数与列数，定点数各加1
                  mesh_outlier_subframe_row_count=4, mesh_outlier_subframe_col_count=4,  # 图像划分为4*4，设立局部阈值RANSAC
@@ -42,8 +62,19 @@ class MeshFlowStabilizer:
                  homography_min_number_corresponding_features=6,
                  temporal_smoothing_radius=10,  # \Omega_t 时域平滑半径
                  optimization_num_iterations=100,  # 雅可比方法最小化能量函数时的迭代次数
+                 path_solver_cache_size=8,  # 缓存的带状系统LU分解数量
                  color_outside_image_area_bgr=(0, 0, 0),  # 稳定图像后设置背景色，避免图像无法覆盖窗口
                  multicore=4,
+                 matcher=None,  # LoFTR匹配器 None时使用进程内共享的匹配器
+                 stitch_matching=STITCH_MATCHING_EVERY_FRAME,  # 拼接特征匹配方式
+                 stitch_keyframe_max_interval=30,  # 关键帧跟踪时两关键帧之间的最大帧数
+                 stitch_tracking_min_feature_ratio=0.5,  # 跟踪成功的特征点少于关键帧的该比例时重新匹配
+                 stitch_tracking_max_reprojection_error=2.0,  # 全局H的平均重投影误差超过该值(像素)时重新匹配
+                 stitch_kalman_process_noise=0.05,  # 卡尔曼预测 顶点加速度的方差(像素^2)
+                 stitch_kalman_measurement_noise=1.0,  # 卡尔曼预测 匹配所得顶点位移的方差(像素^2)
+                 stitch_kalman_max_predicted_variance=4.0,  # 卡尔曼预测 预测方差超过该值(像素^2)时进行匹配
+                 stitch_matching_prefetch=0,  # 后台线程提前匹配的批次数 0为串行
+                 match_cache=None,  # 拼接匹配结果的磁盘缓存 None时不缓存
                  visualize=False):
         '''
         Constructor.
@@ -70,10 +101,37 @@ class MeshFlowStabilizer:
             2 * temporal_smoothing_radius frame indexes.
             NOTE This constant is denoted as \Omega_{t} in the original paper.
         * optimization_num_iterations: The number of iterations of the Jacobi method to perform when
-            minimizing the energy function.
+            minimizing the energy function with _get_jacobi_method_output.
+        * path_solver_cache_size: The number of factored smoothing systems (see _get_path_solver)
+            to keep, keyed by (num_frames, temporal_smoothing_radius, adaptive weights).
         * color_outside_image_area_bgr: The color, expressed in BGR, to display behind the
             stabilized footage in the output.
             NOTE This color should be removed during cropping, but is customizable just in case.
+        * multicore: The number of worker processes used for motion estimation and warping.
+        * matcher: The loftr_matcher.LoFTRMatcher used for LoFTR matching, or None to use the
+            matcher shared by the process (created on first use and kept for its lifetime).
+        * stitch_matching: STITCH_MATCHING_EVERY_FRAME runs LoFTR on every frame pair when
+            computing the stitch mesh; STITCH_MATCHING_KEYFRAME_TRACKING runs it only on
+            keyframes and tracks the correspondences with pyramidal Lucas-Kanade in between.
+        * stitch_keyframe_max_interval: With keyframe tracking, the maximum number of frames
+            between keyframes.
+        * stitch_tracking_min_feature_ratio: With keyframe tracking, a new keyframe is matched
+            when fewer than this fraction of the keyframe's correspondences survive tracking.
+        * stitch_tracking_max_reprojection_error: With keyframe tracking, a new keyframe is
+            matched when the mean reprojection error (in pixels) of either stitch homography on
+            the tracked correspondences exceeds this value.
+        * stitch_kalman_process_noise: With STITCH_MATCHING_KALMAN_PREDICTION, the variance of
+            the per-frame acceleration of each stitch vertex; see OnlineStitchFieldPredictor.
+        * stitch_kalman_measurement_noise: With STITCH_MATCHING_KALMAN_PREDICTION, the variance
+            of a stitch vertex displacement measured by matching.
+        * stitch_kalman_max_predicted_variance: With STITCH_MATCHING_KALMAN_PREDICTION, a frame
+            is matched only when the predicted variance of the stitch field exceeds this value.
+            Lower values match more often and follow the field more closely.
+        * stitch_matching_prefetch: With STITCH_MATCHING_EVERY_FRAME, the number of batches
+            LoFTR matches ahead in a background thread while the current batch is filtered and
+            turned into stitch fields on the CPU. 0 matches and post-processes serially.
+        * match_cache: A match_cache.MatchCache holding the filtered stitch matches of earlier
+            runs, or None. Subframe pairs found in it are not matched again.
         * visualize: Whether or not to display a video loop of the unstabilized and cropped,
             stabilized videos after saving the stabilized video. Pressing Q closes the window.
 
@@ -91,8 +149,20 @@ class MeshFlowStabilizer:
         self.homography_min_number_corresponding_features = homography_min_number_corresponding_features
         self.temporal_smoothing_radius = temporal_smoothing_radius
         self.optimization_num_iterations = optimization_num_iterations
+        self.path_solver_cache_size = path_solver_cache_size
+        self.path_solver_cache = OrderedDict()
         self.color_outside_image_area_bgr = color_outside_image_area_bgr
         self.multicore = multicore
+        self.matcher = matcher
+        self.stitch_matching = stitch_matching
+        self.stitch_keyframe_max_interval = stitch_keyframe_max_interval
+        self.stitch_tracking_min_feature_ratio = stitch_tracking_min_feature_ratio
+        self.stitch_tracking_max_reprojection_error = stitch_tracking_max_reprojection_error
+        self.stitch_kalman_process_noise = stitch_kalman_process_noise
+        self.stitch_kalman_measurement_noise = stitch_kalman_measurement_noise
+        self.stitch_kalman_max_predicted_variance = stitch_kalman_max_predicted_variance
+        self.stitch_matching_prefetch = stitch_matching_prefetch
+        self.match_cache = match_cache
         self.visualize = visualize
 
 
@@ -177,6 +247,55 @@ class MeshFlowStabilizer:
         return (cropping_ratio, distortion_score, stability_score)
 
 
+    ##  在线稳定 逐帧读入视频并以固定延迟输出  ##
+    def stabilize_online(self, input_path, output_path, lookahead=None,
+                         adaptive_weights_definition = ADAPTIVE_WEIGHTS_DEFINITION_ORIGINAL):
+        '''
+        Stabilize the video at the given input path frame by frame with an
+        OnlineMeshFlowStabilizer and write the result to the given output path.
+
+        Unlike stabilize, the video is never held in memory as a whole. The output is not cropped,
+        since a video-wide crop is only known once every frame has been warped.
+
+        Input:
+
+        * input_path: The path to a video.
+        * output_path: The path where the stabilized version of the video should be placed.
+        * lookahead: The number of frames each frame waits for before it is emitted; see
+            OnlineMeshFlowStabilizer.
+        * adaptive_weights_definition: Which method to use for computing the energy function's adaptive
+            weights.
+
+        Output:
+
+        (The stabilized video is saved to output_path.)
+        '''
+
+        online_stabilizer = OnlineMeshFlowStabilizer(self, lookahead, adaptive_weights_definition)
+
+        unstabilized_video = cv2.VideoCapture(input_path)
+        num_frames = np.int32(unstabilized_video.get(cv2.CAP_PROP_FRAME_COUNT))
+        frames_per_second = unstabilized_video.get(cv2.CAP_PROP_FPS)
+        fourcc = cv2.VideoWriter_fourcc('X', 'V', 'I', 'D')
+        video = cv2.VideoWriter(output_path, fourcc, frames_per_second, (W, H))
+
+        with tqdm.trange(num_frames) as t:
+            t.set_description(f'Stabilizing <{input_path}> online')
+            for _ in t:
+                success, pixels = unstabilized_video.read()
+                if not success:
+                    break
+                # 规范分辨率
+                for _, stabilized_frame, _ in online_stabilizer.push_frame(cv2.resize(pixels, (W, H))):
+                    video.write(stabilized_frame)
+
+        for _, stabilized_frame, _ in online_stabilizer.flush():
+            video.write(stabilized_frame)
+
+        unstabilized_video.release()
+        video.release()
+
+
     ##  读入视频 获得视频序列以及参数  ##
     def _get_unstabilized_frames_and_video_features(self, input_path):
         '''
@@ -261,6 +380,10 @@ class MeshFlowStabilizer:
             Since no frame comes after num_frames - 1, homographies[num_frames-1] is the identity homography.
         '''
 
+        # 帧对之间相互独立 多核时交给进程池
+        if self.multicore > 1 and num_frames > 2:
+            return get_unstabilized_vertex_displacements_and_homographies_with_multiprocessing(self, num_frames, unstabilized_frames)
+
         vertex_unstabilized_displacements_by_frame_index = np.empty((num_frames, self.mesh_row_count + 1, self.mesh_col_count + 1, 2))
         vertex_unstabilized_displacements_by_frame_index[0].fill(0)
 
@@ -283,30 +406,235 @@ class MeshFlowStabilizer:
 
     
     ##
-    def _get_stitch_vertex_displacements_and_homographies(self, num_frames, unstabilized_frames_1, unstabilized_frames_2):
+    def _get_stitch_vertex_displacements_and_homographies(self, num_frames, unstabilized_frames_1, unstabilized_frames_2, return_homographies=False):
+
+        # 仅关键帧使用LoFTR 其余帧用LK光流跟踪
+        if self.stitch_matching == self.STITCH_MATCHING_KEYFRAME_TRACKING:
+            displacements_and_homographies = self._get_stitch_vertex_displacements_with_keyframe_tracking(num_frames, unstabilized_frames_1, unstabilized_frames_2)
+            return displacements_and_homographies if return_homographies else displacements_and_homographies[:2]
+        # 卡尔曼预测拼接运动场 仅在预测不确定度过大时匹配
+        if self.stitch_matching == self.STITCH_MATCHING_KALMAN_PREDICTION:
+            displacements_and_homographies = self._get_stitch_vertex_displacements_with_kalman_prediction(num_frames, unstabilized_frames_1, unstabilized_frames_2)
+            return displacements_and_homographies if return_homographies else displacements_and_homographies[:2]
 
         left_stitch_vertex_displacements_by_frame_index = np.empty((num_frames, self.mesh_row_count + 1, self.mesh_col_count + 1, 2))
         right_stitch_vertex_displacements_by_frame_index = np.empty((num_frames, self.mesh_row_count + 1, self.mesh_col_count + 1, 2))
+        # 各帧左右图像到虚拟中间图的全局H 用于估计铰接角
+        stitch_homographies_by_frame_index = np.empty((num_frames, 2, 3, 3))
+
+        # 每批帧对一次LoFTR前向推理
+        batch_size = self._get_matcher().batch_size
+        frame_indexes_by_batch = [range(batch_start_index, min(batch_start_index + batch_size, num_frames))
+                                  for batch_start_index in range(0, num_frames, batch_size)]
+        # LoFTR推理可在后台线程中提前进行 与当前批次的CPU后处理重叠
+        keypoints_by_batch = self._get_stitch_keypoints_by_batch(frame_indexes_by_batch, unstabilized_frames_1, unstabilized_frames_2)
 
         # 即数组中从0遍历到num_frame
-        with tqdm.trange(num_frames) as t:
+        with tqdm.trange(len(frame_indexes_by_batch)) as t:
             t.set_description('Computing stitch mesh displacements')
+            for _, (batch_frame_indexes, cached_matches, subframe_offsets) in zip(t, keypoints_by_batch):
+                # 获取各顶点运动向量以及全局单应矩阵，这里的middle是左右特征点的平均值，左右特征点的单应矩阵分别计算其和middle的单应矩阵
+                matches_by_pair = [self._get_stitch_features_and_homography(early_features, late_features)
+                                   for early_features, late_features in self._filter_stitch_subframe_matches(*cached_matches, subframe_offsets)]
+
+                for current_index, matches in zip(batch_frame_indexes, matches_by_pair):
+                    # 生成拼接顶点运动场
+                    left_velocity, right_velocity = self._get_stitch_velocities(unstabilized_frames_1[current_index], matches)
+
+                    left_stitch_vertex_displacements_by_frame_index[current_index] = left_velocity
+                    right_stitch_vertex_displacements_by_frame_index[current_index] = right_velocity
+                    stitch_homographies_by_frame_index[current_index] = matches[3:5]
+
+        if return_homographies:
+            return left_stitch_vertex_displacements_by_frame_index, right_stitch_vertex_displacements_by_frame_index, stitch_homographies_by_frame_index
+        return left_stitch_vertex_displacements_by_frame_index, right_stitch_vertex_displacements_by_frame_index
+    ##
+
+
+    ##  逐批次LoFTR匹配拼接重叠区域 可由后台线程提前匹配后续批次  ##
+    def _get_stitch_keypoints_by_batch(self, frame_indexes_by_batch, unstabilized_frames_1, unstabilized_frames_2):
+        '''
+        Helper method for _get_stitch_vertex_displacements_and_homographies.
+
+        Yield (batch_frame_indexes, cached_matches, subframe_offsets) for every batch of frame
+        indexes, in order, where cached_matches is the output of
+        match_cache.match_subframes_with_cache for the batch's overlap strips: the cached
+        filtered matches, and the unfiltered LoFTR keypoints of the pairs not in the cache.
+
+        With stitch_matching_prefetch > 0, the batches are matched by a single background thread
+        that runs up to stitch_matching_prefetch batches ahead of the caller. Torch and OpenCV
+        release the GIL, so inference overlaps with the caller's MAGSAC filtering and vertex
+        field computation. One thread keeps inference serialized and the results in frame order.
+        '''
+
+        def match_batch(batch_frame_indexes):
+            subframe_pairs, subframe_offsets = self._get_stitch_subframe_pairs(
+                [(unstabilized_frames_1[current_index], unstabilized_frames_2[current_index]) for current_index in batch_frame_indexes])
+            cached_matches = match_cache.match_subframes_with_cache(
+                self.match_cache, self._get_matcher(), subframe_pairs, subframe_offsets, self._get_stitch_match_filter_config())
+            return (batch_frame_indexes, cached_matches, subframe_offsets)
+
+        if self.stitch_matching_prefetch <= 0:
+            for batch_frame_indexes in frame_indexes_by_batch:
+                yield match_batch(batch_frame_indexes)
+            return
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            pending_batches = deque()
+            for batch_frame_indexes in frame_indexes_by_batch:
+                pending_batches.append(executor.submit(match_batch, batch_frame_indexes))
+                if len(pending_batches) > self.stitch_matching_prefetch:
+                    yield pending_batches.popleft().result()
+            while pending_batches:
+                yield pending_batches.popleft().result()
+
+
+    ##  由匹配结果生成左右图像的拼接顶点运动场  ##
+    def _get_stitch_velocities(self, left_frame, matches):
+
+        left_features, right_features, middle_features, early_to_late_homography_l, early_to_late_homography_r = matches
+        left_velocity, _ = self.get_unstabilized_vertex_velocities_for_stitch(left_frame, left_features, middle_features, early_to_late_homography_l)
+        right_velocity, _ = self.get_unstabilized_vertex_velocities_for_stitch(left_frame, right_features, middle_features, early_to_late_homography_r)
+
+        return (left_velocity, right_velocity)
+
+
+    ##  关键帧LoFTR匹配 非关键帧用LK光流跟踪上一帧的拼接特征点对  ##
+    def _get_stitch_vertex_displacements_with_keyframe_tracking(self, num_frames, unstabilized_frames_1, unstabilized_frames_2):
+        '''
+        Helper method for _get_stitch_vertex_displacements_and_homographies.
+
+        Same output as _get_stitch_vertex_displacements_and_homographies with
+        return_homographies=True, but LoFTR only runs on keyframes. On the other frames the
+        previous frame's correspondences are carried forward with cv2.calcOpticalFlowPyrLK, the
+        left features inside the left camera's overlap strip and the right features inside the
+        right camera's. A frame becomes a keyframe when it is
+        stitch_keyframe_max_interval frames after the last one, when fewer than
+        stitch_tracking_min_feature_ratio of the keyframe's correspondences are still tracked, or
+        when the mean reprojection error of early_to_late_homography_l or
+        early_to_late_homography_r on the tracked correspondences exceeds
+        stitch_tracking_max_reprojection_error.
+        '''
+
+        left_stitch_vertex_displacements_by_frame_index = np.empty((num_frames, self.mesh_row_count + 1, self.mesh_col_count + 1, 2))
+        right_stitch_vertex_displacements_by_frame_index = np.empty((num_frames, self.mesh_row_count + 1, self.mesh_col_count + 1, 2))
+        stitch_homographies_by_frame_index = np.empty((num_frames, 2, 3, 3))
+
+        frame_width = unstabilized_frames_1[0].shape[1]
+        left_strip_offset = np.float32([frame_width - self.STITCH_COMMON_FIELD, 0])
+
+        matches = None
+        keyframe_num_features = 0
+        frames_since_keyframe = 0
+        previous_left_strip = previous_right_strip = None
+
+        with tqdm.trange(num_frames) as t:
+            t.set_description('Computing stitch mesh displacements (keyframe tracking)')
             for current_index in t:
                 left_frame = unstabilized_frames_1[current_index]
                 right_frame = unstabilized_frames_2[current_index]
-                # 获取各顶点运动向量以及全局单应矩阵，这里的middle是左右特征点的平均值，左右特征点的单应矩阵分别计算其和middle的单应矩阵
-                left_features, right_features, middle_features, early_to_late_homography_l, early_to_late_homography_r = self.get_matched_features_and_homography_for_stitch(left_frame, right_frame) 
-                # 生成拼接顶点运动场
-                left_velocity, _ = self.get_unstabilized_vertex_velocities_for_stitch(left_frame, left_features, middle_features, early_to_late_homography_l)
-                right_velocity, _ = self.get_unstabilized_vertex_velocities_for_stitch(left_frame, right_features, middle_features, early_to_late_homography_r)
+                # 重叠区域灰度图 光流只在其中计算
+                left_strip = cv2.cvtColor(left_frame[:, frame_width - self.STITCH_COMMON_FIELD: frame_width], cv2.COLOR_BGR2GRAY)
+                right_strip = cv2.cvtColor(right_frame[:, 0: self.STITCH_COMMON_FIELD], cv2.COLOR_BGR2GRAY)
+
+                tracked_matches = None
+                if matches is not None and frames_since_keyframe < self.stitch_keyframe_max_interval:
+                    tracked_matches = self._track_stitch_features(
+                        previous_left_strip, left_strip, previous_right_strip, right_strip,
+                        matches[0], matches[1], left_strip_offset, keyframe_num_features)
+
+                if tracked_matches is None:
+                    # 关键帧 重新进行LoFTR匹配
+                    matches = self.get_matched_features_and_homography_for_stitch(left_frame, right_frame)
+                    keyframe_num_features = len(matches[0])
+                    frames_since_keyframe = 0
+                else:
+                    matches = tracked_matches
+                    frames_since_keyframe += 1
+
+                previous_left_strip = left_strip
+                previous_right_strip = right_strip
+
+                left_velocity, right_velocity = self._get_stitch_velocities(left_frame, matches)
+                left_stitch_vertex_displacements_by_frame_index[current_index] = left_velocity
+                right_stitch_vertex_displacements_by_frame_index[current_index] = right_velocity
+                stitch_homographies_by_frame_index[current_index] = matches[3:5]
+
+        return left_stitch_vertex_displacements_by_frame_index, right_stitch_vertex_displacements_by_frame_index, stitch_homographies_by_frame_index
+
+
+    ##  卡尔曼预测拼接运动场 预测不确定度超过阈值时才进行LoFTR匹配并融合  ##
+    def _get_stitch_vertex_displacements_with_kalman_prediction(self, num_frames, unstabilized_frames_1, unstabilized_frames_2):
+        '''
+        Helper method for _get_stitch_vertex_displacements_and_homographies.
+
+        Same output as _get_stitch_vertex_displacements_and_homographies with
+        return_homographies=True, with the stitch fields of every frame taken from an
+        OnlineStitchFieldPredictor. Frames that are not matched keep the homographies of the last
+        matched frame.
+        '''
+
+        left_stitch_vertex_displacements_by_frame_index = np.empty((num_frames, self.mesh_row_count + 1, self.mesh_col_count + 1, 2))
+        right_stitch_vertex_displacements_by_frame_index = np.empty((num_frames, self.mesh_row_count + 1, self.mesh_col_count + 1, 2))
+        stitch_homographies_by_frame_index = np.empty((num_frames, 2, 3, 3))
 
+        predictor = OnlineStitchFieldPredictor(self)
+        num_matched_frames = 0
 
+        with tqdm.trange(num_frames) as t:
+            t.set_description('Computing stitch mesh displacements (Kalman prediction)')
+            for current_index in t:
+                left_velocity, right_velocity, matched = predictor.push_frame(unstabilized_frames_1[current_index], unstabilized_frames_2[current_index])
+                num_matched_frames += matched
 
                 left_stitch_vertex_displacements_by_frame_index[current_index] = left_velocity
                 right_stitch_vertex_displacements_by_frame_index[current_index] = right_velocity
+                stitch_homographies_by_frame_index[current_index] = predictor.homographies
+                t.set_postfix(matched=num_matched_frames)
 
-        return left_stitch_vertex_displacements_by_frame_index, right_stitch_vertex_displacements_by_frame_index
-    ##
+        return left_stitch_vertex_displacements_by_frame_index, right_stitch_vertex_displacements_by_frame_index, stitch_homographies_by_frame_index
+
+
+    ##  LK光流跟踪拼接特征点对 跟踪质量不足时返回None  ##
+    def _track_stitch_features(self, previous_left_strip, left_strip, previous_right_strip, right_strip,
+                               left_features, right_features, left_strip_offset, keyframe_num_features):
+        '''
+        Helper method for _get_stitch_vertex_displacements_with_keyframe_tracking.
+
+        Track the left and right stitch features from the previous frame's overlap strips into
+        the current ones and rebuild the stitch matches from the survivors. Return the same tuple
+        as get_matched_features_and_homography_for_stitch, or None when the tracking is not good
+        enough and a new keyframe should be matched.
+        '''
+
+        tracked_left_features, left_status, _ = cv2.calcOpticalFlowPyrLK(
+            previous_left_strip, left_strip, np.float32(left_features - left_strip_offset), None, winSize=(21, 21), maxLevel=3)
+        tracked_right_features, right_status, _ = cv2.calcOpticalFlowPyrLK(
+            previous_right_strip, right_strip, np.float32(right_features), None, winSize=(21, 21), maxLevel=3)
+
+        # 两侧均跟踪成功且仍在重叠区域内的特征点对
+        strip_height, strip_width = left_strip.shape
+        tracked = (left_status[:, 0] == 1) & (right_status[:, 0] == 1)
+        for tracked_features in (tracked_left_features, tracked_right_features):
+            tracked &= ((tracked_features[:, 0, 0] >= 0) & (tracked_features[:, 0, 0] <= strip_width - 1) &
+                        (tracked_features[:, 0, 1] >= 0) & (tracked_features[:, 0, 1] <= strip_height - 1))
+
+        if np.count_nonzero(tracked) < max(12, self.stitch_tracking_min_feature_ratio * keyframe_num_features):
+            return None
+
+        matches = self._get_stitch_features_and_homography(
+            tracked_left_features[tracked] + left_strip_offset, tracked_right_features[tracked])
+        if len(matches) < 5 or matches[3] is None or matches[4] is None:
+            return None
+
+        # 全局H在跟踪特征点对上的平均重投影误差
+        left_features, right_features, middle_features, early_to_late_homography_l, early_to_late_homography_r = matches
+        for features, homography in ((left_features, early_to_late_homography_l), (right_features, early_to_late_homography_r)):
+            reprojection_error = np.mean(np.linalg.norm(cv2.perspectiveTransform(features, homography) - middle_features, axis=-1))
+            if reprojection_error > self.stitch_tracking_max_reprojection_error:
+                return None
+
+        return matches
 
 
     ##  获取中值滤波后的帧间顶点位移(MeshFlow Vertex Profiles)及全局H变换  ##
@@ -368,26 +696,10 @@ class MeshFlowStabilizer:
         # element as the vertex's velocity.
 
         # 获取各顶点在约定范围(椭圆)内由各特征点引起的运动向量
-        vertex_nearby_feature_residual_x_velocities_by_row_col, vertex_nearby_feature_residual_y_velocities_by_row_col = self._get_vertex_nearby_feature_residual_velocities(
-            frame_width, frame_height, early_features, late_features, early_to_late_homography)
-        
-        # 各顶点累积的运动向量取中位数放回
-        vertex_residual_x_velocities_by_row_col = np.array([
-            [
-                statistics.median(x_velocities)
-                if x_velocities else 0
-                for x_velocities in row
-            ]
-            for row in vertex_nearby_feature_residual_x_velocities_by_row_col
-        ])
-        vertex_residual_y_velocities_by_row_col = np.array([
-            [
-                statistics.median(y_velocities)
-                if y_velocities else 0
-                for y_velocities in row
-            ]
-            for row in vertex_nearby_feature_residual_y_velocities_by_row_col
-        ])
+        vertex_residual_x_velocities_by_row_col, vertex_residual_y_velocities_by_row_col = stitch_utils.get_vertex_nearby_feature_residual_medians(
+            frame_width, frame_height, self.mesh_row_count, self.mesh_col_count,
+            self.feature_ellipse_row_count, self.feature_ellipse_col_count,
+            early_features, late_features, early_to_late_homography)
 
         # 累加全局运动量
         vertex_x_velocities_by_row_col = (vertex_global_x_velocities_by_row_col + vertex_residual_x_velocities_by_row_col).astype(np.float32)
@@ -447,32 +759,10 @@ class MeshFlowStabilizer:
         # element as the vertex's velocity.
 
         # 获取各顶点在约定范围(椭圆)内由各特征点引起的运动向量，先计算特征点的残余运动矢量，然后通过椭圆传播到顶点，然后输出顶点的残余运动矢量
-        vertex_nearby_feature_residual_x_velocities_by_row_col, vertex_nearby_feature_residual_y_velocities_by_row_col = self._get_vertex_nearby_feature_residual_velocities(
-            frame_width, frame_height, early_features, late_features, early_to_late_homography)
-
-        # for row in vertex_nearby_feature_residual_x_velocities_by_row_col:
-        #     for col in row:
-        #         print(len(col))
-        # print(vertex_nearby_feature_residual_x_velocities_by_row_col[7][8])
-        # print(vertex_nearby_feature_residual_x_velocities_by_row_col[7][9])
-        # 各顶点累积的运动向量取中位数放回
-        vertex_residual_x_velocities_by_row_col = np.array([
-            [
-                statistics.median(x_velocities)
-                if x_velocities else 0
-                for x_velocities in row
-            ]
-            for row in vertex_nearby_feature_residual_x_velocities_by_row_col
-        ])
-        # print(vertex_residual_x_velocities_by_row_col)
-        vertex_residual_y_velocities_by_row_col = np.array([
-            [
-                statistics.median(y_velocities)
-                if y_velocities else 0
-                for y_velocities in row
-            ]
-            for row in vertex_nearby_feature_residual_y_velocities_by_row_col
-        ])
+        vertex_residual_x_velocities_by_row_col, vertex_residual_y_velocities_by_row_col = stitch_utils.get_vertex_nearby_feature_residual_medians(
+            frame_width, frame_height, self.mesh_row_count, self.mesh_col_count,
+            self.feature_ellipse_row_count, self.feature_ellipse_col_count,
+            early_features, late_features, early_to_late_homography)
 
         # 累加全局运动量
         vertex_x_velocities_by_row_col = (vertex_global_x_velocities_by_row_col + vertex_residual_x_velocities_by_row_col).astype(np.float32)
@@ -508,7 +798,7 @@ class MeshFlowStabilizer:
         # early_features_by_subframe = []
         # late_features_by_subframe = []
 
-        common_field = 800
+        common_field = self.STITCH_COMMON_FIELD
 
         # # TODO parallelize
         # for subframe_left_x in range(0, frame_width, subframe_width):
@@ -534,6 +824,37 @@ class MeshFlowStabilizer:
         # early_features = np.concatenate(early_features_by_subframe, axis=0)
         # late_features = np.concatenate(late_features_by_subframe, axis=0)
 
+        return self._get_stitch_features_and_homography(early_features, late_features)
+    ##
+
+
+    ##  批量获取多组图像对的匹配特征点对以及全局H 所有图像对按批次调用LoFTR  ##
+    def get_matched_features_and_homography_for_stitch_batch(self, frame_pairs):
+
+        subframe_pairs, subframe_offsets = self._get_stitch_subframe_pairs(frame_pairs)
+        features_by_pair = self.loftr_for_stitch_batch(subframe_pairs, subframe_offsets)
+
+        return [self._get_stitch_features_and_homography(early_features, late_features)
+                for early_features, late_features in features_by_pair]
+
+
+    ##  截取各图像对的拼接重叠区域 左图右侧与右图左侧  ##
+    def _get_stitch_subframe_pairs(self, frame_pairs):
+
+        subframe_pairs = []
+        subframe_offsets = []
+        for early_frame, late_frame in frame_pairs:
+            frame_height, frame_width = early_frame.shape[:2]
+            common_field = self.STITCH_COMMON_FIELD
+            subframe_pairs.append((early_frame[:, (frame_width - common_field): frame_width], late_frame[:, 0: common_field]))
+            subframe_offsets.append([(frame_width - common_field), 0])
+
+        return (subframe_pairs, subframe_offsets)
+
+
+    ##  由匹配特征点对计算虚拟中点以及左右图像到中点的全局H  ##
+    def _get_stitch_features_and_homography(self, early_features, late_features):
+
         middle_points = (early_features + late_features) / 2
 
         if len(early_features) < 12:
@@ -591,110 +912,6 @@ class MeshFlowStabilizer:
             for col in range(self.mesh_col_count + 1)
         ], dtype=np.float32)
     
-    ##  获取各顶点在约定范围(椭圆)内由各特征点引起的运动向量  ##
-    def _get_vertex_nearby_feature_residual_velocities(self, frame_width, frame_height, early_features, late_features, early_to_late_homography): 
-        '''
-        Helper method for _get_unstabilized_vertex_velocities.
-
-        Given two adjacent frames, return a list that maps each vertex in the mesh to the residual
-        velocities of its nearby features.
-
-        Input:
-
-        * frame_width: the width of the windows' frames.
-        * frame_height: the height of the windows' frames.
-        * early_features: A CV_32FC2 array (see https://stackoverflow.com/a/47617999) of positions
-            containing the coordinates of each non-outlying feature in early_subframe that was
-            successfully tracked in late_subframe. These coordinates are expressed relative to the
-            frame, not the window. If fewer than self.homography_min_number_corresponding_features such 
-            features were found, early_features is None.
-        * late_features: A CV_32FC2 array (see https://stackoverflow.com/a/47617999) of positions
-            containing the coordinates of each non-outlying feature in late_subframe that was
-            successfully tracked from early_subframe. These coordinates are expressed relative to the
-            frame, not the window. If fewer than self.homography_min_number_corresponding_features such 
-            features were found, late_features is None.
-        * early_to_late_homography: A homography matrix that maps a point in early_frame to its
-            corresponding location in late_frame, assuming the point is not undergoing motion
-
-        Output:
-
-        A tuple of the following items in order.
-
-        * vertex_nearby_feature_x_velocities_by_row_col: A list
-            where entry vertex_nearby_feature_x_velocities_by_row_col[row, col] contains a list of
-            the x-velocities of all the features nearby the vertex at the given row and col.
-        * vertex_nearby_feature_y_velocities_by_row_col: A list
-            where entry vertex_nearby_feature_y_velocities_by_row_col[row, col] contains a list of
-            the y-velocities of all the features nearby the vertex at the given row and col.
-        '''
-        #  初始化数组
-        vertex_nearby_feature_x_velocities_by_row_col = [
-            [[] for _ in range(self.mesh_col_count + 1)]
-            for _ in range(self.mesh_row_count + 1)
-        ]
-        vertex_nearby_feature_y_velocities_by_row_col = [
-            [[] for _ in range(self.mesh_col_count + 1)]
-            for _ in range(self.mesh_row_count + 1)
-        ]
-
-        if early_features is not None:
-            # calculate features' velocities; see https://stackoverflow.com/a/44409124 for
-            # combining the positions and velocities into one matrix
-
-            # If a point were undergoing no motion, then its position in the late frame would be
-            # found by applying early_to_late_homography to its position in the early frame.
-            # The point's additional motion is what takes it from that position to its actual
-            # position.
-
-            # 计算特征点自身的运动(去除全局运动) v_p~ = p - F_t*p^
-            feature_residual_velocities = late_features - cv2.perspectiveTransform(early_features, early_to_late_homography)
-
-            # 数据类型转换
-            # a = array([1, 2, 3])
-            # b = array([ 6, 7, 8])
-            # >>> np.c_[a, b]
-            # array([[ 1,  6],
-            #        [ 2,  7],
-            #        [ 3,  8]])
-            # 首列存当前帧特征点的位置 次列存帧间相对运动
-            feature_positions_and_residual_velocities = np.c_[late_features, feature_residual_velocities]
-
-            # apply features' velocities to nearby mesh vertices
-            for feature_position_and_residual_velocity in feature_positions_and_residual_velocities:
-                feature_x, feature_y, feature_residual_x_velocity, feature_residual_y_velocity = feature_position_and_residual_velocity[0]
-                feature_row = (feature_y / frame_height) * self.mesh_row_count
-                feature_col = (feature_x / frame_width) * self.mesh_col_count
-
-                # Draw an ellipse around each feature of width self.feature_ellipse_col_count
-                # and height self.feature_ellipse_row_count,
-                # and apply the feature's velocity to all mesh vertices that fall within this ellipse.
-                # To do this, we can iterate through all the rows that the ellipse covers.
-                # For each row, we can use the equation for an ellipse centered on the
-                # feature to determine which columns the ellipse covers. The resulting
-                # (row, column) pairs correspond to the vertices in the ellipse.
-
-                # 顶行
-                ellipse_top_row_inclusive = max(0, math.ceil(feature_row - self.feature_ellipse_row_count / 2))
-                # 底行
-                ellipse_bottom_row_exclusive = 1 + min(self.mesh_row_count, math.floor(feature_row + self.feature_ellipse_row_count / 2))
-
-                for vertex_row in range(ellipse_top_row_inclusive, ellipse_bottom_row_exclusive):
-
-                    # half-width derived from ellipse equation
-                    # 计算每一行所包含的列
-                    ellipse_slice_half_width = self.feature_ellipse_col_count * \
-                        math.sqrt((1/4) - ((vertex_row - feature_row) / self.feature_ellipse_row_count) ** 2)
-                    # 左列
-                    ellipse_left_col_inclusive = max(0, math.ceil(feature_col - ellipse_slice_half_width))
-                    # 右列
-                    ellipse_right_col_exclusive = 1 + min(self.mesh_col_count, math.floor(feature_col + ellipse_slice_half_width))
-                    # 向对应网格点中存入运动向量
-                    for vertex_col in range(ellipse_left_col_inclusive, ellipse_right_col_exclusive):
-                        vertex_nearby_feature_x_velocities_by_row_col[vertex_row][vertex_col].append(feature_residual_x_velocity)
-                        vertex_nearby_feature_y_velocities_by_row_col[vertex_row][vertex_col].append(feature_residual_y_velocity)
-
-        return (vertex_nearby_feature_x_velocities_by_row_col, vertex_nearby_feature_y_velocities_by_row_col)
-
     ##  设立局部网格，根据不同阈值获得整张图像特征点以及帧间单应性变换  ##
     def _get_matched_features_and_homography(self, early_frame, late_frame):
         '''
@@ -833,31 +1050,21 @@ class MeshFlowStabilizer:
 
         return early_to_late_homography
 
-    ## LoFTR方法获取局部网格内的特征点坐标  ##
-    def loftr_in_subframe(self, early_subframe, late_subframe, subframe_offset):
-
-        import kornia as K
-        import kornia.feature as KF
-        import torch
-
-        img1 = K.image_to_tensor(early_subframe, False).float() /255.
-        img1 = K.color.bgr_to_rgb(img1)
-
-        img2 = K.image_to_tensor(late_subframe, False).float() /255.
-        img2 = K.color.bgr_to_rgb(img2)
+    ##  获取LoFTR匹配器  ##
+    def _get_matcher(self):
+        '''
+        Return the LoFTR matcher given to the constructor, or the one shared by the process
+        (see loftr_matcher.get_shared_matcher).
+        '''
 
-        matcher = KF.LoFTR(pretrained='outdoor')
-        matcher.cuda()
-        matcher.eval()
+        return self.matcher if self.matcher is not None else loftr_matcher.get_shared_matcher()
 
-        input_dict = {"image0": K.color.rgb_to_grayscale(img1.cuda()), # LofTR works on grayscale images only 
-                    "image1": K.color.rgb_to_grayscale(img2.cuda())}
 
-        with torch.no_grad():
-            correspondences = matcher(input_dict)
+    ## LoFTR方法获取局部网格内的特征点坐标  ##
+    def loftr_in_subframe(self, early_subframe, late_subframe, subframe_offset):
 
-        mkpts0 = correspondences['keypoints0'].cpu().numpy()
-        mkpts1 = correspondences['keypoints1'].cpu().numpy()
+        # 匹配器只创建一次 权重从本地文件读取 设备自动选择
+        mkpts0, mkpts1 = self._get_matcher().match(early_subframe, late_subframe)
         _, inliers = cv2.findFundamentalMat(mkpts0, mkpts1, cv2.USAC_MAGSAC, 0.4, 0.999, 100000)
 
         filter_mask = inliers.flatten().astype(dtype = bool)
@@ -873,29 +1080,39 @@ class MeshFlowStabilizer:
     ##
     def loftr_for_stitch(self, early_subframe, late_subframe, subframe_offset):
 
-        import kornia as K
-        import kornia.feature as KF
-        import torch
+        return self.loftr_for_stitch_batch([(early_subframe, late_subframe)], [subframe_offset])[0]
 
-        img1 = K.image_to_tensor(early_subframe, False).float() /255.
-        img1 = K.color.bgr_to_rgb(img1)
 
-        img2 = K.image_to_tensor(late_subframe, False).float() /255.
-        img2 = K.color.bgr_to_rgb(img2)
+    ##  批量LoFTR匹配 subframe_pairs为(early_subframe, late_subframe)列表 缓存命中的图像对不再匹配  ##
+    def loftr_for_stitch_batch(self, subframe_pairs, subframe_offsets):
 
-        matcher = KF.LoFTR(pretrained='outdoor')
-        matcher.cuda()
-        matcher.eval()
+        # 匹配器只创建一次 权重从本地文件读取 设备自动选择
+        keys, features_by_pair, keypoints_by_pair = match_cache.match_subframes_with_cache(
+            self.match_cache, self._get_matcher(), subframe_pairs, subframe_offsets, self._get_stitch_match_filter_config())
 
-        input_dict = {"image0": K.color.rgb_to_grayscale(img1.cuda()), # LofTR works on grayscale images only 
-                    "image1": K.color.rgb_to_grayscale(img2.cuda())}
+        return self._filter_stitch_subframe_matches(keys, features_by_pair, keypoints_by_pair, subframe_offsets)
 
-        with torch.no_grad():
-            correspondences = matcher(input_dict)
 
-        mkpts0 = correspondences['keypoints0'].cpu().numpy()
-        mkpts1 = correspondences['keypoints1'].cpu().numpy()
-        _, inliers = cv2.findFundamentalMat(mkpts0, mkpts1, cv2.USAC_MAGSAC, 0.4, 0.999, 100000)
+    ##  剔除新匹配图像对的误匹配并写入缓存 缓存命中的直接使用  ##
+    def _filter_stitch_subframe_matches(self, keys, features_by_pair, keypoints_by_pair, subframe_offsets):
+
+        features_by_pair = [features if keypoints is None else self._filter_stitch_matches(*keypoints, subframe_offset)
+                            for features, keypoints, subframe_offset in zip(features_by_pair, keypoints_by_pair, subframe_offsets)]
+        match_cache.store_filtered_matches(self.match_cache, keys, features_by_pair, keypoints_by_pair)
+
+        return features_by_pair
+
+
+    ##  误匹配剔除方式与参数 作为匹配缓存键的一部分  ##
+    def _get_stitch_match_filter_config(self):
+
+        return ('fundamental_magsac',) + self.STITCH_MAGSAC_PARAMETERS
+
+
+    ##  MAGSAC剔除误匹配 并将early特征点转换为整张图像坐标  ##
+    def _filter_stitch_matches(self, mkpts0, mkpts1, subframe_offset):
+
+        _, inliers = cv2.findFundamentalMat(mkpts0, mkpts1, cv2.USAC_MAGSAC, *self.STITCH_MAGSAC_PARAMETERS)
 
         filter_mask = inliers.flatten().astype(dtype = bool)
         mkpts0_filtered = mkpts0[filter_mask]
@@ -1025,7 +1242,7 @@ class MeshFlowStabilizer:
         return (early_features, late_features)
 
 
-    ##  使用雅可比方法 获得稳定后的各帧顶点运动向量 其数据格式与未稳定类似 (num_frames, row + 1, col + 1, 2)
+    ##  求解带状线性系统 获得稳定后的各帧顶点运动向量 其数据格式与未稳定类似 (num_frames, row + 1, col + 1, 2)
     def _get_stabilized_vertex_displacements(self, num_frames, unstabilized_frames, adaptive_weights_definition, vertex_unstabilized_displacements_by_frame_index, homographies):
         '''
         Helper method for stabilize.
@@ -1036,8 +1253,7 @@ class MeshFlowStabilizer:
         The energy function takes displacements as input and outputs a number corresponding
         to how shaky the input is.
 
-        The output array of stabilized displacements is calculated using the
-        Jacobi method. For each mesh vertex, the method solves the equation
+        For each mesh vertex, the stabilized displacements solve the equation
         A p = b
         for vector p,
         where entry p[i] contains the vertex's stabilized displacement at frame i.
@@ -1045,6 +1261,10 @@ class MeshFlowStabilizer:
         energy function with respect to each p[i] and setting them all to 0. Thus, solving for p in
         A p = b results in displacements that produce a local extremum (which we can safely
         assume is a local minimum) in the energy function.
+        A is banded (its entries vanish outside temporal_smoothing_radius) and shared by every
+        vertex and velocity component, so it is factored once and all
+        (mesh_row_count + 1) * (mesh_col_count + 1) * 2 systems are solved together;
+        see _get_path_solver.
 
         Input:
 
@@ -1069,194 +1289,95 @@ class MeshFlowStabilizer:
             vertex_unstabilized_displacements_by_frame_index[frame_index][row][col][1]
             contains the corresponding y-displacement.
         '''
-        ##
-        frame_height, frame_width = unstabilized_frames[0].shape[:2]
-        # 非对角系数 对角系数
-        off_diagonal_coefficients, on_diagonal_coefficients = self._get_jacobi_method_input(
-            num_frames, frame_width, frame_height, adaptive_weights_definition, homographies)
-        ##
-
-        # vertex_unstabilized_displacements_by_frame_index is indexed by
-        # frame_index, then row, then col, then velocity component.
-        # Instead, vertex_unstabilized_displacements_by_coord is indexed by
-        # row, then col, then frame_index, then velocity component;
-        # this rearrangement should allow for faster access during the optimization step.
-        # 坐标轴0位置换坐标轴2 其他轴位置不变 (num_frames, self.mesh_row_count + 1, self.mesh_col_count + 1, 2)
-        vertex_unstabilized_displacements_by_coord = np.moveaxis(
-            vertex_unstabilized_displacements_by_frame_index, 0, 2)
-        
-        # 初始化稳定后的顶点位移
-        vertex_stabilized_displacements_by_coord = np.empty(
-            vertex_unstabilized_displacements_by_coord.shape)
 
-        # TODO parallelize
-        with tqdm.trange((self.mesh_row_count + 1) * (self.mesh_col_count + 1)) as t:
-            t.set_description('Computing stabilized mesh displacements')
-            for mesh_coords_flattened in t:
-                # 先列后行 (0,0),(0,1),...,(1,0),(1,1),...
-                ##
-                mesh_row = mesh_coords_flattened // (self.mesh_col_count + 1)   # 商向前取整
-                mesh_col = mesh_coords_flattened % (self.mesh_col_count + 1)    # 取余
-                ##
-                # 取出对应的 (num_frames, 2)
-                vertex_unstabilized_displacements = vertex_unstabilized_displacements_by_coord[mesh_row][mesh_col]
-                vertex_stabilized_displacements = self._get_jacobi_method_output(
-                    off_diagonal_coefficients, on_diagonal_coefficients,
-                    vertex_unstabilized_displacements,
-                    vertex_unstabilized_displacements
-                )
-                vertex_stabilized_displacements_by_coord[mesh_row][mesh_col] = vertex_stabilized_displacements
-
-            # 还原
-            vertex_stabilized_displacements_by_frame_index = np.moveaxis(
-                vertex_stabilized_displacements_by_coord, 2, 0
-            )
+        frame_height, frame_width = unstabilized_frames[0].shape[:2]
+        adaptive_weights = self._get_adaptive_weights(num_frames, frame_width, frame_height, adaptive_weights_definition,
+                                                      homographies)
+        path_solver = self._get_path_solver(num_frames, adaptive_weights)
 
-        return vertex_stabilized_displacements_by_frame_index
+        # b为未稳定的顶点位移 所有顶点与xy分量一次求解
+        return path_solver.solve(vertex_unstabilized_displacements_by_frame_index)
 
 
     ##
     def _get_unified_stabilized_vertex_displacements(self, num_frames, vertex_for_stitch,
                                                      vertex_unstabilized_displacements_by_frame_index, vertex_stabilized_displacements_by_frame_index):
-            ##
-            # frame_height, frame_width = unstabilized_frames[0].shape[:2]
-            # 非对角系数 对角系数
-            off_diagonal_coefficients, on_diagonal_coefficients = self._get_jacobi_method_input_for_stitch(num_frames)
-            ##
-
-            # vertex_unstabilized_displacements_by_frame_index is indexed by
-            # frame_index, then row, then col, then velocity component.
-            # Instead, vertex_unstabilized_displacements_by_coord is indexed by
-            # row, then col, then frame_index, then velocity component;
-            # this rearrangement should allow for faster access during the optimization step.
-            # 坐标轴0位置换坐标轴2 其他轴位置不变 (num_frames, self.mesh_row_count + 1, self.mesh_col_count + 1, 2)
-            vertex_for_stitch_coord = np.moveaxis(vertex_for_stitch, 0, 2)
-            vertex_for_start = vertex_for_stitch + vertex_unstabilized_displacements_by_frame_index - vertex_stabilized_displacements_by_frame_index
-            vertex_for_start_coord = np.moveaxis(vertex_for_start, 0, 2)
-                      
-            # 初始化稳定后的顶点位移
-            vertex_stabilized_displacements_by_coord = np.empty(vertex_for_stitch_coord.shape)
+        '''
+        Helper method for the unified stabilization and stitching stage.
+
+        Smooth the stitch displacements vertex_for_stitch over time with the constant adaptive
+        weights of _get_jacobi_method_input_for_stitch. The system is solved directly, so unlike
+        the Jacobi method the result does not depend on the starting point
+        vertex_for_stitch + vertex_unstabilized_displacements_by_frame_index - vertex_stabilized_displacements_by_frame_index;
+        the latter two arguments are kept for compatibility.
+        '''
+
+        path_solver = self._get_path_solver(num_frames, self._get_stitch_adaptive_weights(num_frames))
+
+        return path_solver.solve(vertex_for_stitch)
 
-            # TODO parallelize
-            with tqdm.trange((self.mesh_row_count + 1) * (self.mesh_col_count + 1)) as t:
-                t.set_description('Computing unified mesh displacements')
-                for mesh_coords_flattened in t:
-                    # 先列后行 (0,0),(0,1),...,(1,0),(1,1),...
-                    ##
-                    mesh_row = mesh_coords_flattened // (self.mesh_col_count + 1)   # 商向前取整
-                    mesh_col = mesh_coords_flattened % (self.mesh_col_count + 1)    # 取余
-                    ##
-                    # 取出对应的 (num_frames, 2)
-                    # vertex_unstabilized_displacements = vertex_unstabilized_displacements_by_coord[mesh_row][mesh_col]
-                    vertex_for_stitch_displacements = vertex_for_stitch_coord[mesh_row][mesh_col]
-                    vertex_for_start = vertex_for_start_coord[mesh_row][mesh_col]
-                    vertex_stabilized_displacements = self._get_jacobi_method_output(
-                        off_diagonal_coefficients, on_diagonal_coefficients,
-                        vertex_for_stitch_displacements, vertex_for_start)
-                    vertex_stabilized_displacements_by_coord[mesh_row][mesh_col] = vertex_stabilized_displacements
-
-                # 还原
-                vertex_stabilized_displacements_by_frame_index = np.moveaxis(
-                    vertex_stabilized_displacements_by_coord, 2, 0)
-
-            return vertex_stabilized_displacements_by_frame_index
-    
     ##
     def _get_stitch_vertex_displacements(self, num_frames, vertex_for_stitch):
-        ##
-        # frame_height, frame_width = unstabilized_frames[0].shape[:2]
-        # 非对角系数 对角系数
-        off_diagonal_coefficients, on_diagonal_coefficients = self._get_jacobi_method_input_for_stitch(num_frames)
-        ##
+        '''
+        Helper method for the stitching stage.
 
-        # vertex_unstabilized_displacements_by_frame_index is indexed by
-        # frame_index, then row, then col, then velocity component.
-        # Instead, vertex_unstabilized_displacements_by_coord is indexed by
-        # row, then col, then frame_index, then velocity component;
-        # this rearrangement should allow for faster access during the optimization step.
-        # 坐标轴0位置换坐标轴2 其他轴位置不变 (num_frames, self.mesh_row_count + 1, self.mesh_col_count + 1, 2)
-        vertex_for_stitch_coord = np.moveaxis(vertex_for_stitch, 0, 2)
-        vertex_for_start = vertex_for_stitch
-        vertex_for_start_coord = np.moveaxis(vertex_for_start, 0, 2)
-                    
-        # 初始化稳定后的顶点位移
-        vertex_stabilized_displacements_by_coord = np.empty(vertex_for_stitch_coord.shape)
+        Smooth the stitch displacements vertex_for_stitch over time with the constant adaptive
+        weights of _get_jacobi_method_input_for_stitch. The factorization is cached, so the left and
+        right stitch fields of the same video share it.
+        '''
 
-        # TODO parallelize
-        with tqdm.trange((self.mesh_row_count + 1) * (self.mesh_col_count + 1)) as t:
-            t.set_description('Computing unified mesh displacements')
-            for mesh_coords_flattened in t:
-                # 先列后行 (0,0),(0,1),...,(1,0),(1,1),...
-                ##
-                mesh_row = mesh_coords_flattened // (self.mesh_col_count + 1)   # 商向前取整
-                mesh_col = mesh_coords_flattened % (self.mesh_col_count + 1)    # 取余
-                ##
-                # 取出对应的 (num_frames, 2)
-                # vertex_unstabilized_displacements = vertex_unstabilized_displacements_by_coord[mesh_row][mesh_col]
-                vertex_for_stitch_displacements = vertex_for_stitch_coord[mesh_row][mesh_col]
-                vertex_for_start = vertex_for_start_coord[mesh_row][mesh_col]
-                vertex_stabilized_displacements = self._get_jacobi_method_output(
-                    off_diagonal_coefficients, on_diagonal_coefficients,
-                    vertex_for_stitch_displacements, vertex_for_start)
-                vertex_stabilized_displacements_by_coord[mesh_row][mesh_col] = vertex_stabilized_displacements
-
-            # 还原
-            vertex_stabilized_displacements_by_frame_index = np.moveaxis(
-                vertex_stabilized_displacements_by_coord, 2, 0)
-
-        return vertex_stabilized_displacements_by_frame_index
+        path_solver = self._get_path_solver(num_frames, self._get_stitch_adaptive_weights(num_frames))
 
-    def _get_jacobi_method_input_for_stitch(self, num_frames):
+        return path_solver.solve(vertex_for_stitch)
 
-        # row_indexes[row][col] = row, col_indexes[row][col] = col
-        # 返回一个表示索引的数组 维度为输入视频的帧总数
-        row_indexes, col_indexes = np.indices((num_frames, num_frames))
-
-        # regularization_weights[t, r] is a weight constant applied to the regularization term.
-        # In the paper, regularization_weights[t, r] is denoted as w_{t,r}.
-        # NOTE that regularization_weights[i, i] = 0.
-        # row_indexes - col_indexes
-        # [[ 0 -1 -2 -3]
-        #  [ 1  0 -1 -2]
-        #  [ 2  1  0 -1]
-        #  [ 3  2  1  0]]
-        # \omega_(t,r)
-        regularization_weights = np.exp(-np.square((3 / self.temporal_smoothing_radius)* (row_indexes - col_indexes)))
+    ##  获取分解后的带状系统 按(num_frames, temporal_smoothing_radius, adaptive_weights)缓存  ##
+    def _get_path_solver(self, num_frames, adaptive_weights):
+        '''
+        Helper method for _get_stabilized_vertex_displacements, _get_stitch_vertex_displacements
+        and _get_unified_stabilized_vertex_displacements.
 
-        # adaptive_weights[t] is a weight, derived from properties of the frames, applied to the
-        # regularization term corresponding to the frame at index t
-        # Note that the paper does not specify the weight to apply to the last frame (which does not
-        # have a velocity), so we assume it is the same as the second-to-last frame.
-        # In the paper, adaptive_weights[t] is denoted as \lambda_{t}.
-        # adaptive_weights = self._get_adaptive_weights(num_frames, frame_width, frame_height, adaptive_weights_definition, 
-        #                                               homographies)
-        adaptive_weights = np.full((num_frames), 2)
-        # combined_adaptive_regularization_weights[t, r] = \lambda_{t} w_{t, r}
-        # adaptive_weights转化为对角阵，矩阵相乘
-        # [[2 0 0]    [[0 1 4]    [[0 2 8]
-        #  [0 2 0]  *  [1 0 1]  =  [2 0 2]
-        #  [0 0 2]]    [4 1 0]]    [8 2 0]] 
-        combined_adaptive_regularization_weights = np.matmul(np.diag(adaptive_weights), regularization_weights)
+        Return a path_solver.BandedPathSolver holding the LU factorization of the matrix A
+        described in _get_jacobi_method_input. Factorizations are cached per
+        (num_frames, temporal_smoothing_radius, adaptive_weights); the least recently used one is
+        dropped once more than self.path_solver_cache_size are stored.
 
-        # the off-diagonal entry at cell [t, r] is written as  -2 * \lambda_{t} w_{t, r}
-        off_diagonal_coefficients = -2 * combined_adaptive_regularization_weights
+        Input:
 
-        # the on-diagonal entry at cell [t, t] is written as
-        # 1 + 2 * \sum_{r \in \Omega_{t}, r \neq t} \lambda_{t} w_{t, r}.
-        # NOTE Since w_{t, t} = 0,
-        # we can ignore the r \neq t constraint on the sum and write the on-diagonal entry at cell [t, t] as
-        # 1 + 2 * \sum{r \in \Omega_{t}} \lambda_{t} w_{t, r}.
-        # 按行求和 生成一维数组
-        on_diagonal_coefficients = 1 + 2 * np.sum(combined_adaptive_regularization_weights, axis=1)
+        * num_frames: The number of frames in the video.
+        * adaptive_weights: A NumPy array of shape (num_frames,) as returned by
+            _get_adaptive_weights.
 
-        # set coefficients to 0 for appropriate t, r; see https://stackoverflow.com/a/36247680
-        # 将对角线上下一部分元素置1 即将各t对应r范围外的元素置零
-        off_diagonal_mask = np.zeros(off_diagonal_coefficients.shape)
-        for i in range(-self.temporal_smoothing_radius, self.temporal_smoothing_radius + 1):
-            off_diagonal_mask += np.diag(np.ones(num_frames - abs(i)), i)
-        off_diagonal_coefficients = np.where(off_diagonal_mask, off_diagonal_coefficients, 0)
+        Output:
 
-        return (off_diagonal_coefficients, on_diagonal_coefficients)
+        * path_solver: A path_solver.BandedPathSolver for A.
+        '''
+
+        adaptive_weights = np.asarray(adaptive_weights, dtype=np.float64)
+        key = (int(num_frames), self.temporal_smoothing_radius, adaptive_weights.tobytes())
+
+        if key in self.path_solver_cache:
+            self.path_solver_cache.move_to_end(key)
+            return self.path_solver_cache[key]
+
+        off_diagonal_coefficients, on_diagonal_coefficients = self._get_smoothing_coefficients(num_frames, adaptive_weights)
+        solver = path_solver.BandedPathSolver.from_jacobi_coefficients(
+            off_diagonal_coefficients, on_diagonal_coefficients, self.temporal_smoothing_radius)
+
+        self.path_solver_cache[key] = solver
+        while len(self.path_solver_cache) > self.path_solver_cache_size:
+            self.path_solver_cache.popitem(last=False)
+
+        return solver
+
+    ##  拼接运动场平滑所用的固定自适应权重  ##
+    def _get_stitch_adaptive_weights(self, num_frames):
+        # adaptive_weights = self._get_adaptive_weights(num_frames, frame_width, frame_height, adaptive_weights_definition, 
+        #                                               homographies)
+        return np.full((num_frames), 2)
+
+    def _get_jacobi_method_input_for_stitch(self, num_frames):
+
+        return self._get_smoothing_coefficients(num_frames, self._get_stitch_adaptive_weights(num_frames))
     ##
 
     ##  获得Jacobi方法中的A矩阵 A的列方向对应整个视频序列 行对应稳定每一帧所需前后一定范围r的图像  ##
@@ -1282,34 +1403,16 @@ class MeshFlowStabilizer:
 
         A tuple of the following items in order.
 
-        * off_diagonal_coefficients: A 2D NumPy array containing the off-diagonal entries of A.
-            Specifically, off_diagonal_coefficients[i, j] = A_{i, j} where i != j, and all
-            on-diagonal entries off_diagonal_coefficients[i, i] = 0.
+        * off_diagonal_coefficients: A 2D NumPy array of shape
+            (2 * temporal_smoothing_radius + 1, num_frames) containing the off-diagonal entries of A
+            in banded form. Specifically,
+            off_diagonal_coefficients[temporal_smoothing_radius + offset, i] = A_{i, i + offset}
+            for |offset| <= temporal_smoothing_radius; A_{i, j} = 0 for all other i != j.
             In the Wikipedia link, this matrix is L + U.
         * on_diagonal_coefficients: A 1D NumPy array containing the on-diagonal entries of A.
             Specifically, on_diagonal_coefficients[i] = A_{i, i}.
         '''
 
-        # row_indexes[row][col] = row, col_indexes[row][col] = col
-        # 返回一个表示索引的数组 维度为输入视频的帧总数
-        #  np.indices((2, 3))
-        #  [[0 0 0]
-        #   [1 1 1]]
-        #  [[0 1 2]
-        #   [0 1 2]]
-        row_indexes, col_indexes = np.indices((num_frames, num_frames))
-
-        # regularization_weights[t, r] is a weight constant applied to the regularization term.
-        # In the paper, regularization_weights[t, r] is denoted as w_{t,r}.
-        # NOTE that regularization_weights[i, i] = 0.
-        # row_indexes - col_indexes
-        # [[ 0 -1 -2 -3]
-        #  [ 1  0 -1 -2]
-        #  [ 2  1  0 -1]
-        #  [ 3  2  1  0]]
-        # \omega_(t,r)
-        regularization_weights = np.exp(-np.square((3 / self.temporal_smoothing_radius)* (row_indexes - col_indexes)))
-
         # adaptive_weights[t] is a weight, derived from properties of the frames, applied to the
         # regularization term corresponding to the frame at index t
         # Note that the paper does not specify the weight to apply to the last frame (which does not
@@ -1318,34 +1421,45 @@ class MeshFlowStabilizer:
         adaptive_weights = self._get_adaptive_weights(num_frames, frame_width, frame_height, adaptive_weights_definition, 
                                                       homographies)
 
-        # combined_adaptive_regularization_weights[t, r] = \lambda_{t} w_{t, r}
-        # adaptive_weights转化为对角阵，矩阵相乘
-        # [[2 0 0]    [[0 1 4]    [[0 2 8]
-        #  [0 2 0]  *  [1 0 1]  =  [2 0 2]
-        #  [0 0 2]]    [4 1 0]]    [8 2 0]] 
-        combined_adaptive_regularization_weights = np.matmul(np.diag(adaptive_weights), regularization_weights)
+        return self._get_smoothing_coefficients(num_frames, adaptive_weights)
+
+    ##  由自适应权重构建A矩阵的系数(带状存储)  ##
+    def _get_smoothing_coefficients(self, num_frames, adaptive_weights):
+        '''
+        Helper method for _get_jacobi_method_input, _get_jacobi_method_input_for_stitch and
+        _get_path_solver.
+        Return the coefficients of matrix A for the given adaptive weights, in the banded format
+        described in _get_jacobi_method_input. Only O(num_frames * temporal_smoothing_radius)
+        memory is used; no num_frames x num_frames array is built.
+        '''
+
+        radius = self.temporal_smoothing_radius
+        adaptive_weights = np.asarray(adaptive_weights, dtype=np.float64)
+
+        # regularization_weights[t, r] = w_{t, r} 只与|t - r|有关
+        # kernel[d] = w_{t, t + d}, d = 0 ... num_frames - 1
+        kernel = np.exp(-np.square((3 / radius) * np.arange(num_frames)))
 
         # 以下两个方程参考文章《Bundled Camera Paths for Video Stabilization》 Page5 Eq.6
         # the off-diagonal entry at cell [t, r] is written as  -2 * \lambda_{t} w_{t, r}
-        off_diagonal_coefficients = -2 * combined_adaptive_regularization_weights
+        # and is kept only for |t - r| <= radius.
+        # off_diagonal_coefficients[radius + offset, t] = A_off[t, t + offset]
+        offsets = np.arange(-radius, radius + 1)
+        off_diagonal_coefficients = -2 * adaptive_weights[np.newaxis, :] * kernel[np.minimum(np.abs(offsets), num_frames - 1)][:, np.newaxis]
+        # 超出矩阵边界的元素置零
+        col_indexes = np.arange(num_frames)[np.newaxis, :] + offsets[:, np.newaxis]
+        off_diagonal_coefficients[(col_indexes < 0) | (col_indexes >= num_frames)] = 0
 
         # the on-diagonal entry at cell [t, t] is written as
-        # 1 + 2 * \sum_{r \in \Omega_{t}, r \neq t} \lambda_{t} w_{t, r}.
-        # NOTE Since w_{t, t} = 0,
-        # we can ignore the r \neq t constraint on the sum and write the on-diagonal entry at cell [t, t] as
         # 1 + 2 * \sum{r \in \Omega_{t}} \lambda_{t} w_{t, r}.
-        # 按行求和 生成一维数组
-        on_diagonal_coefficients = 1 + 2 * np.sum(combined_adaptive_regularization_weights, axis=1)
-
-        # set coefficients to 0 for appropriate t, r; see https://stackoverflow.com/a/36247680
-        # 将对角线上下一部分元素置1 即将各t对应r范围外的元素置零
-        off_diagonal_mask = np.zeros(off_diagonal_coefficients.shape)
-        for i in range(-self.temporal_smoothing_radius, self.temporal_smoothing_radius + 1):
-            off_diagonal_mask += np.diag(np.ones(num_frames - abs(i)), i)
-        off_diagonal_coefficients = np.where(off_diagonal_mask, off_diagonal_coefficients, 0)
+        # The sum runs over all frames; with cumulative_kernel[d] = \sum_{i <= d} kernel[i],
+        # \sum_{r} w_{t, r} = cumulative_kernel[t] + cumulative_kernel[num_frames - 1 - t] - kernel[0].
+        cumulative_kernel = np.cumsum(kernel)
+        regularization_weight_sums = cumulative_kernel + cumulative_kernel[::-1] - kernel[0]
+        on_diagonal_coefficients = 1 + 2 * adaptive_weights * regularization_weight_sums
 
         return (off_diagonal_coefficients, on_diagonal_coefficients)
-    
+
     ##  计算\Lambda_t  ##
     def _get_adaptive_weights(self, num_frames, frame_width, frame_height, adaptive_weights_definition, homographies):
         '''
@@ -1379,27 +1493,23 @@ class MeshFlowStabilizer:
             # 将所有H矩阵第三行置为[0, 0, 1]，此时单应变换退化为仿射变换
             homography_affine_components[:, 2, :] = [0, 0, 1]
 
-            # 建立长度为num_frames的一维数组
-            adaptive_weights = np.empty((num_frames))
+            # 批量求特征值 按行排序(小到大) 绝对值
+            sorted_eigenvalue_magnitudes = np.sort(np.abs(np.linalg.eigvals(homography_affine_components[:num_frames])), axis=1)
 
-            for frame_index in range(num_frames):
-                homography = homography_affine_components[frame_index]
-                # 按行排序(小到大) 绝对值 特征值
-                sorted_eigenvalue_magnitudes = np.sort(np.abs(np.linalg.eigvals(homography)))
+            # 平移部分(通过图像宽高进行归一化)
+            translational_elements = np.sqrt((homography_affine_components[:num_frames, 0, 2] / frame_width) ** 2 +
+                                             (homography_affine_components[:num_frames, 1, 2] / frame_height) ** 2)
+            # 仿射部分
+            affine_components = sorted_eigenvalue_magnitudes[:, -2] / sorted_eigenvalue_magnitudes[:, -1]
 
-                # 平移部分(通过图像宽高进行归一化)
-                translational_element = math.sqrt((homography[0, 2] / frame_width) ** 2 + (homography[1, 2] / frame_height) ** 2)
-                # 仿射部分
-                affine_component = sorted_eigenvalue_magnitudes[-2] / sorted_eigenvalue_magnitudes[-1]
+            adaptive_weight_candidates_1 = -1.93 * translational_elements + 0.95
 
-                adaptive_weight_candidate_1 = -1.93 * translational_element + 0.95
+            if adaptive_weights_definition == MeshFlowStabilizer.ADAPTIVE_WEIGHTS_DEFINITION_ORIGINAL:
+                adaptive_weight_candidates_2 = 5.83 * affine_components + 4.88
+            else:  # ADAPTIVE_WEIGHTS_DEFINITION_FLIPPED
+                adaptive_weight_candidates_2 = 5.83 * affine_components - 4.88
 
-                if adaptive_weights_definition == MeshFlowStabilizer.ADAPTIVE_WEIGHTS_DEFINITION_ORIGINAL:
-                    adaptive_weight_candidate_2 = 5.83 * affine_component + 4.88
-                else:  # ADAPTIVE_WEIGHTS_DEFINITION_FLIPPED
-                    adaptive_weight_candidate_2 = 5.83 * affine_component - 4.88
-
-                adaptive_weights[frame_index] = max( min(adaptive_weight_candidate_1,adaptive_weight_candidate_2), 0)
+            adaptive_weights = np.maximum(np.minimum(adaptive_weight_candidates_1, adaptive_weight_candidates_2), 0)
         
         # 直接赋值
         elif adaptive_weights_definition == MeshFlowStabilizer.ADAPTIVE_WEIGHTS_DEFINITION_CONSTANT_HIGH:
@@ -1422,11 +1532,9 @@ class MeshFlowStabilizer:
 
         Input:
 
-        * off_diagonal_coefficients: A 2D NumPy array containing the off-diagonal entries of A.
-            Specifically, off_diagonal_coefficients[i, j] = A_{i, j} where i != j, and all
-            on-diagonal entries off_diagonal_coefficients[i, i] = 0.
+        * off_diagonal_coefficients: A banded 2D NumPy array as returned by _get_jacobi_method_input.
             In the Wikipedia link, this matrix is L + U.
-         * on_diagonal_coefficients: A 1D NumPy array containing the on-diagonal entries of A.
+        * on_diagonal_coefficients: A 1D NumPy array containing the on-diagonal entries of A.
             Specifically, on_diagonal_coefficients[i] = A_{i, i}.
             In the Wikipedia link, this array is the diagonal entries of D.
         * x_start: A NumPy array containing an initial estimate for x.
@@ -1439,13 +1547,12 @@ class MeshFlowStabilizer:
 
         x = x_start.copy()
 
-        # np.reciprocal取倒数 构造对角矩阵 即D^(-1)
-        reciprocal_on_diagonal_coefficients_matrix = np.diag(np.reciprocal(on_diagonal_coefficients))
+        # np.reciprocal取倒数 即D^(-1)的对角元素 按帧广播到x的其余维度
+        reciprocal_on_diagonal_coefficients = np.reciprocal(on_diagonal_coefficients).reshape((-1,) + (1,) * (np.ndim(x) - 1))
          
         # x^(k+1) = D^(-1) * (b - (L + U) * x^(k))
         for _ in range(self.optimization_num_iterations):
-            x = np.matmul(reciprocal_on_diagonal_coefficients_matrix,
-                          b - np.matmul(off_diagonal_coefficients, x))
+            x = reciprocal_on_diagonal_coefficients * (b - path_solver.banded_matmul(off_diagonal_coefficients, x))
 
         return x
 
@@ -1698,41 +1805,6 @@ class MeshFlowStabilizer:
 
         frame_height, frame_width = unstabilized_frames[0].shape[:2]
 
-        # unstabilized_vertex_x_y and stabilized_vertex_x_y are CV_32FC2 NumPy arrays
-        # (see https://stackoverflow.com/a/47617999)
-        # of the coordinates of the mesh nodes in the stabilized video, indexed from the top left
-        # corner and moving left-to-right, top-to-bottom.
-        # 例 [[[ 0., 0.]]
-        #     [[40., 0.]]
-        #     ...
-        #     [[ 0., 40.]]
-        #     [[40., 40.]]
-        #     ...
-        #     [[600., 479.]]
-        #     [[639., 479.]]]
-        unstabilized_vertex_x_y = self._get_vertex_x_y(frame_width, frame_height)
-
-        # row_col_to_unstabilized_vertex_x_y[row, col] and
-        # row_col_to_stabilized_vertex_x_y[row, col]
-        # contain the x and y positions of the vertex at the given row and col
-        # 原格式 ((self.mesh_row_count + 1)* (self.mesh_col_count + 1), 1, 2)
-        # [[[  0.   0.]
-        #   [ 40.   0.]]
-        #    ...
-        #   [639.   0.]]
-        #
-        #  [[  0.  60.]
-        #   [ 40.  60.]
-        #    ...
-        #   [639.  60.]]
-        #    ...
-        #  [[  0. 479.]
-        #   [ 40. 479.]
-        #    ...
-        #   [639. 479.]]]
-        row_col_to_unstabilized_vertex_x_y = np.reshape(
-            unstabilized_vertex_x_y, (self.mesh_row_count + 1, self.mesh_col_count + 1, 2))
-
         # stabilized_motion_mesh_by_frame_index[frame_index] is a CV_32FC2 NumPy array
         # (see https://stackoverflow.com/a/47617999) containing the amount to add to each vertex coordinate to transform it 
         # from its unstabilized position at frame frame_index to its stabilized position at frame frame_index.
@@ -1746,56 +1818,6 @@ class MeshFlowStabilizer:
             (num_frames, -1, 1, 2)
         )
         
-        # Construct map from the stabilized frame to the unstabilized frame.
-        # If (x_s, y_s) in the stabilized video is taken from (x_u, y_u) in the unstabilized
-        # video, then
-        # stabilized_y_x_to_unstabilized_x[y_s, x_s] = x_u,
-        # stabilized_y_x_to_unstabilized_y[y_s, x_s] = y_u, and
-        # frame_stabilized_y_x_to_stabilized_x_y[y_s, x_s] = [x_u, y_u].
-        # NOTE the inverted coordinate order. This setup allows us to index into map just like
-        # we index into the image. Each point [x_u, y_u] in the array is in OpenCV's expected
-        # order so we can easily apply homographies to those points.
-        # NOTE If a given coordinate's value is not changed by the subsequent steps, then that
-        # coordinate falls outside the stabilized image (so in the output image, that image
-        # should be filled with a border color).
-        # Since these arrays' default values fall outside the unstabilized image, remap will
-        # fill in those coordinates in the stabilized image with the border color as desired.
-        # 数组形状 (frame_height, frame_width) 填充值为frame_width + 1/frame_height + 1
-        frame_stabilized_y_x_to_unstabilized_x_template = np.full((frame_height, frame_width), frame_width + 1)
-        frame_stabilized_y_x_to_unstabilized_y_template = np.full((frame_height, frame_width), frame_height + 1)
-        
-        # a = np.indices((2, 3), dtype=np.float32)
-        # [[[0. 0. 0.]
-        #   [1. 1. 1.]]
-        #  [[0. 1. 2.]
-        #   [0. 1. 2.]]]
-        # shape(a) = (2, 2, 3)
-
-        # b = np.swapaxes(a, 0, 2)
-        #   [[[0. 0.]
-        #     [1. 0.]]
-        #    [[0. 1.]
-        #     [1. 1.]]
-        #    [[0. 2.]
-        #     [1. 2.]]]
-        # shape(b) = (3, 2, 2)
-
-        # shape(frame_stabilized_y_x_to_stabilized_x_y_template) = (frame_height, frame_width, 2)
-        frame_stabilized_y_x_to_stabilized_x_y_template = np.swapaxes(
-            np.indices((frame_width, frame_height), dtype=np.float32), 0, 2)
-        # shape(frame_stabilized_x_y_template) = (frame_height * frame_width, 1, 2)
-        # 元组中存入像素点对应索引[frame_width列 frame_height行] 从左上角像素点开始 从左至右 先列后行
-        # [[[0. 0.]]
-        #  [[1. 0.]]
-        #  ...
-        #  [[0. 1.]]
-        #  [[1. 1.]]
-        #  ...
-        #  [[0. 4.]]
-        #  ...
-        #  [[3. 4.]]]
-        frame_stabilized_x_y_template = frame_stabilized_y_x_to_stabilized_x_y_template.reshape((-1, 1, 2))
-
         # left_crop_x_by_frame_index[frame_index] contains the x-value where the left edge
         # where frame frame_index would be cropped to produce a rectangular image;
         # right_crop_x_by_frame_index, top_crop_y_by_frame_index, and
@@ -1810,149 +1832,10 @@ class MeshFlowStabilizer:
         with tqdm.trange(num_frames) as t:
             t.set_description('Warping frames')
             for frame_index in t:
-                unstabilized_frame = unstabilized_frames[frame_index]
-
-                # Construct map from the stabilized frame to the unstabilized frame.
-                # If (x_s, y_s) in the stabilized video is taken from (x_u, y_u) in the unstabilized
-                # video, then
-                # stabilized_y_x_to_unstabilized_x[y_s, x_s] = x_u,
-                # stabilized_y_x_to_unstabilized_y[y_s, x_s] = y_u, and
-                # frame_stabilized_y_x_to_stabilized_x_y[y_s, x_s] = [x_u, y_u].
-                # NOTE the inverted coordinate order. This setup allows us to index into map just like
-                # we index into the image. Each point [x_u, y_u] in the array is in OpenCV's expected
-                # order so we can easily apply homographies to those points.
-                # NOTE If a given coordinate's value is not changed by the subsequent steps, then that
-                # coordinate falls outside the stabilized image (so in the output image, that image
-                # should be filled with a border color).
-                # Since these arrays' default values fall outside the unstabilized image, remap will
-                # fill in those coordinates in the stabilized image with the border color as desired.
-                # np.full((frame_height, frame_width), frame_width + 1)
-                frame_stabilized_y_x_to_unstabilized_x = np.copy(frame_stabilized_y_x_to_unstabilized_x_template)
-                # np.full((frame_height, frame_width), frame_height + 1)
-                frame_stabilized_y_x_to_unstabilized_y = np.copy(frame_stabilized_y_x_to_unstabilized_y_template)
-                # 元组中存入像素点对应索引[frame_width列 frame_height行] 从左上角像素点开始 从左至右 先列后行
-                # shape(-1, 1, 2)
-                frame_stabilized_x_y = np.copy(frame_stabilized_x_y_template)
-
-                # Determine the coordinates of the mesh vertices in the stabilized video.
-                # The current displacements are given by vertex_unstabilized_displacements, and
-                # the desired displacements are given by vertex_stabilized_displacements,
-                # so adding the difference of the two transforms the frame as desired.
-                # 将顶点稳定前后运动向量的差值叠加到各顶点坐标上 得到稳定后的顶点坐标
-                # unstabilized_vertex_x_y ((self.mesh_row_count + 1)* (self.mesh_col_count + 1), 1, 2)
-                # stabilized_motion_mesh_by_frame_index (num_frames, self.mesh_row_count + 1 * self.mesh_col_count + 1, 1, 2)
-                stabilized_vertex_x_y = unstabilized_vertex_x_y + stabilized_motion_mesh_by_frame_index[frame_index]
-
-                # 重构数组结构
-                row_col_to_stabilized_vertex_x_y = np.reshape(
-                    stabilized_vertex_x_y, (self.mesh_row_count + 1, self.mesh_col_count + 1, 2))
-                # Look at each face of the mesh. Since we know the original and transformed coordinates
-                # of its four vertices, we can construct a homography to fill in the remaining pixels
-                # TODO parallelize
-                # 由稳定后的顶点坐标和稳定后的顶点坐标，计算单应性矩阵
-                for cell_top_left_row in range(self.mesh_row_count):
-                    for cell_top_left_col in range(self.mesh_col_count):
-
-                        # Construct a mask representing the stabilized cell.
-                        # Since we know the cell's boundaries before and after stabilization, we can
-                        # construct a homography representing this cell's warp and then apply it to
-                        # the unstabilized cell (which is just a rectangle) to construct the stabilized
-                        # cell.
-                        # top_left, top_right, bottom_left, bottom_right
-                        # unstabilized为原图像各网格顶点坐标 stabilized为叠加稳定向量后的各网格顶点坐标
-                        unstabilized_cell_bounds = row_col_to_unstabilized_vertex_x_y[
-                            cell_top_left_row:cell_top_left_row+2, cell_top_left_col:cell_top_left_col+2].reshape(-1, 2)
-                        stabilized_cell_bounds = row_col_to_stabilized_vertex_x_y[
-                            cell_top_left_row:cell_top_left_row+2, cell_top_left_col:cell_top_left_col+2].reshape(-1, 2)
-                        # 计算单应性矩阵
-                        unstabilized_to_stabilized_homography, _ = cv2.findHomography(
-                            unstabilized_cell_bounds, stabilized_cell_bounds)
-                        stabilized_to_unstabilized_homography, _ = cv2.findHomography(
-                            stabilized_cell_bounds, unstabilized_cell_bounds)
-
-                        # 行列互换 先列后行
-                        # [[ 80. 120.  80. 120.]    列变换 
-                        #  [ 30.  30.  60.  60.]]   行变化
-                        unstabilized_cell_x_bounds, unstabilized_cell_y_bounds = np.transpose(unstabilized_cell_bounds)
-                        # 向下取整
-                        unstabilized_cell_left_x = math.floor(np.min(unstabilized_cell_x_bounds))
-                        # 向上取整
-                        unstabilized_cell_right_x = math.ceil(np.max(unstabilized_cell_x_bounds))
-                        unstabilized_cell_top_y = math.floor(np.min(unstabilized_cell_y_bounds))
-                        unstabilized_cell_bottom_y = math.ceil(np.max(unstabilized_cell_y_bounds))
-                        # 设置掩膜 取原始图像(未稳定)中对应的某一网格
-                        unstabilized_cell_mask = np.zeros((frame_height, frame_width))
-                        unstabilized_cell_mask[unstabilized_cell_top_y:unstabilized_cell_bottom_y + 1,
-                                               unstabilized_cell_left_x:unstabilized_cell_right_x + 1] = 255
-                        #图像位置平移
-                        # transform_dist = [-50, 0]
-                        # transform_array = np.array([[1, 0, transform_dist[0]], [0, 1, transform_dist[1]], [0, 0, 1]])
-                        # dsize (x, y)
-                        stabilized_cell_mask = cv2.warpPerspective(
-                            unstabilized_cell_mask, unstabilized_to_stabilized_homography, (frame_width, frame_height))
-                        
-                        # 以下取全局变化
-                        # 以稳定后的图像为基准 通过逆单应变换获得稳定后图像与稳定前图像间各像素的对应关系
-                        # frame_stalizied_x_y中存储每个像素所在位置的索引 shape(-1, 1, 2)
-                        # shape(cell_unstabilized_x_y) = (frame_height * frame_width, 1, 2)
-                        cell_unstabilized_x_y = cv2.perspectiveTransform(frame_stabilized_x_y, stabilized_to_unstabilized_homography)
-                        # cell_unstabilized_x_y = frame_stabilized_x_y
-                        # shape(cell_stabilized_y_x_to_unstabilized_x_y) = (frame_height, frame_width, 2)
-                        cell_stabilized_y_x_to_unstabilized_x_y = cell_unstabilized_x_y.reshape((frame_height, frame_width, 2))
-                        # (2, frame_width, frame_height)
-                        cell_stabilized_y_x_to_unstabilized_x, cell_stabilized_y_x_to_unstabilized_y = np.moveaxis(
-                            cell_stabilized_y_x_to_unstabilized_x_y, 2, 0)
-
-                        # update the overall stabilized-to-unstabilized map, applying this cell's
-                        # transformation only to those pixels that are actually part of this cell、
-                        # 以下取局部 将掩膜内的部分转换为经逆单应矩阵变换后的点的坐标
-                        # frame_stabilized_y_x_to_unstabilized_x  np.full((frame_height, frame_width), frame_width + 1)
-                        # (frame_height, frame_width) 填充值为frame_width + 1/frame_height + 1
-                        # 向各网格在稳定图像中所对应的区域内存入各像素点对应未稳定图像像素的索引
-                        frame_stabilized_y_x_to_unstabilized_x = np.where(
-                            stabilized_cell_mask, cell_stabilized_y_x_to_unstabilized_x, frame_stabilized_y_x_to_unstabilized_x)
-                        frame_stabilized_y_x_to_unstabilized_y = np.where(
-                            stabilized_cell_mask, cell_stabilized_y_x_to_unstabilized_y, frame_stabilized_y_x_to_unstabilized_y)
-                
-                # cv2.remap(img,map1,map2,interpolation) img源图像 map1表示CV_32FC2类型(x,y)点的x map2表示y
-                stabilized_frame = cv2.remap(
-                    unstabilized_frame,
-                    frame_stabilized_y_x_to_unstabilized_x.reshape((frame_height, frame_width, 1)).astype(np.float32),
-                    frame_stabilized_y_x_to_unstabilized_y.reshape((frame_height, frame_width, 1)).astype(np.float32),
-                    cv2.INTER_LINEAR,
-                    borderValue=self.color_outside_image_area_bgr
-                )
-
-                # crop the frame
-                # left edge: the maximum stabilized x_s that corresponds to the unstabilized x_u = 0
-                # np.abs返回每个元素的绝对值
-                # np.where 返回符合条件的元素的索引 [0]为所在行数 [1]为所在列数
-                # 即取稳定后图像的最大内接矩
-                stabilized_image_x_matching_unstabilized_left_edge = np.where(
-                    np.abs(frame_stabilized_y_x_to_unstabilized_x - 0) < 1)[1]
-                if stabilized_image_x_matching_unstabilized_left_edge.size > 0:
-                    left_crop_x_by_frame_index[frame_index] = np.max(stabilized_image_x_matching_unstabilized_left_edge)
-
-                # right edge: the minimum stabilized x_s that corresponds to the stabilized
-                # x_u = frame_width - 1
-                stabilized_image_x_matching_unstabilized_right_edge = np.where(
-                    np.abs(frame_stabilized_y_x_to_unstabilized_x - (frame_width - 1)) < 1)[1]
-                if stabilized_image_x_matching_unstabilized_right_edge.size > 0:
-                    right_crop_x_by_frame_index[frame_index] = np.min(stabilized_image_x_matching_unstabilized_right_edge)
-
-                # top edge: the maximum stabilized y_s that corresponds to the unstabilized
-                # y_u = 01
-                stabilized_image_y_matching_unstabilized_top_edge = np.where(
-                    np.abs(frame_stabilized_y_x_to_unstabilized_y - 0) < 1)[0]
-                if stabilized_image_y_matching_unstabilized_top_edge.size > 0:
-                    top_crop_y_by_frame_index[frame_index] = np.max(stabilized_image_y_matching_unstabilized_top_edge)
-
-                # bottom edge: the minimum stabilized y_s that corresponds to the unstabilized
-                # y_u = frame_height - 1
-                stabilized_image_y_matching_unstabilized_bottom_edge = np.where(
-                    np.abs(frame_stabilized_y_x_to_unstabilized_y - (frame_height - 1)) < 1)[0]
-                if stabilized_image_y_matching_unstabilized_bottom_edge.size > 0:
-                    bottom_crop_y_by_frame_index[frame_index] = np.min(stabilized_image_y_matching_unstabilized_bottom_edge)
+                stabilized_frame, frame_crop_boundaries = self._get_stabilized_frame_and_crop_boundaries(
+                    unstabilized_frames[frame_index], stabilized_motion_mesh_by_frame_index[frame_index])
+                (left_crop_x_by_frame_index[frame_index], top_crop_y_by_frame_index[frame_index],
+                 right_crop_x_by_frame_index[frame_index], bottom_crop_y_by_frame_index[frame_index]) = frame_crop_boundaries
 
                 stabilized_frames.append(stabilized_frame)
 
@@ -1966,6 +1849,138 @@ class MeshFlowStabilizer:
         return (stabilized_frames, (left_crop_x, top_crop_y, right_crop_x, bottom_crop_y))
 
 
+    ##  单帧网格变形 供_get_stabilized_frames_and_crop_boundaries与在线稳定调用  ##
+    def _get_stabilized_frame_and_crop_boundaries(self, unstabilized_frame, stabilized_motion_mesh):
+        '''
+        Helper method for _get_stabilized_frames_and_crop_boundaries and OnlineMeshFlowStabilizer.
+
+        Warp a single unstabilized frame according to its stabilized motion mesh and return the
+        boundaries that would crop the result to a rectangle.
+
+        Input:
+
+        * unstabilized_frame: A NumPy array representing the unstabilized frame.
+        * stabilized_motion_mesh: A NumPy array of shape
+            ((self.mesh_row_count + 1) * (self.mesh_col_count + 1), 1, 2)
+            containing the amount to add to each vertex coordinate to transform it from its
+            unstabilized position to its stabilized position.
+
+        Output:
+
+        A tuple of the following items in order.
+
+        * stabilized_frame: A NumPy array representing the stabilized frame.
+        * crop_boundaries: A tuple of the form
+            (left_crop_x, top_crop_y, right_crop_x, bottom_crop_y)
+            representing the x- and y-boundaries (all inclusive) of this frame's crop.
+        '''
+
+        frame_height, frame_width = unstabilized_frame.shape[:2]
+
+        # unstabilized_vertex_x_y and stabilized_vertex_x_y are CV_32FC2 NumPy arrays
+        # (see https://stackoverflow.com/a/47617999)
+        # of the coordinates of the mesh nodes in the stabilized video, indexed from the top left
+        # corner and moving left-to-right, top-to-bottom.
+        # 例 [[[ 0., 0.]]
+        #     [[40., 0.]]
+        #     ...
+        #     [[ 0., 40.]]
+        #     [[40., 40.]]
+        #     ...
+        #     [[600., 479.]]
+        #     [[639., 479.]]]
+        unstabilized_vertex_x_y = self._get_vertex_x_y(frame_width, frame_height)
+
+        # row_col_to_unstabilized_vertex_x_y[row, col] and
+        # row_col_to_stabilized_vertex_x_y[row, col]
+        # contain the x and y positions of the vertex at the given row and col
+        # 原格式 ((self.mesh_row_count + 1)* (self.mesh_col_count + 1), 1, 2)
+        # [[[  0.   0.]
+        #   [ 40.   0.]]
+        #    ...
+        #   [639.   0.]]
+        #
+        #  [[  0.  60.]
+        #   [ 40.  60.]
+        #    ...
+        #   [639.  60.]]
+        #    ...
+        #  [[  0. 479.]
+        #   [ 40. 479.]
+        #    ...
+        #   [639. 479.]]]
+        row_col_to_unstabilized_vertex_x_y = np.reshape(
+            unstabilized_vertex_x_y, (self.mesh_row_count + 1, self.mesh_col_count + 1, 2))
+
+        # Determine the coordinates of the mesh vertices in the stabilized video.
+        # The current displacements are given by vertex_unstabilized_displacements, and
+        # the desired displacements are given by vertex_stabilized_displacements,
+        # so adding the difference of the two transforms the frame as desired.
+        # 将顶点稳定前后运动向量的差值叠加到各顶点坐标上 得到稳定后的顶点坐标
+        # unstabilized_vertex_x_y ((self.mesh_row_count + 1)* (self.mesh_col_count + 1), 1, 2)
+        # stabilized_motion_mesh (self.mesh_row_count + 1 * self.mesh_col_count + 1, 1, 2)
+        stabilized_vertex_x_y = unstabilized_vertex_x_y + stabilized_motion_mesh
+
+        # 重构数组结构
+        row_col_to_stabilized_vertex_x_y = np.reshape(
+            stabilized_vertex_x_y, (self.mesh_row_count + 1, self.mesh_col_count + 1, 2))
+        # Look at each face of the mesh. Since we know the original and transformed coordinates
+        # of its four vertices, we can construct a homography to fill in the remaining pixels.
+        # 各网格只在其变形后的包围盒内计算 见mesh_warp.get_mesh_warp_maps
+        # NOTE If a given coordinate's value is not changed by the mesh, then that coordinate falls
+        # outside the stabilized image; its default value (frame_width + 1, frame_height + 1) makes
+        # remap fill it with the border color.
+        frame_stabilized_y_x_to_unstabilized_x, frame_stabilized_y_x_to_unstabilized_y = mesh_warp.get_mesh_warp_maps(
+            frame_width, frame_height, row_col_to_unstabilized_vertex_x_y, row_col_to_stabilized_vertex_x_y)
+
+        # cv2.remap(img,map1,map2,interpolation) img源图像 map1表示CV_32FC2类型(x,y)点的x map2表示y
+        stabilized_frame = cv2.remap(
+            unstabilized_frame,
+            frame_stabilized_y_x_to_unstabilized_x,
+            frame_stabilized_y_x_to_unstabilized_y,
+            cv2.INTER_LINEAR,
+            borderValue=self.color_outside_image_area_bgr
+        )
+
+        left_crop_x = 0
+        right_crop_x = frame_width - 1
+        top_crop_y = 0
+        bottom_crop_y = frame_height - 1
+
+        # crop the frame
+        # left edge: the maximum stabilized x_s that corresponds to the unstabilized x_u = 0
+        # np.abs返回每个元素的绝对值
+        # np.where 返回符合条件的元素的索引 [0]为所在行数 [1]为所在列数
+        # 即取稳定后图像的最大内接矩
+        stabilized_image_x_matching_unstabilized_left_edge = np.where(
+            np.abs(frame_stabilized_y_x_to_unstabilized_x - 0) < 1)[1]
+        if stabilized_image_x_matching_unstabilized_left_edge.size > 0:
+            left_crop_x = np.max(stabilized_image_x_matching_unstabilized_left_edge)
+
+        # right edge: the minimum stabilized x_s that corresponds to the stabilized
+        # x_u = frame_width - 1
+        stabilized_image_x_matching_unstabilized_right_edge = np.where(
+            np.abs(frame_stabilized_y_x_to_unstabilized_x - (frame_width - 1)) < 1)[1]
+        if stabilized_image_x_matching_unstabilized_right_edge.size > 0:
+            right_crop_x = np.min(stabilized_image_x_matching_unstabilized_right_edge)
+
+        # top edge: the maximum stabilized y_s that corresponds to the unstabilized
+        # y_u = 01
+        stabilized_image_y_matching_unstabilized_top_edge = np.where(
+            np.abs(frame_stabilized_y_x_to_unstabilized_y - 0) < 1)[0]
+        if stabilized_image_y_matching_unstabilized_top_edge.size > 0:
+            top_crop_y = np.max(stabilized_image_y_matching_unstabilized_top_edge)
+
+        # bottom edge: the minimum stabilized y_s that corresponds to the unstabilized
+        # y_u = frame_height - 1
+        stabilized_image_y_matching_unstabilized_bottom_edge = np.where(
+            np.abs(frame_stabilized_y_x_to_unstabilized_y - (frame_height - 1)) < 1)[0]
+        if stabilized_image_y_matching_unstabilized_bottom_edge.size > 0:
+            bottom_crop_y = np.min(stabilized_image_y_matching_unstabilized_bottom_edge)
+
+        return (stabilized_frame, (left_crop_x, top_crop_y, right_crop_x, bottom_crop_y))
+
+
     ##  裁切稳定后的图像 在保持长宽比的前提下使之充满图窗  ##
     def _crop_frames(self, uncropped_frames, crop_boundaries):
         '''
@@ -2194,6 +2209,398 @@ class MeshFlowStabilizer:
 
 
 
+##  在线(流式)稳定 逐帧输入 仅保留时域窗口内的图像与顶点轨迹  ##
+class OnlineMeshFlowStabilizer:
+    '''
+    Streaming counterpart of MeshFlowStabilizer.stabilize.
+
+    Frames are pushed one at a time. Each frame is emitted lookahead frames after it arrives, so
+    latency is a fixed number of frames. Only the frames that have not been emitted yet and the
+    vertex profiles of a window of about temporal_smoothing_radius + lookahead frames are kept,
+    so memory does not grow with the length of the recording.
+
+    On every emitted frame the energy function of MeshFlowStabilizer is minimized over the window
+    with the Jacobi method, warm-started from the previous window's solution. The last
+    temporal_smoothing_radius emitted frames stay in the window as fixed boundary values, so the
+    emitted path is never revised.
+    '''
+
+    def __init__(self, stabilizer, lookahead=None,
+                 adaptive_weights_definition=MeshFlowStabilizer.ADAPTIVE_WEIGHTS_DEFINITION_ORIGINAL,
+                 optimization_num_iterations=None):
+        '''
+        Constructor.
+
+        Input:
+
+        * stabilizer: A MeshFlowStabilizer whose parameters (mesh size, temporal smoothing radius,
+            border color) are used.
+        * lookahead: The number of frames to wait for before a frame is emitted. Defaults to
+            stabilizer.temporal_smoothing_radius.
+        * adaptive_weights_definition: Which method to use for computing the energy function's
+            adaptive weights.
+        * optimization_num_iterations: The number of Jacobi iterations to run per emitted frame.
+            Defaults to stabilizer.optimization_num_iterations. Because every window starts from
+            the previous solution, far fewer iterations than the offline solve are usually enough.
+
+        Output:
+
+        (An OnlineMeshFlowStabilizer object.)
+        '''
+
+        if not (adaptive_weights_definition == MeshFlowStabilizer.ADAPTIVE_WEIGHTS_DEFINITION_ORIGINAL or
+                adaptive_weights_definition == MeshFlowStabilizer.ADAPTIVE_WEIGHTS_DEFINITION_FLIPPED or
+                adaptive_weights_definition == MeshFlowStabilizer.ADAPTIVE_WEIGHTS_DEFINITION_CONSTANT_HIGH or
+                adaptive_weights_definition == MeshFlowStabilizer.ADAPTIVE_WEIGHTS_DEFINITION_CONSTANT_LOW):
+            raise ValueError('Invalid value for `adaptive_weights_definition`.')
+
+        self.stabilizer = stabilizer
+        self.lookahead = stabilizer.temporal_smoothing_radius if lookahead is None else lookahead
+        if self.lookahead < 0:
+            raise ValueError('`lookahead` must be non-negative.')
+        self.adaptive_weights_definition = adaptive_weights_definition
+        self.optimization_num_iterations = (stabilizer.optimization_num_iterations
+                                            if optimization_num_iterations is None else optimization_num_iterations)
+
+        # 尚未输出的图像
+        self.pending_frames = deque()
+        self.previous_frame = None
+        # 窗口内(已输出的边界帧 + 尚未输出的帧)的未稳定/稳定顶点位移与帧间单应矩阵
+        self.vertex_unstabilized_displacements = deque()
+        self.vertex_stabilized_displacements = deque()
+        self.homographies = deque()
+        self.num_emitted_frames = 0
+
+
+    def push_frame(self, frame):
+        '''
+        Add the next frame of the video.
+
+        Input:
+
+        * frame: A NumPy array representing the next unstabilized frame.
+
+        Output:
+
+        * emitted: A list of (frame_index, stabilized_frame, crop_boundaries) tuples for the frames
+            that became ready, as described in _emit_frame. It holds at most one entry.
+        '''
+
+        if self.previous_frame is None:
+            vertex_unstabilized_displacements = np.zeros(
+                (self.stabilizer.mesh_row_count + 1, self.stabilizer.mesh_col_count + 1, 2))
+            vertex_stabilized_displacements = vertex_unstabilized_displacements.copy()
+        else:
+            velocity, homography = self.stabilizer._get_unstabilized_vertex_velocities(self.previous_frame, frame)
+            vertex_unstabilized_displacements = self.vertex_unstabilized_displacements[-1] + velocity
+            # 新帧的初值沿用上一帧的稳定修正量
+            vertex_stabilized_displacements = vertex_unstabilized_displacements + (
+                self.vertex_stabilized_displacements[-1] - self.vertex_unstabilized_displacements[-1])
+            self.homographies[-1] = homography
+
+        # 窗口最后一帧之后没有单应矩阵 与离线版本相同取单位阵
+        self.homographies.append(np.identity(3))
+        self.vertex_unstabilized_displacements.append(vertex_unstabilized_displacements)
+        self.vertex_stabilized_displacements.append(vertex_stabilized_displacements)
+        self.pending_frames.append(frame)
+        self.previous_frame = frame
+
+        if len(self.pending_frames) > self.lookahead:
+            return [self._emit_frame()]
+        return []
+
+
+    def flush(self):
+        '''
+        Emit every frame still waiting for its lookahead, at the end of the video.
+
+        Output:
+
+        * emitted: A list of (frame_index, stabilized_frame, crop_boundaries) tuples as described
+            in _emit_frame.
+        '''
+
+        emitted = []
+        while self.pending_frames:
+            emitted.append(self._emit_frame())
+        return emitted
+
+
+    def _emit_frame(self):
+        '''
+        Helper method for push_frame and flush.
+
+        Re-solve the window, then warp and remove the oldest pending frame.
+
+        Output:
+
+        A tuple of the following items in order.
+
+        * frame_index: The index of the emitted frame in the video.
+        * stabilized_frame: A NumPy array representing the (uncropped) stabilized frame.
+        * crop_boundaries: The crop boundaries of this frame alone, as returned by
+            MeshFlowStabilizer._get_stabilized_frame_and_crop_boundaries. A video-wide crop needs
+            every frame, so it is left to the caller.
+        '''
+
+        self._solve_window()
+
+        num_boundary_frames = len(self.vertex_unstabilized_displacements) - len(self.pending_frames)
+        stabilized_motion_mesh = np.reshape(
+            self.vertex_stabilized_displacements[num_boundary_frames] - self.vertex_unstabilized_displacements[num_boundary_frames],
+            (-1, 1, 2)
+        )
+        stabilized_frame, crop_boundaries = self.stabilizer._get_stabilized_frame_and_crop_boundaries(
+            self.pending_frames.popleft(), stabilized_motion_mesh)
+
+        frame_index = self.num_emitted_frames
+        self.num_emitted_frames += 1
+
+        # 只保留temporal_smoothing_radius个已输出的帧作为边界
+        while len(self.vertex_unstabilized_displacements) - len(self.pending_frames) > self.stabilizer.temporal_smoothing_radius:
+            self.vertex_unstabilized_displacements.popleft()
+            self.vertex_stabilized_displacements.popleft()
+            self.homographies.popleft()
+
+        return (frame_index, stabilized_frame, crop_boundaries)
+
+
+    def _solve_window(self):
+        '''
+        Helper method for _emit_frame.
+
+        Minimize the energy function over the current window with the Jacobi method (see
+        MeshFlowStabilizer._get_jacobi_method_output), starting from the previous window's
+        solution and keeping the already emitted frames fixed.
+        '''
+
+        num_window_frames = len(self.vertex_unstabilized_displacements)
+        num_boundary_frames = num_window_frames - len(self.pending_frames)
+        frame_height, frame_width = self.pending_frames[0].shape[:2]
+
+        adaptive_weights = self.stabilizer._get_adaptive_weights(
+            num_window_frames, frame_width, frame_height, self.adaptive_weights_definition, np.array(self.homographies))
+        off_diagonal_coefficients, on_diagonal_coefficients = self.stabilizer._get_smoothing_coefficients(
+            num_window_frames, adaptive_weights)
+
+        b = np.array(self.vertex_unstabilized_displacements)
+        x = np.array(self.vertex_stabilized_displacements)
+        boundary = x[:num_boundary_frames].copy()
+        reciprocal_on_diagonal_coefficients = np.reciprocal(on_diagonal_coefficients).reshape((-1, 1, 1, 1))
+
+        # x^(k+1) = D^(-1) * (b - (L + U) * x^(k)) 已输出的帧保持不变
+        for _ in range(self.optimization_num_iterations):
+            x = reciprocal_on_diagonal_coefficients * (b - path_solver.banded_matmul(off_diagonal_coefficients, x))
+            x[:num_boundary_frames] = boundary
+
+        self.vertex_stabilized_displacements = deque(x)
+
+
+
+class OnlineStitchFieldPredictor:
+    '''
+    Streaming estimate of the left and right stitch vertex fields with a per-vertex
+    constant-velocity Kalman filter.
+
+    Every component of every vertex of the (mesh_row_count + 1, mesh_col_count + 1, 2) left and
+    right fields has a [displacement, velocity] state. Each pushed frame pair is first predicted
+    from the previous state; the frames are matched (see
+    MeshFlowStabilizer.get_matched_features_and_homography_for_stitch) only when the predicted
+    displacement variance exceeds stabilizer.stitch_kalman_max_predicted_variance, and the
+    measured fields are then fused into the prediction. All vertices share the same motion model
+    and are measured together, so they share one 2x2 covariance and the gate is a single scalar.
+
+    The process noise is scaled by the normalized innovation of the last measurement, so a field
+    that moves faster than the model expects is matched more often.
+    '''
+
+    def __init__(self, stabilizer):
+        '''
+        Constructor.
+
+        Input:
+
+        * stabilizer: A MeshFlowStabilizer whose mesh size, stitch matching and
+            stitch_kalman_* parameters are used.
+
+        Output:
+
+        (An OnlineStitchFieldPredictor object.)
+        '''
+
+        self.stabilizer = stabilizer
+        self.process_noise = stabilizer.stitch_kalman_process_noise
+        self.measurement_noise = stabilizer.stitch_kalman_measurement_noise
+        self.max_predicted_variance = stabilizer.stitch_kalman_max_predicted_variance
+
+        # 状态 [左/右, 行, 列, x/y] 的位移与速度 所有顶点共用一个2x2协方差
+        field_shape = (2, stabilizer.mesh_row_count + 1, stabilizer.mesh_col_count + 1, 2)
+        self.displacements = np.zeros(field_shape)
+        self.velocities = np.zeros(field_shape)
+        self.covariance = None
+        self.process_noise_scale = 1.0
+        # 最近一次匹配得到的左右图像到中间图的全局H
+        self.homographies = np.tile(np.identity(3), (2, 1, 1))
+
+
+    def push_frame(self, left_frame, right_frame):
+        '''
+        Estimate the stitch fields of the next frame pair.
+
+        Input:
+
+        * left_frame: The next left (tractor) frame.
+        * right_frame: The next right (trailer) frame.
+
+        Output:
+
+        A tuple of the following items in order.
+
+        * left_velocity: The left stitch field, of shape (mesh_row_count + 1, mesh_col_count + 1, 2).
+        * right_velocity: The right stitch field.
+        * matched: Whether the frame pair was matched.
+        '''
+
+        if self.covariance is not None:
+            self._predict()
+
+        matched = False
+        if self.covariance is None or self.covariance[0, 0] > self.max_predicted_variance:
+            matches = self.stabilizer.get_matched_features_and_homography_for_stitch(left_frame, right_frame)
+            # 特征点不足时不融合 继续使用预测值
+            if len(matches) == 5 and matches[3] is not None and matches[4] is not None:
+                self._update(np.array(self.stabilizer._get_stitch_velocities(left_frame, matches)))
+                self.homographies = np.array(matches[3:5])
+                matched = True
+
+        return (self.displacements[0].copy(), self.displacements[1].copy(), matched)
+
+
+    def _predict(self):
+        '''
+        Helper method for push_frame.
+
+        Constant-velocity prediction x = F x, P = F P F^T + Q with
+        F = [[1, 1], [0, 1]] and the discrete white-noise acceleration Q.
+        '''
+
+        self.displacements = self.displacements + self.velocities
+
+        transition = np.array([[1.0, 1.0], [0.0, 1.0]])
+        process_covariance = self.process_noise * self.process_noise_scale * np.array([[0.25, 0.5], [0.5, 1.0]])
+        self.covariance = transition @ self.covariance @ transition.T + process_covariance
+
+
+    def _update(self, measured_fields):
+        '''
+        Helper method for push_frame.
+
+        Fuse measured_fields, an array of shape (2, mesh_row_count + 1, mesh_col_count + 1, 2)
+        holding the matched left and right stitch fields, into the state. The first measurement
+        initializes the state.
+        '''
+
+        if self.covariance is None:
+            self.displacements = measured_fields.astype(np.float64)
+            self.velocities = np.zeros_like(self.displacements)
+            self.covariance = np.diag([self.measurement_noise, self.measurement_noise])
+            return
+
+        innovations = measured_fields - self.displacements
+        innovation_variance = self.covariance[0, 0] + self.measurement_noise
+        # K = P H^T / S, H = [1, 0]
+        kalman_gain = self.covariance[:, 0] / innovation_variance
+
+        self.displacements = self.displacements + kalman_gain[0] * innovations
+        self.velocities = self.velocities + kalman_gain[1] * innovations
+        self.covariance = self.covariance - np.outer(kalman_gain, self.covariance[0])
+
+        # 新息超出模型预期时放大过程噪声 之后更早触发匹配
+        self.process_noise_scale = max(1.0, float(np.mean(np.square(innovations))) / innovation_variance)
+
+
+
+##  多进程估计相邻帧间顶点运动 连续若干帧作为一个任务传给进程 最后按帧顺序做前缀和  ##
+def get_unstabilized_vertex_displacements_and_homographies_with_multiprocessing(stabilizer, num_frames, unstabilized_frames, processes=None, pairs_per_task=8):
+    '''
+    Helper method for MeshFlowStabilizer._get_unstabilized_vertex_displacements_and_homographies.
+
+    Estimate the vertex velocities and homography of every (current_frame, next_frame) pair in a
+    worker pool. Each task carries pairs_per_task + 1 consecutive frames, so every frame is sent
+    to the workers about once and only the frames of the tasks in flight are held besides
+    unstabilized_frames. The workers receive only the motion estimation parameters of
+    stabilizer (see _get_motion_estimation_parameters), not its matcher or match cache, so the
+    pool starts under both fork and spawn. Results are gathered by frame index and the only
+    sequential step, the cumulative sum of the velocities, is done at the end.
+
+    Input:
+
+    * stabilizer: The MeshFlowStabilizer whose _get_unstabilized_vertex_velocities is run.
+    * num_frames: The number of frames in the video.
+    * unstabilized_frames: A list of the unstabilized frames, each represented as a NumPy array.
+    * processes: The number of worker processes. Defaults to stabilizer.multicore.
+    * pairs_per_task: The number of frame pairs per task.
+
+    Output:
+
+    The same tuple as _get_unstabilized_vertex_displacements_and_homographies.
+    '''
+
+    processes = stabilizer.multicore if processes is None else processes
+
+    vertex_velocities_by_frame_index = np.empty((num_frames - 1, stabilizer.mesh_row_count + 1, stabilizer.mesh_col_count + 1, 2))
+    homographies = np.empty((num_frames, 3, 3))
+    homographies[-1] = np.identity(3)
+
+    # 任务按需生成 进程池只在空闲时取用 图像不会全部同时进入进程间队列
+    tasks = ((start_index, unstabilized_frames[start_index:min(start_index + pairs_per_task, num_frames - 1) + 1])
+             for start_index in range(0, num_frames - 1, pairs_per_task))
+    with mp.Pool(processes=processes, initializer=_init_motion_estimation_worker,
+                 initargs=(_get_motion_estimation_parameters(stabilizer),)) as pool:
+        with tqdm.tqdm(total=num_frames - 1) as t:
+            t.set_description(f'Computing unstabilized mesh displacements ({processes} processes)')
+            for task_results in pool.imap_unordered(_motion_estimation_job, tasks):
+                for current_index, current_velocity, homography in task_results:
+                    vertex_velocities_by_frame_index[current_index] = current_velocity
+                    homographies[current_index] = homography
+                t.update(len(task_results))
+
+    # 前缀和 第一帧置0
+    vertex_unstabilized_displacements_by_frame_index = np.empty((num_frames, stabilizer.mesh_row_count + 1, stabilizer.mesh_col_count + 1, 2))
+    vertex_unstabilized_displacements_by_frame_index[0].fill(0)
+    np.cumsum(vertex_velocities_by_frame_index, axis=0, out=vertex_unstabilized_displacements_by_frame_index[1:])
+
+    return (vertex_unstabilized_displacements_by_frame_index, homographies)
+
+# _get_unstabilized_vertex_velocities只用到网格 特征与离群点剔除的参数 匹配器与匹配缓存无法也无需传给进程
+def _get_motion_estimation_parameters(stabilizer):
+    return {
+        'mesh_row_count': stabilizer.mesh_row_count,
+        'mesh_col_count': stabilizer.mesh_col_count,
+        'mesh_outlier_subframe_row_count': stabilizer.mesh_outlier_subframe_row_count,
+        'mesh_outlier_subframe_col_count': stabilizer.mesh_outlier_subframe_col_count,
+        'feature_ellipse_row_count': stabilizer.feature_ellipse_row_count,
+        'feature_ellipse_col_count': stabilizer.feature_ellipse_col_count,
+        'homography_min_number_corresponding_features': stabilizer.homography_min_number_corresponding_features,
+    }
+
+_motion_estimation_worker_state = {}
+
+def _init_motion_estimation_worker(motion_estimation_parameters):
+    # 进程内按参数重建只用于运动估计的稳定器; OpenCV单线程 避免与进程池争抢CPU
+    cv2.setNumThreads(1)
+    _motion_estimation_worker_state['stabilizer'] = MeshFlowStabilizer(multicore=1, **motion_estimation_parameters)
+
+def _motion_estimation_job(task):
+    start_index, frames = task
+    stabilizer = _motion_estimation_worker_state['stabilizer']
+    task_results = []
+    for offset in range(len(frames) - 1):
+        current_velocity, homography = stabilizer._get_unstabilized_vertex_velocities(frames[offset], frames[offset + 1])
+        task_results.append((start_index + offset, current_velocity, homography))
+    return task_results
+
+
 ##  调用多进程 根据四个顶点稳定前后的运动向量之差计算单应矩阵并进行网格变形  ##
 def get_stabilized_frames_and_crop_boundaries_with_multiprocessing(pos, num_frames, unstabilized_frames, vertex_for_stitch, vertex_unstabilized_displacements_by_frame_index, vertex_stabilized_displacements_by_frame_index):
     '''
@@ -2300,62 +2707,15 @@ def multiprocessing_job_for_warp(pos, unstabilized_frames, stabilized_motion_mes
     row_col_to_unstabilized_vertex_x_y = np.reshape(
         unstabilized_vertex_x_y, (mesh_row_count + 1, mesh_col_count + 1, 2))
 
-    # Construct map from the stabilized frame to the unstabilized frame.
-    # If (x_s, y_s) in the stabilized video is taken from (x_u, y_u) in the unstabilized video, then
-    # stabilized_y_x_to_unstabilized_x[y_s, x_s] = x_u,
-    # stabilized_y_x_to_unstabilized_y[y_s, x_s] = y_u, and
-    # frame_stabilized_y_x_to_stabilized_x_y[y_s, x_s] = [x_u, y_u].
-    # NOTE the inverted coordinate order. This setup allows us to index into map just like
-    # we index into the image. Each point [x_u, y_u] in the array is in OpenCV's expected
-    # order so we can easily apply homographies to those points.
-    # NOTE If a given coordinate's value is not changed by the subsequent steps, then that
-    # coordinate falls outside the stabilized image (so in the output image, that image
-    # should be filled with a border color).
-    # Since these arrays' default values fall outside the unstabilized image, remap will
-    # fill in those coordinates in the stabilized image with the border color as desired.
-    # 数组形状 (frame_height, frame_width) 填充值为frame_width + 1/frame_height + 1
-    frame_stabilized_y_x_to_unstabilized_x_template = np.full((frame_height, frame_width), frame_width + 1)
-    frame_stabilized_y_x_to_unstabilized_y_template = np.full((frame_height, frame_width), frame_height + 1)
-    
-    # shape(frame_stabilized_y_x_to_stabilized_x_y_template) = (frame_height, frame_width, 2)
-    # shape(frame_stabilized_x_y_template) = (frame_height * frame_width, 1, 2)
-    # 元组中存入像素点对应索引[frame_width列 frame_height行] 从左上角像素点开始 从左至右 先列后行
-    frame_stabilized_x_y_template = np.swapaxes(
-        np.indices((frame_width, frame_height), dtype=np.float32), 0, 2).reshape((-1, 1, 2))
-
     stabilized_frames = []
 
     x_displacement = O
     if pos > 0:
         x_displacement = -x_displacement
-    transform_dist = [x_displacement, 0]
-    transform_array = np.array([[1, 0, transform_dist[0]], [0, 1, transform_dist[1]], [0, 0, 1]])
-    transform_array1 = np.array([[1, 0, -transform_dist[0]], [0, 1, -transform_dist[1]], [0, 0, 1]])
 
     for frame_index in range(num_frames):
         unstabilized_frame = unstabilized_frames_in_snipped[frame_index]
 
-        # Construct map from the stabilized frame to the unstabilized frame.
-        # If (x_s, y_s) in the stabilized video is taken from (x_u, y_u) in the unstabilized video, then
-        # stabilized_y_x_to_unstabilized_x[y_s, x_s] = x_u,
-        # stabilized_y_x_to_unstabilized_y[y_s, x_s] = y_u, and
-        # frame_stabilized_y_x_to_stabilized_x_y[y_s, x_s] = [x_u, y_u].
-        # NOTE the inverted coordinate order. This setup allows us to index into map just like
-        # we index into the image. Each point [x_u, y_u] in the array is in OpenCV's expected
-        # order so we can easily apply homographies to those points.
-        # NOTE If a given coordinate's value is not changed by the subsequent steps, then that
-        # coordinate falls outside the stabilized image (so in the output image, that image
-        # should be filled with a border color).
-        # Since these arrays' default values fall outside the unstabilized image, remap will
-        # fill in those coordinates in the stabilized image with the border color as desired.
-        # np.full((frame_height, frame_width), frame_width + 1)
-        frame_stabilized_y_x_to_unstabilized_x = np.copy(frame_stabilized_y_x_to_unstabilized_x_template)
-        # np.full((frame_height, frame_width), frame_height + 1)
-        frame_stabilized_y_x_to_unstabilized_y = np.copy(frame_stabilized_y_x_to_unstabilized_y_template)
-        # 元组中存入像素点对应索引[frame_width列 frame_height行] 从左上角像素点开始 从左至右 先列后行
-        # shape(-1, 1, 2)
-        frame_stabilized_x_y = np.copy(frame_stabilized_x_y_template)
-
         # Determine the coordinates of the mesh vertices in the stabilized video.
         # The current displacements are given by vertex_unstabilized_displacements, and
         # the desired displacements are given by vertex_stabilized_displacements,
@@ -2369,70 +2729,17 @@ def multiprocessing_job_for_warp(pos, unstabilized_frames, stabilized_motion_mes
             stabilized_vertex_x_y, (mesh_row_count + 1, mesh_col_count + 1, 2))
 
         # Look at each face of the mesh. Since we know the original and transformed coordinates
-        # of its four vertices, we can construct a homography to fill in the remaining pixels
-        # TODO parallelize
-        # 由稳定后的顶点坐标和稳定后的顶点坐标，计算单应性矩阵
-        for cell_top_left_row in range(mesh_row_count):
-            for cell_top_left_col in range(mesh_col_count):
-
-                # Construct a mask representing the stabilized cell.
-                # Since we know the cell's boundaries before and after stabilization, we can
-                # construct a homography representing this cell's warp and then apply it to the 
-                # unstabilized cell (which is just a rectangle) to construct the stabilized cell.
-                # top_left, top_right, bottom_left, bottom_right
-                # unstabilized为原图像各网格顶点坐标 stabilized为叠加稳定向量后的各网格顶点坐标
-                unstabilized_cell_bounds = row_col_to_unstabilized_vertex_x_y[
-                    cell_top_left_row:cell_top_left_row+2, cell_top_left_col:cell_top_left_col+2].reshape(-1, 2)
-                stabilized_cell_bounds = row_col_to_stabilized_vertex_x_y[
-                    cell_top_left_row:cell_top_left_row+2, cell_top_left_col:cell_top_left_col+2].reshape(-1, 2)
-
-                unstabilized_to_stabilized_homography, _ = cv2.findHomography(
-                    unstabilized_cell_bounds, stabilized_cell_bounds)
-                stabilized_to_unstabilized_homography, _ = cv2.findHomography(
-                    stabilized_cell_bounds, unstabilized_cell_bounds)
-
-                # 行列互换 先列后行
-                unstabilized_cell_x_bounds, unstabilized_cell_y_bounds = np.transpose(unstabilized_cell_bounds)
-                # 向下取整
-                unstabilized_cell_left_x = math.floor(np.min(unstabilized_cell_x_bounds))
-                # 向上取整
-                unstabilized_cell_right_x = math.ceil(np.max(unstabilized_cell_x_bounds))
-                unstabilized_cell_top_y = math.floor(np.min(unstabilized_cell_y_bounds))
-                unstabilized_cell_bottom_y = math.ceil(np.max(unstabilized_cell_y_bounds))
-                # 设置掩膜 取原始图像(未稳定)中对应的某一网格
-                unstabilized_cell_mask = np.zeros((frame_height, frame_width))
-                unstabilized_cell_mask[unstabilized_cell_top_y:unstabilized_cell_bottom_y + 1,
-                                        unstabilized_cell_left_x:unstabilized_cell_right_x + 1] = 255
-                # dsize (x, y)
-                stabilized_cell_mask = cv2.warpPerspective(
-                    unstabilized_cell_mask, transform_array.dot(unstabilized_to_stabilized_homography), (frame_width, frame_height))
-                
-                # 以下取全局变化
-                # 以稳定后的图像为基准 通过逆单应变换获得稳定后图像与稳定前图像间各像素的对应关系
-                # frame_stalizied_x_y中存储每个像素所在位置的索引 shape(-1, 1, 2)
-                # shape(cell_unstabilized_x_y) = (frame_height * frame_width, 1, 2)
-                cell_unstabilized_x_y = cv2.perspectiveTransform(frame_stabilized_x_y, stabilized_to_unstabilized_homography.dot(transform_array1))
-                # shape(cell_stabilized_y_x_to_unstabilized_x_y) = (frame_height, frame_width, 2)
-                cell_stabilized_y_x_to_unstabilized_x_y = cell_unstabilized_x_y.reshape((frame_height, frame_width, 2))
-                cell_stabilized_y_x_to_unstabilized_x, cell_stabilized_y_x_to_unstabilized_y = np.moveaxis(
-                    cell_stabilized_y_x_to_unstabilized_x_y, 2, 0)
-
-                # update the overall stabilized-to-unstabilized map, applying this cell's
-                # transformation only to those pixels that are actually part of this cell、
-                # 以下取局部 将掩膜内的部分转换为经逆单应矩阵变换后的点的坐标
-                # frame_stabilized_y_x_to_unstabilized_x  np.full((frame_height, frame_width), frame_width + 1)
-                # (frame_height, frame_width) 填充值为frame_width + 1/frame_height + 1
-                # 向各网格在稳定图像中所对应的区域内存入各像素点对应未稳定图像像素的索引
-                frame_stabilized_y_x_to_unstabilized_x = np.where(
-                    stabilized_cell_mask, cell_stabilized_y_x_to_unstabilized_x, frame_stabilized_y_x_to_unstabilized_x)
-                frame_stabilized_y_x_to_unstabilized_y = np.where(
-                    stabilized_cell_mask, cell_stabilized_y_x_to_unstabilized_y, frame_stabilized_y_x_to_unstabilized_y)
-            
-        # cv2.remap(img,map1,map2,interpolation) img源图像 map1表示CV_32FC2类型(x,y)点的x map2表示点的y
+        # of its four vertices, we can construct a homography to fill in the remaining pixels.
+        # 各网格只在其变形后的包围盒内计算 见mesh_warp.get_mesh_warp_maps
+        frame_stabilized_y_x_to_unstabilized_x, frame_stabilized_y_x_to_unstabilized_y = mesh_warp.get_warp_maps(
+            frame_width, frame_height, row_col_to_unstabilized_vertex_x_y, row_col_to_stabilized_vertex_x_y, x_displacement,
+            map_format=warp_map_format)
+
+        # cv2.remap(img,map1,map2,interpolation) img源图像 浮点格式下map1为x坐标 map2为y坐标 定点格式下map1为整数坐标(x,y) map2为插值表索引
         stabilized_frame = cv2.remap(
             unstabilized_frame,
-            frame_stabilized_y_x_to_unstabilized_x.reshape((frame_height, frame_width, 1)).astype(np.float32),
-            frame_stabilized_y_x_to_unstabilized_y.reshape((frame_height, frame_width, 1)).astype(np.float32),
+            frame_stabilized_y_x_to_unstabilized_x,
+            frame_stabilized_y_x_to_unstabilized_y,
             cv2.INTER_LINEAR, borderValue=(0,0,0)
         )
 
@@ -2501,37 +2808,26 @@ def multiprocessing_job_for_warp_boost(pos, unstabilized_frames, stabilized_moti
     transform_array = np.array([[1, 0, transform_dist[0]], [0, 1, transform_dist[1]], [0, 0, 1]])
     transform_array1 = np.array([[1, 0, -transform_dist[0]], [0, 1, -transform_dist[1]], [0, 0, 1]])
 
+    mesh = unstabilized_vertex_x_y.reshape((mesh_row_count + 1, mesh_col_count + 1, 2))
+    # 片段内所有帧所有网格的单应性矩阵一次批量求解 shape (num_frames, mesh_row_count, mesh_col_count, 3, 3)
+    homographies_by_frame_index, _ = mesh_warp.get_cell_homographies(
+        mesh, mesh + np.reshape(stabilized_motion_mesh_in_snipped, (num_frames, mesh_row_count + 1, mesh_col_count + 1, 2)))
+
     for frame_index in range(num_frames):
         unstabilized_frame = unstabilized_frames_in_snipped[frame_index]
 
         # define handles on mesh in x and y direction
         map_x = np.zeros((frame_height, frame_width), np.float32)
         map_y = np.zeros((frame_height, frame_width), np.float32)
-        #
-        mesh = unstabilized_vertex_x_y.reshape((mesh_row_count + 1, mesh_col_count + 1, 2))
-
-        row_col_to_stabilized_vertex_x_y = np.reshape(stabilized_motion_mesh_in_snipped[frame_index], (mesh_row_count + 1, mesh_col_count + 1, 2))
-        x_motion_mesh, y_motion_mesh = np.moveaxis(row_col_to_stabilized_vertex_x_y, 2, 0)
-        # print(x_motion_mesh[0,0])
 
         pixel_indices_x, pixel_indices_y = np.meshgrid(np.arange(frame_width), np.arange(frame_height))
         pixel_indices = np.concatenate((pixel_indices_x.reshape(-1,1), pixel_indices_y.reshape(-1,1)), axis=1).astype(np.float32).reshape((frame_height, frame_width, 2))
         
         for i in range(mesh_row_count):
             for j in range(mesh_col_count):
-                    
-                src = [mesh[i, j], mesh[i+1, j],
-                        mesh[i, j+1], mesh[i+1, j+1]]
-                src = np.asarray(src)
-
-                dst = [[mesh[i, j, 0] + x_motion_mesh[i, j], mesh[i, j, 1] + y_motion_mesh[i, j]],
-                    [mesh[i+1, j, 0] + x_motion_mesh[i+1, j], mesh[i+1, j, 1] + y_motion_mesh[i+1, j]],
-                    [mesh[i, j+1, 0] + x_motion_mesh[i, j+1], mesh[i, j+1, 1] + y_motion_mesh[i, j+1]],
-                    [mesh[i+1, j+1, 0] + x_motion_mesh[i+1, j+1], mesh[i+1, j+1, 1] + y_motion_mesh[i+1, j+1]]]
-                dst = np.asarray(dst)
-                dst = dst.reshape((4, 2))
-                    
-                H, _ = cv2.findHomography(src, dst, cv2.RANSAC)
+
+                # 四点单应性矩阵为闭式解 无需RANSAC
+                H = homographies_by_frame_index[frame_index, i, j]
                 
                 chosen_pixel = pixel_indices[int(mesh[i, j, 1]): int(mesh[i+1, j, 1]), 
                                              int(mesh[i, j, 0]): int(mesh[i, j+1, 0]), :]
@@ -2543,6 +2839,7 @@ def multiprocessing_job_for_warp_boost(pos, unstabilized_frames, stabilized_moti
                 map_y[int(mesh[i, j, 1]): int(mesh[i+1, j, 1]), 
                       int(mesh[i, j, 0]): int(mesh[i, j+1, 0])] = warped_pixel[:, :, 1]
         
+        map_x, map_y = mesh_warp.convert_warp_maps(map_x, map_y, warp_map_format)
         stabilized_frame = cv2.remap(unstabilized_frame, map_x, map_y, interpolation=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)\
         
         stabilized_frames.append(stabilized_frame)
@@ -2640,43 +2937,12 @@ def plot_motionfield(frame_index, vertex_stabilized_displacements_by_frame_index
     
     plt.show()
 
-def seamcut(src, dst):
-
-    import maxflow
-    from energy import get_energy_map
-    img_pixel1,img_pixel2,left,right,up,down = get_energy_map(src, dst)
-
-    g = maxflow.GraphFloat()
-    img_pixel1 = img_pixel1.astype(float)
-    img_pixel1 = img_pixel1*1e10
-    img_pixel2 = img_pixel2.astype(float)
-    img_pixel2 = img_pixel2*1e10
-    nodeids = g.add_grid_nodes(img_pixel1.shape)
-    # print(img_pixel1.shape)
-    g.add_grid_tedges(nodeids,img_pixel1,img_pixel2)
-    structure_left = np.array([[0,0,0],
-                            [0,0,1],
-                            [0,0,0]])
-    g.add_grid_edges(nodeids,weights=left,structure=structure_left,symmetric=False)
-    structure_right = np.array([[0,0,0],
-                            [1,0,0],
-                            [0,0,0]])
-    g.add_grid_edges(nodeids,weights=right,structure=structure_right,symmetric=False)
-    structure_up = np.array([[0,0,0],
-                            [0,0,0],
-                            [0,1,0]])
-    g.add_grid_edges(nodeids,weights=up,structure=structure_up,symmetric=False)
-    structure_down = np.array([[0,1,0],
-                            [0,0,0],
-                            [0,0,0]])
-    g.add_grid_edges(nodeids,weights=down,structure=structure_down,symmetric=False)
-    g.maxflow()
-    sgm = g.get_grid_segments(nodeids)
-
-    # The labels should be 1 where sgm is False and 0 otherwise.
-    img2 = np.int_(np.logical_not(sgm))
-    src_mask = img2.astype(np.uint8)
-    dst_mask = np.logical_not(img2).astype(np.uint8)
+def seamcut(src, dst, seam_solver=None, seam_backend=SEAM_BACKEND_GRAPH_CUT, seam_coarse_scale=4):
+
+    from energy import get_seam_mask
+    # 只在重叠区域包围盒内求解缝合线 视频中可由seam_solver沿用上一帧缝合线 只在其附近的通道内求解
+    src_mask = seam_solver.get_seam_mask(src, dst) if seam_solver is not None else get_seam_mask(src, dst, seam_backend, seam_coarse_scale)
+    dst_mask = np.logical_not(src_mask).astype(np.uint8)
     src_mask = np.stack((src_mask,src_mask,src_mask),axis=-1)
     dst_mask = np.stack((dst_mask,dst_mask,dst_mask),axis=-1)
 
@@ -2727,7 +2993,63 @@ if __name__ == '__main__':
     ap.add_argument("-r", "--right", type=str, default="data/rear/rear_multiband.mp4", help="path to the right video")
     # ap.add_argument("-l", "--left", type=str, default="real_09/final_3/rear/case3_rear_multiband.mp4", help="path to the left video")
     # ap.add_argument("-r", "--right", type=str, default="real_09/final_3/front/case3_front_multiband.mp4", help="path to the right video")
+    # LoFTR推理后端 无GPU时在CPU上控制线程数与精度
+    ap.add_argument("--matcher-threads", type=int, default=None, help="number of torch intra-op threads for LoFTR on the CPU")
+    ap.add_argument("--matcher-precision", type=str, default=loftr_matcher.PRECISION_FLOAT32,
+                    choices=[loftr_matcher.PRECISION_FLOAT32, loftr_matcher.PRECISION_BFLOAT16, loftr_matcher.PRECISION_DYNAMIC_INT8],
+                    help="LoFTR inference precision")
+    ap.add_argument("--matcher-trace-cache", type=str, default=None, help="directory for the cached TorchScript trace of the LoFTR backbone")
+    ap.add_argument("--matcher-scale", type=str, default="1.0", help="downsampling scale of the overlap crops before LoFTR, or 'auto'")
+    ap.add_argument("--matcher-target-matches", type=int, default=None, help="target number of matches per pair for --matcher-scale auto")
+    ap.add_argument("--matcher-time-budget", type=float, default=None, help="target LoFTR time per pair in seconds for --matcher-scale auto")
+    ap.add_argument("--matcher-max-window-pixels", type=int, default=None, help="match the overlap crops in windows of at most this many pixels to cap memory")
+    # 拼接特征仅在关键帧上LoFTR匹配 其余帧LK光流跟踪
+    ap.add_argument("--stitch-keyframe-tracking", action="store_true", help="run LoFTR for stitching only on keyframes and track the matches with LK in between")
+    ap.add_argument("--stitch-keyframe-interval", type=int, default=30, help="maximum number of frames between stitch keyframes")
+    # 匹配结果磁盘缓存 反复运行同一段录像时跳过LoFTR
+    ap.add_argument("--match-cache", type=str, default=None, help="sqlite file caching the filtered LoFTR matches across runs")
+    ap.add_argument("--match-cache-size", type=int, default=1024, help="maximum size of the match cache in MB")
+    ap.add_argument("--stitch-prefetch", type=int, default=0, help="number of LoFTR batches matched ahead in a background thread during stitching")
+    # 卡尔曼预测拼接运动场 数值越小匹配越频繁
+    ap.add_argument("--stitch-kalman-max-variance", type=float, default=None,
+                    help="predict the stitch field with a Kalman filter and match only when its predicted variance (px^2) exceeds this value")
+    # 铰接角查找表 标定时扫描一段录像建表 运行时按铰接角查表得到拼接网格与映射表
+    ap.add_argument("--stitch-lut-calibrate", type=str, default=None, help="sweep the videos and save an articulation-angle stitch table (.npz) to this path")
+    ap.add_argument("--stitch-lut", type=str, default=None, help="stitch with the articulation-angle table at this path instead of matching every frame")
+    ap.add_argument("--stitch-lut-step", type=float, default=1.0, help="angle bin width in degrees when calibrating the stitch table")
+    ap.add_argument("--stitch-lut-interpolation", type=str, default=stitch_lut.LUT_INTERPOLATION_LINEAR,
+                    choices=[stitch_lut.LUT_INTERPOLATION_NEAREST, stitch_lut.LUT_INTERPOLATION_LINEAR],
+                    help="how the stitch table is interpolated between entries")
+    ap.add_argument("--hitch-angles", type=str, default=None, help="CSV of per-frame hitch sensor angles (frame_index, angle) used instead of estimated angles")
+    ap.add_argument("--focal-length", type=float, default=None, help="camera focal length in pixels for the angle estimate (default: frame width)")
+    # 缝合线求解方式 实时处理可用动态规划 离线渲染用图割
+    ap.add_argument("--seam-backend", type=str, default=SEAM_BACKEND_GRAPH_CUT,
+                    choices=[SEAM_BACKEND_GRAPH_CUT, SEAM_BACKEND_DP, SEAM_BACKEND_OPENCV_DP, SEAM_BACKEND_COARSE_TO_FINE],
+                    help="seam solver: graph cut, vertical seam by dynamic programming over the same cost, OpenCV's DP seam finder, "
+                         "or graph cut on a downsampled overlap refined at full resolution around the coarse seam")
+    ap.add_argument("--seam-coarse-scale", type=int, default=4, choices=[4, 8], help="downsampling factor of the coarse-to-fine seam")
+    # 视频缝合线 在上一帧缝合线附近的通道内求解 0为逐帧在整个重叠区域求解
+    ap.add_argument("--seam-corridor", type=int, default=0, help="width in pixels of the corridor around the previous seam that the next seam is searched in (graph cut only; 0: solve every frame over the whole overlap)")
+    ap.add_argument("--seam-keyframe-interval", type=int, default=30, help="maximum number of frames between full-overlap seam solves")
     args = vars(ap.parse_args())
+    if args["seam_backend"] != SEAM_BACKEND_GRAPH_CUT and args["seam_corridor"] > 0:
+        ap.error("--seam-corridor needs --seam-backend %s" % SEAM_BACKEND_GRAPH_CUT)
+
+    if args["stitch_keyframe_tracking"]:
+        stabilizer.stitch_matching = MeshFlowStabilizer.STITCH_MATCHING_KEYFRAME_TRACKING
+    if args["stitch_kalman_max_variance"] is not None:
+        stabilizer.stitch_matching = MeshFlowStabilizer.STITCH_MATCHING_KALMAN_PREDICTION
+        stabilizer.stitch_kalman_max_predicted_variance = args["stitch_kalman_max_variance"]
+    stabilizer.stitch_keyframe_max_interval = args["stitch_keyframe_interval"]
+    stabilizer.stitch_matching_prefetch = args["stitch_prefetch"]
+    if args["match_cache"] is not None:
+        stabilizer.match_cache = match_cache.MatchCache(args["match_cache"], args["match_cache_size"] << 20)
+
+    loftr_matcher.configure_shared_matcher(num_threads=args["matcher_threads"], precision=args["matcher_precision"],
+                                           trace_cache_dir=args["matcher_trace_cache"],
+                                           match_scale=args["matcher_scale"] if args["matcher_scale"] == loftr_matcher.MATCH_SCALE_AUTO else float(args["matcher_scale"]),
+                                           target_match_count=args["matcher_target_matches"], match_time_budget=args["matcher_time_budget"],
+                                           max_window_pixels=args["matcher_max_window_pixels"])
 
     vs = cv2.VideoCapture(args["left"])
     num_frames = np.int32(vs.get(cv2.CAP_PROP_FRAME_COUNT))
@@ -2774,20 +3096,41 @@ if __name__ == '__main__':
                 )
             right_frames.append(unstabilized_frame)
     vs.release()
-    #前视图后视图,拼接运动场生成
-    vertex_left, vertex_right = stabilizer._get_stitch_vertex_displacements_and_homographies(num_frames, left_frames, right_frames)
-    #使用雅可比方法，计算网格顶点稳定后的运动场
-    vertex_stabilized_stitched_by_frame_index_1 = stabilizer._get_stitch_vertex_displacements(
-        num_frames, vertex_left
-    )
 
-    vertex_stabilized_stitched_by_frame_index_2 = stabilizer._get_stitch_vertex_displacements(
-        num_frames, vertex_right
-    )
+    # 拼接网格逐帧变化 映射表无法复用 不缓存
+    stitcher = stitch_utils.stitch_utils(mesh_row_count=mesh_row_count, mesh_col_count=mesh_col_count, 
+                                         feature_ellipse_row_count=8, feature_ellipse_col_count=10,
+                                         warp_map_cache_size=0, warp_map_format=warp_map_format)
+
+    # 各帧铰接角 有传感器记录时使用传感器值
+    hitch_angles_by_frame_index = stitch_lut.read_hitch_angles(args["hitch_angles"]) if args["hitch_angles"] is not None else None
+    angle_source = stitch_lut.ANGLE_SOURCE_SENSOR if hitch_angles_by_frame_index is not None else stitch_lut.ANGLE_SOURCE_HOMOGRAPHY
+
+    articulation_angle_lut = None
+    if args["stitch_lut"] is not None:
+        # 查表拼接 不再逐帧进行LoFTR匹配、顶点求解与映射表计算
+        articulation_angle_lut = stitch_lut.ArticulationAngleLUT.load(args["stitch_lut"], args["stitch_lut_interpolation"])
+        if articulation_angle_lut.angle_source != angle_source:
+            print(f'Warning: the stitch table was calibrated with {articulation_angle_lut.angle_source} angles but {angle_source} angles are used.')
+        articulation_angle_lut.build_warp_maps(stitcher, W, H)
+        orb = cv2.ORB_create(1000)
+        articulation_angle = 0.0
+    else:
+        #前视图后视图,拼接运动场生成
+        vertex_left, vertex_right, stitch_homographies_by_frame_index = stabilizer._get_stitch_vertex_displacements_and_homographies(
+            num_frames, left_frames, right_frames, return_homographies=True)
+        #使用雅可比方法，计算网格顶点稳定后的运动场
+        vertex_stabilized_stitched_by_frame_index_1 = stabilizer._get_stitch_vertex_displacements(
+            num_frames, vertex_left
+        )
 
+        vertex_stabilized_stitched_by_frame_index_2 = stabilizer._get_stitch_vertex_displacements(
+            num_frames, vertex_right
+        )
 
-    stitcher = stitch_utils.stitch_utils(mesh_row_count=mesh_row_count, mesh_col_count=mesh_col_count, 
-                                         feature_ellipse_row_count=8, feature_ellipse_col_count=10)
+    articulation_angle_lut_calibration = None
+    if args["stitch_lut_calibrate"] is not None:
+        articulation_angle_lut_calibration = stitch_lut.ArticulationAngleLUT(args["stitch_lut_step"], angle_source=angle_source)
 
     def motion_field_filter(left_velocity, right_velocity):
         # 中值滤波器去噪
@@ -2850,6 +3193,8 @@ if __name__ == '__main__':
 
         return left_velocity, right_velocity, O_l, O_r, O
 
+    # 缝合线求解器 未启用时逐帧独立求解
+    seam_solver = SeamTracker(args["seam_corridor"], args["seam_keyframe_interval"]) if args["seam_corridor"] > 0 else None
     with tqdm.trange(num_frames) as t:
         t.set_description(f'stitching frames')
         # stitched_frames = []
@@ -2857,14 +3202,36 @@ if __name__ == '__main__':
         for frame_index in t:
             left_frame_ = left_frames[frame_index]
             right_frame_ = right_frames[frame_index]
-            
-            left_velocity_ = vertex_stabilized_stitched_by_frame_index_1[frame_index]
-            right_velocity_ = vertex_stabilized_stitched_by_frame_index_2[frame_index]
-            left_velocity_1_filter, right_velocity_1_filter, O_l_1, O_r_1, O_1 = motion_field_filter(left_velocity_, right_velocity_)
-            O_1 = O_1 + 5
-            # 网格变形
-            img_l_1 = stitcher.get_warped_frames_for_stitch(0, left_frame_, left_velocity_1_filter, O_l_1)
-            img_r_1 = stitcher.get_warped_frames_for_stitch(1, right_frame_, right_velocity_1_filter, O_r_1)
+
+            if articulation_angle_lut is not None:
+                # 铰接角 传感器读数或ORB低成本估计 估计失败时沿用上一帧
+                if hitch_angles_by_frame_index is not None:
+                    articulation_angle = hitch_angles_by_frame_index[min(frame_index, len(hitch_angles_by_frame_index) - 1)]
+                else:
+                    estimated_angle = stitch_lut.estimate_articulation_angle(
+                        left_frame_, right_frame_, MeshFlowStabilizer.STITCH_COMMON_FIELD, args["focal_length"], orb=orb)
+                    if estimated_angle is not None:
+                        articulation_angle = estimated_angle
+                left_warp_maps, right_warp_maps, O_l_1, O_r_1, O_1 = articulation_angle_lut.lookup(articulation_angle)
+                O_1 = O_1 + 5
+                # 网格变形 使用查表得到的映射表
+                img_l_1 = stitcher.remap_for_stitch(left_frame_, left_warp_maps)
+                img_r_1 = stitcher.remap_for_stitch(right_frame_, right_warp_maps)
+            else:
+                left_velocity_ = vertex_stabilized_stitched_by_frame_index_1[frame_index]
+                right_velocity_ = vertex_stabilized_stitched_by_frame_index_2[frame_index]
+                left_velocity_1_filter, right_velocity_1_filter, O_l_1, O_r_1, O_1 = motion_field_filter(left_velocity_, right_velocity_)
+                if articulation_angle_lut_calibration is not None:
+                    if hitch_angles_by_frame_index is not None:
+                        articulation_angle = hitch_angles_by_frame_index[min(frame_index, len(hitch_angles_by_frame_index) - 1)]
+                    else:
+                        articulation_angle = stitch_lut.get_articulation_angle_for_stitch(
+                            *stitch_homographies_by_frame_index[frame_index], W, H, args["focal_length"])
+                    articulation_angle_lut_calibration.add_frame(articulation_angle, left_velocity_1_filter, right_velocity_1_filter, O_l_1, O_r_1, O_1)
+                O_1 = O_1 + 5
+                # 网格变形
+                img_l_1 = stitcher.get_warped_frames_for_stitch(0, left_frame_, left_velocity_1_filter, O_l_1)
+                img_r_1 = stitcher.get_warped_frames_for_stitch(1, right_frame_, right_velocity_1_filter, O_r_1)
 
             # 缝合线选取
             print(f"H = {H}, W = {W}, O_1 = {O_1}")
@@ -2873,7 +3240,7 @@ if __name__ == '__main__':
             r = np.zeros((H, W + 2 * O_1, 3), np.uint8)
             l[:, :W, :] = img_l_1
             r[:, 2 * O_1:, :] = img_r_1
-            stitched_seam_1 = seamcut(l, r)
+            stitched_seam_1 = seamcut(l, r, seam_solver, args["seam_backend"], args["seam_coarse_scale"])
 
             # 多频段融合
             flag_half = False
@@ -2889,3 +3256,7 @@ if __name__ == '__main__':
             cv2.imwrite('data/final/seamcut/'+'{:0{}d}'.format(frame_index + 0, 3) + '.jpg', stitched_seam_1)
             cv2.imwrite('data/final/multiband/'+'{:0{}d}'.format(frame_index + 0, 3) + '.jpg', stitched_band_1)
 
+
+    if articulation_angle_lut_calibration is not None:
+        articulation_angle_lut_calibration.save(args["stitch_lut_calibrate"])
+        print(f'Saved the articulation-angle stitch table ({len(articulation_angle_lut_calibration.angles)} entries) to <{args["stitch_lut_calibrate"]}>.')
@@ -0,0 +1,344 @@
+import csv
+import math
+import cv2
+import numpy as np
+
+import mesh_warp
+
+
+# 查表时相邻表项之间的插值方式
+LUT_INTERPOLATION_NEAREST = 'nearest'
+LUT_INTERPOLATION_LINEAR = 'linear'
+
+# 铰接角的来源 标定与运行时须一致
+ANGLE_SOURCE_HOMOGRAPHY = 'homography'
+ANGLE_SOURCE_SENSOR = 'sensor'
+
+
+##  由左图到右图的单应矩阵估计铰接角(绕竖直轴的偏航角)  ##
+def get_articulation_angle(left_to_right_homography, frame_width, frame_height, focal_length=None):
+    '''
+    Return the articulation angle in degrees encoded by a homography from the left (tractor)
+    frame to the right (trailer) frame.
+
+    The homography is treated as a camera rotation H = K R K^-1 with the principal point at the
+    frame center, and the angle is the rotation of R about the vertical axis. The cameras are
+    not at the same place, so this is only approximately the hitch angle, but it changes
+    monotonically with it, which is all an angle-indexed table needs.
+
+    Input:
+
+    * left_to_right_homography: A 3x3 homography mapping left frame coordinates to right frame
+        coordinates.
+    * frame_width: the width of the frames.
+    * frame_height: the height of the frames.
+    * focal_length: The focal length in pixels, or None to use frame_width.
+
+    Output:
+
+    articulation_angle: The angle in degrees.
+    '''
+
+    if focal_length is None:
+        focal_length = frame_width
+    camera_matrix = np.array([[focal_length, 0, (frame_width - 1) / 2],
+                              [0, focal_length, (frame_height - 1) / 2],
+                              [0, 0, 1]])
+
+    rotation = np.linalg.inv(camera_matrix) @ left_to_right_homography @ camera_matrix
+    # 单应矩阵只定义到尺度 归一化为行列式为1
+    rotation = rotation / np.cbrt(np.linalg.det(rotation))
+
+    return math.degrees(math.atan2(rotation[0, 2], rotation[2, 2]))
+
+
+##  由拼接的全局H(左右图到虚拟中间图)估计铰接角  ##
+def get_articulation_angle_for_stitch(early_to_late_homography_l, early_to_late_homography_r, frame_width, frame_height, focal_length=None):
+    '''
+    Return get_articulation_angle for the homographies returned by
+    MeshFlowStabilizer.get_matched_features_and_homography_for_stitch, which map the left and
+    right frames to the virtual middle frame.
+    '''
+
+    left_to_right_homography = np.linalg.inv(early_to_late_homography_r) @ early_to_late_homography_l
+
+    return get_articulation_angle(left_to_right_homography, frame_width, frame_height, focal_length)
+
+
+##  运行时低成本估计铰接角 重叠区域降采样后ORB匹配  ##
+def estimate_articulation_angle(left_frame, right_frame, common_field, focal_length=None, scale=0.5, orb=None):
+    '''
+    Estimate the articulation angle of a frame pair without LoFTR.
+
+    ORB features are matched between the left frame's right overlap strip and the right frame's
+    left overlap strip, downsampled by scale, and the angle of their MAGSAC homography is
+    returned. The result is in the same units as get_articulation_angle_for_stitch.
+
+    Input:
+
+    * left_frame: The left (tractor) frame.
+    * right_frame: The right (trailer) frame.
+    * common_field: The width of the overlap strips.
+    * focal_length: See get_articulation_angle.
+    * scale: The downsampling factor of the strips.
+    * orb: A cv2.ORB object to reuse, or None to create one.
+
+    Output:
+
+    articulation_angle: The angle in degrees, or None if too few features matched.
+    '''
+
+    frame_height, frame_width = left_frame.shape[:2]
+    if orb is None:
+        orb = cv2.ORB_create(1000)
+
+    left_strip = cv2.cvtColor(left_frame[:, frame_width - common_field: frame_width], cv2.COLOR_BGR2GRAY)
+    right_strip = cv2.cvtColor(right_frame[:, 0: common_field], cv2.COLOR_BGR2GRAY)
+    left_strip = cv2.resize(left_strip, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    right_strip = cv2.resize(right_strip, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+    left_keypoints, left_descriptors = orb.detectAndCompute(left_strip, None)
+    right_keypoints, right_descriptors = orb.detectAndCompute(right_strip, None)
+    if left_descriptors is None or right_descriptors is None:
+        return None
+    matches = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True).match(left_descriptors, right_descriptors)
+    if len(matches) < 12:
+        return None
+
+    # 回到全分辨率的整帧坐标
+    left_features = np.float32([left_keypoints[match.queryIdx].pt for match in matches]) / scale + np.float32([frame_width - common_field, 0])
+    right_features = np.float32([right_keypoints[match.trainIdx].pt for match in matches]) / scale
+    left_to_right_homography, _ = cv2.findHomography(left_features, right_features, cv2.USAC_MAGSAC)
+    if left_to_right_homography is None:
+        return None
+
+    return get_articulation_angle(left_to_right_homography, frame_width, frame_height, focal_length)
+
+
+##  读取铰接角传感器记录 每行(frame_index, angle)  ##
+def read_hitch_angles(csv_path):
+    '''
+    Return the per-frame articulation angles recorded by a hitch sensor.
+
+    The CSV has a header row and the columns frame_index and angle (in degrees). Frames without
+    a row get the angle of the closest earlier frame.
+
+    Input:
+
+    * csv_path: The path to the CSV file.
+
+    Output:
+
+    hitch_angles_by_frame_index: A float NumPy array of shape (num_frames,).
+    '''
+
+    with open(csv_path, newline='') as csv_file:
+        rows = [(int(row['frame_index']), float(row['angle'])) for row in csv.DictReader(csv_file)]
+    if not rows:
+        raise ValueError(f'No hitch angles in <{csv_path}>.')
+
+    rows.sort()
+    hitch_angles_by_frame_index = np.full(rows[-1][0] + 1, rows[0][1])
+    for frame_index, angle in rows:
+        hitch_angles_by_frame_index[frame_index:] = angle
+
+    return hitch_angles_by_frame_index
+
+
+class ArticulationAngleLUT:
+    '''
+    A table of filtered stitch meshes indexed by articulation angle.
+
+    In calibration, add_frame is called for every frame of a recording with the frame's angle
+    and its filtered stitch meshes; frames are grouped into bins of angle_step degrees and each
+    bin keeps the mean meshes and displacements of its frames. At runtime, build_warp_maps
+    precomputes the remap maps of every entry once, and lookup returns the maps for a frame's
+    angle, so no matching, vertex solve or warp-map build is needed per frame.
+    '''
+
+    def __init__(self, angle_step=1.0, interpolation=LUT_INTERPOLATION_LINEAR, angle_source=ANGLE_SOURCE_HOMOGRAPHY):
+        '''
+        Constructor.
+
+        Input:
+
+        * angle_step: The width in degrees of the angle bins.
+        * interpolation: LUT_INTERPOLATION_NEAREST returns the maps of the closest entry;
+            LUT_INTERPOLATION_LINEAR blends the maps of the two entries around the angle.
+        * angle_source: ANGLE_SOURCE_HOMOGRAPHY or ANGLE_SOURCE_SENSOR, recorded so that the
+            runtime can use the same kind of angle as the calibration.
+
+        Output:
+
+        (An ArticulationAngleLUT object.)
+        '''
+
+        if interpolation not in (LUT_INTERPOLATION_NEAREST, LUT_INTERPOLATION_LINEAR):
+            raise ValueError(
+                'Invalid value for `interpolation`. Expecting value of '
+                '`stitch_lut.LUT_INTERPOLATION_NEAREST` or `stitch_lut.LUT_INTERPOLATION_LINEAR`.'
+            )
+
+        self.angle_step = angle_step
+        self.interpolation = interpolation
+        self.angle_source = angle_source
+        # 标定时按角度分箱累加 键为箱序号
+        self.sums_by_bin = {}
+        # 查表用 按角度排序的表项及其映射表
+        self.angles = None
+        self.left_velocities = None
+        self.right_velocities = None
+        self.displacements = None
+        self.left_warp_maps = None
+        self.right_warp_maps = None
+
+
+    ##  标定 累加一帧的拼接网格  ##
+    def add_frame(self, angle, left_velocity, right_velocity, O_l, O_r, O):
+        '''
+        Add a calibration frame.
+
+        Input:
+
+        * angle: The frame's articulation angle in degrees.
+        * left_velocity: The left frame's filtered stitch mesh, of shape
+            (mesh_row_count + 1, mesh_col_count + 1, 2).
+        * right_velocity: The right frame's filtered stitch mesh.
+        * O_l, O_r, O: The frame's horizontal displacements (see motion_field_filter in
+            stitch_dynamic).
+        '''
+
+        angle_bin = int(round(angle / self.angle_step))
+        if angle_bin not in self.sums_by_bin:
+            self.sums_by_bin[angle_bin] = [0, 0.0, np.zeros(np.shape(left_velocity)), np.zeros(np.shape(right_velocity)), np.zeros(3)]
+        sums = self.sums_by_bin[angle_bin]
+        sums[0] += 1
+        sums[1] += angle
+        sums[2] += left_velocity
+        sums[3] += right_velocity
+        sums[4] += (O_l, O_r, O)
+
+
+    ##  由分箱累加值得到各表项的均值  ##
+    def _set_entries_from_sums(self):
+
+        bins = sorted(self.sums_by_bin)
+        counts = np.array([self.sums_by_bin[angle_bin][0] for angle_bin in bins], dtype=np.float64)
+        self.angles = np.array([self.sums_by_bin[angle_bin][1] for angle_bin in bins]) / counts
+        self.left_velocities = np.array([self.sums_by_bin[angle_bin][2] for angle_bin in bins]) / counts[:, np.newaxis, np.newaxis, np.newaxis]
+        self.right_velocities = np.array([self.sums_by_bin[angle_bin][3] for angle_bin in bins]) / counts[:, np.newaxis, np.newaxis, np.newaxis]
+        self.displacements = np.array([self.sums_by_bin[angle_bin][4] for angle_bin in bins]) / counts[:, np.newaxis]
+        self.left_warp_maps = None
+        self.right_warp_maps = None
+
+
+    ##  预先计算所有表项的映射表  ##
+    def build_warp_maps(self, stitcher, frame_width, frame_height):
+        '''
+        Precompute the remap maps of every entry with stitcher.compute_warp_maps_for_stitch.
+
+        With LUT_INTERPOLATION_LINEAR the maps are kept as float32 so they can be blended;
+        with LUT_INTERPOLATION_NEAREST they are converted to stitcher.warp_map_format.
+        '''
+
+        if self.sums_by_bin:
+            self._set_entries_from_sums()
+        if self.angles is None:
+            raise ValueError('The articulation angle table is empty.')
+
+        self.left_warp_maps = []
+        self.right_warp_maps = []
+        for left_velocity, right_velocity, (O_l, O_r, _) in zip(self.left_velocities, self.right_velocities, self.displacements):
+            for pos, velocity, x_displacement, warp_maps in ((0, left_velocity, O_l, self.left_warp_maps), (1, right_velocity, O_r, self.right_warp_maps)):
+                map_x, map_y = stitcher.compute_warp_maps_for_stitch(
+                    pos, frame_width, frame_height, velocity, int(round(x_displacement)), map_format=mesh_warp.MAP_FORMAT_FLOAT)
+                if self.interpolation == LUT_INTERPOLATION_NEAREST:
+                    map_x, map_y = mesh_warp.convert_warp_maps(map_x, map_y, stitcher.warp_map_format)
+                warp_maps.append((map_x, map_y))
+
+
+    ##  按铰接角查表  ##
+    def lookup(self, angle):
+        '''
+        Return the stitch geometry for a frame with the given articulation angle.
+
+        Angles outside the calibrated range use the closest entry.
+
+        Input:
+
+        * angle: The frame's articulation angle in degrees.
+
+        Output:
+
+        A tuple of the following items in order.
+
+        * left_warp_maps: The (map_x, map_y) that warp the left frame, for cv2.remap.
+        * right_warp_maps: The (map_x, map_y) that warp the right frame.
+        * O_l, O_r, O: The frame's horizontal displacements, rounded to integers.
+        '''
+
+        if self.left_warp_maps is None:
+            raise ValueError('Call `build_warp_maps` before `lookup`.')
+
+        # 相邻两表项及插值权重
+        upper_index = int(np.clip(np.searchsorted(self.angles, angle), 1, len(self.angles) - 1)) if len(self.angles) > 1 else 0
+        lower_index = max(upper_index - 1, 0)
+        if upper_index == lower_index:
+            weight = 0.0
+        else:
+            weight = float(np.clip((angle - self.angles[lower_index]) / (self.angles[upper_index] - self.angles[lower_index]), 0, 1))
+
+        displacements = (1 - weight) * self.displacements[lower_index] + weight * self.displacements[upper_index]
+        O_l, O_r, O = (int(round(displacement)) for displacement in displacements)
+
+        if self.interpolation == LUT_INTERPOLATION_NEAREST or weight in (0.0, 1.0):
+            nearest_index = upper_index if weight >= 0.5 else lower_index
+            left_warp_maps = self.left_warp_maps[nearest_index]
+            right_warp_maps = self.right_warp_maps[nearest_index]
+        else:
+            left_warp_maps = self._blend_warp_maps(self.left_warp_maps[lower_index], self.left_warp_maps[upper_index], weight)
+            right_warp_maps = self._blend_warp_maps(self.right_warp_maps[lower_index], self.right_warp_maps[upper_index], weight)
+
+        return (left_warp_maps, right_warp_maps, O_l, O_r, O)
+
+
+    ##  两表项映射表线性插值  ##
+    def _blend_warp_maps(self, lower_warp_maps, upper_warp_maps, weight):
+
+        (lower_map_x, lower_map_y), (upper_map_x, upper_map_y) = lower_warp_maps, upper_warp_maps
+        map_x = cv2.addWeighted(lower_map_x, 1 - weight, upper_map_x, weight, 0)
+        map_y = cv2.addWeighted(lower_map_y, 1 - weight, upper_map_y, weight, 0)
+
+        # 只有一侧在图像外的像素不插值 取较近表项的值 避免插值出图像内的错误坐标
+        frame_height, frame_width = map_x.shape
+        outside = (lower_map_x > frame_width) != (upper_map_x > frame_width)
+        nearest_map_x, nearest_map_y = upper_warp_maps if weight >= 0.5 else lower_warp_maps
+        map_x[outside] = nearest_map_x[outside]
+        map_y[outside] = nearest_map_y[outside]
+
+        return (map_x, map_y)
+
+
+    ##  保存/读取 只存网格与平移量 映射表读取后重新计算  ##
+    def save(self, path):
+
+        if self.sums_by_bin:
+            self._set_entries_from_sums()
+        if self.angles is None:
+            raise ValueError('The articulation angle table is empty.')
+
+        np.savez_compressed(path, angles=self.angles, left_velocities=self.left_velocities, right_velocities=self.right_velocities,
+                            displacements=self.displacements, angle_step=self.angle_step, angle_source=self.angle_source)
+
+
+    @classmethod
+    def load(cls, path, interpolation=LUT_INTERPOLATION_LINEAR):
+
+        with np.load(path) as table:
+            lut = cls(float(table['angle_step']), interpolation, str(table['angle_source']))
+            lut.angles = table['angles']
+            lut.left_velocities = table['left_velocities']
+            lut.right_velocities = table['right_velocities']
+            lut.displacements = table['displacements']
+
+        return lut
@@ -1,11 +1,11 @@
 import numpy as np
 import cv2
-import kornia as K
-import kornia.feature as KF
-import torch
 import math
-import statistics
+from collections import OrderedDict
 import time
+import mesh_warp
+import loftr_matcher
+import match_cache
 
 def measure_performance(method):
     def timed(*args, **kwargs):
@@ -16,11 +16,162 @@ def measure_performance(method):
         return result
     return timed
 
+#  特征点与网格顶点的对应关系(椭圆范围) 数组化实现 供稳定与拼接共用  #
+def get_feature_vertex_membership(frame_width, frame_height, mesh_row_count, mesh_col_count,
+                                  feature_ellipse_row_count, feature_ellipse_col_count, feature_x_y):
+    '''
+    Return which mesh vertices fall inside the ellipse drawn around each feature.
+
+    The ellipse of width feature_ellipse_col_count and height feature_ellipse_row_count (in mesh
+    cells) is centered on the feature. The bounds follow the per-feature loop this replaces
+    exactly, but every feature is tested against a precomputed stencil of
+    (feature_ellipse_row_count + 2) x (feature_ellipse_col_count + 2) candidate vertices at once.
+
+    Input:
+
+    * frame_width: the width of the frame.
+    * frame_height: the height of the frame.
+    * mesh_row_count, mesh_col_count: The number of rows and cols contained in the mesh.
+    * feature_ellipse_row_count, feature_ellipse_col_count: The height and width of the ellipse.
+    * feature_x_y: A NumPy array of shape (num_features, 1, 2) or (num_features, 2) containing
+        the feature positions.
+
+    Output:
+
+    A tuple of the following items in order, with one entry per (feature, vertex) pair.
+
+    * feature_indexes: A 1D NumPy array of feature indexes.
+    * vertex_indexes: A 1D NumPy array of flattened vertex indexes,
+        i.e. row * (mesh_col_count + 1) + col.
+    '''
+
+    feature_x_y = np.reshape(feature_x_y, (-1, 2))
+    feature_row = (feature_x_y[:, 1] / frame_height) * mesh_row_count
+    feature_col = (feature_x_y[:, 0] / frame_width) * mesh_col_count
+
+    # 椭圆覆盖的行 顶行(含)至底行(不含)
+    ellipse_top_row_inclusive = np.maximum(0, np.ceil(feature_row - feature_ellipse_row_count / 2)).astype(np.int64)
+    ellipse_bottom_row_exclusive = 1 + np.minimum(mesh_row_count, np.floor(feature_row + feature_ellipse_row_count / 2)).astype(np.int64)
+
+    # 椭圆最多覆盖feature_ellipse_row_count + 1行 多取一行作为模板
+    vertex_rows = ellipse_top_row_inclusive[:, np.newaxis] + np.arange(feature_ellipse_row_count + 2)
+    row_mask = vertex_rows < ellipse_bottom_row_exclusive[:, np.newaxis]
+
+    # 基于椭圆方程 计算每一行所包含的列 (开方在双精度下进行 与math.sqrt一致)
+    ellipse_slice_half_width_squared = (1/4) - ((vertex_rows - feature_row[:, np.newaxis]) / feature_ellipse_row_count) ** 2
+    ellipse_slice_half_width = (feature_ellipse_col_count * np.sqrt(
+        np.where(row_mask, ellipse_slice_half_width_squared, 0).astype(np.float64))).astype(feature_row.dtype)
+    ellipse_left_col_inclusive = np.maximum(0, np.ceil(feature_col[:, np.newaxis] - ellipse_slice_half_width)).astype(np.int64)
+    ellipse_right_col_exclusive = 1 + np.minimum(mesh_col_count, np.floor(feature_col[:, np.newaxis] + ellipse_slice_half_width)).astype(np.int64)
+
+    vertex_cols = ellipse_left_col_inclusive[:, :, np.newaxis] + np.arange(feature_ellipse_col_count + 2)
+    membership_mask = row_mask[:, :, np.newaxis] & (vertex_cols < ellipse_right_col_exclusive[:, :, np.newaxis])
+
+    feature_indexes = np.broadcast_to(np.arange(len(feature_x_y))[:, np.newaxis, np.newaxis], membership_mask.shape)[membership_mask]
+    vertex_indexes = (vertex_rows[:, :, np.newaxis] * (mesh_col_count + 1) + vertex_cols)[membership_mask]
+
+    return (feature_indexes, vertex_indexes)
+
+
+#  按顶点分组求中位数(分段排序) 无数据的顶点置0  #
+def get_segmented_medians(values, segment_indexes, num_segments):
+    '''
+    Return the median of values within each segment, matching statistics.median: the middle
+    element for an odd count and the mean of the two middle elements (in the values' dtype) for
+    an even count. Empty segments get 0.
+
+    Input:
+
+    * values: A 1D NumPy array.
+    * segment_indexes: A 1D NumPy array of ints in [0, num_segments), one per value.
+    * num_segments: The number of segments.
+
+    Output:
+
+    * medians: A 1D float64 NumPy array of shape (num_segments,).
+    '''
+
+    medians = np.zeros(num_segments)
+    if len(values) == 0:
+        return medians
+
+    # 先按顶点 再按数值排序
+    order = np.lexsort((values, segment_indexes))
+    sorted_values = values[order]
+    counts = np.bincount(segment_indexes, minlength=num_segments)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+    nonempty = counts > 0
+    lower_middle = starts[nonempty] + (counts[nonempty] - 1) // 2
+    upper_middle = starts[nonempty] + counts[nonempty] // 2
+    medians[nonempty] = np.where(counts[nonempty] % 2 == 1, sorted_values[lower_middle],
+                                 (sorted_values[lower_middle] + sorted_values[upper_middle]) / 2)
+
+    return medians
+
+
+#  各顶点在椭圆范围内特征点残余运动的中位数  #
+def get_vertex_nearby_feature_residual_medians(frame_width, frame_height, mesh_row_count, mesh_col_count,
+                                               feature_ellipse_row_count, feature_ellipse_col_count,
+                                               early_features, late_features, early_to_late_homography):
+    '''
+    Return, for every mesh vertex, the median residual velocity of the features whose ellipse
+    contains it (0 for vertices without nearby features). This is the array form of collecting
+    every feature's residual velocity into per-vertex lists and reducing them with
+    statistics.median, and gives the same values.
+
+    Input:
+
+    * frame_width, frame_height, mesh_row_count, mesh_col_count, feature_ellipse_row_count,
+        feature_ellipse_col_count: See get_feature_vertex_membership.
+    * early_features: A CV_32FC2 array of feature positions in the early frame, or None.
+    * late_features: A CV_32FC2 array of the matching feature positions in the late frame,
+        or None.
+    * early_to_late_homography: A homography matrix that maps a point in the early frame to its
+        corresponding location in the late frame, assuming the point is not undergoing motion.
+
+    Output:
+
+    A tuple of the following items in order.
+
+    * vertex_residual_x_velocities_by_row_col: A NumPy array of shape
+        (mesh_row_count + 1, mesh_col_count + 1).
+    * vertex_residual_y_velocities_by_row_col: The corresponding y-velocities.
+    '''
+
+    num_vertices = (mesh_row_count + 1) * (mesh_col_count + 1)
+    if early_features is None:
+        return (np.zeros((mesh_row_count + 1, mesh_col_count + 1)), np.zeros((mesh_row_count + 1, mesh_col_count + 1)))
+
+    # 计算特征点自身的运动(去除全局运动) v_p~ = p - F_t*p^
+    feature_residual_velocities = np.reshape(
+        late_features - cv2.perspectiveTransform(early_features, early_to_late_homography), (-1, 2))
+
+    feature_indexes, vertex_indexes = get_feature_vertex_membership(
+        frame_width, frame_height, mesh_row_count, mesh_col_count,
+        feature_ellipse_row_count, feature_ellipse_col_count, late_features)
+
+    vertex_residual_x_velocities = get_segmented_medians(
+        feature_residual_velocities[feature_indexes, 0], vertex_indexes, num_vertices)
+    vertex_residual_y_velocities = get_segmented_medians(
+        feature_residual_velocities[feature_indexes, 1], vertex_indexes, num_vertices)
+
+    return (vertex_residual_x_velocities.reshape((mesh_row_count + 1, mesh_col_count + 1)),
+            vertex_residual_y_velocities.reshape((mesh_row_count + 1, mesh_col_count + 1)))
+
+
 class stitch_utils:
+    # MAGSAC剔除误匹配的参数(阈值, 置信度, 最大迭代次数)
+    MAGSAC_PARAMETERS = (0.8, 0.9999, 100000)
+
     def __init__(self, mesh_row_count=12, mesh_col_count=8,  # 网格行数与列数，顶点数各加1
                  feature_ellipse_row_count=8, feature_ellipse_col_count=6,  # 每个特征点所占椭圆覆盖的行\列
                  homography_min_number_corresponding_features=12,
-                 color_outside_image_area_bgr=(0, 0, 0)  # 稳定图像后设置背景色，避免图像无法覆盖窗口
+                 color_outside_image_area_bgr=(0, 0, 0),  # 稳定图像后设置背景色，避免图像无法覆盖窗口
+                 warp_map_cache_size=16,  # 缓存的网格变形映射表(map_x, map_y)数量 0为不缓存
+                 warp_map_format=mesh_warp.MAP_FORMAT_FIXED,  # 映射表格式 定点(CV_16SC2)映射表占用内存减半
+                 matcher=None,  # LoFTR匹配器 None时使用进程内共享的loftr_matcher.get_shared_matcher()
+                 match_cache=None  # 匹配结果的磁盘缓存(match_cache.MatchCache) None时不缓存
                 #  overlap_region = 150
                  ):
         self.mesh_col_count = mesh_col_count
@@ -29,39 +180,44 @@ class stitch_utils:
         self.feature_ellipse_col_count = feature_ellipse_col_count
         self.homography_min_number_corresponding_features = homography_min_number_corresponding_features
         self.color_outside_image_area_bgr = color_outside_image_area_bgr
+        self.warp_map_cache_size = warp_map_cache_size
+        self.warp_map_cache = OrderedDict()
+        self.warp_map_format = warp_map_format
+        self.matcher = matcher
+        self.match_cache = match_cache
         # self.overlap_region = overlap_region
 
 
+    #  获取LoFTR匹配器 未指定时使用进程内共享的匹配器  #
+    def get_matcher(self):
+
+        return self.matcher if self.matcher is not None else loftr_matcher.get_shared_matcher()
+
+
     # LoFTR进行inter-frame的特征匹配 subframe_offset是截取subframe的偏移量
     def loftr_in_subframe(self, early_subframe, late_subframe, subframe_offset):
 
-        img1 = K.image_to_tensor(early_subframe, False).float() /255.
-        img1 = K.color.bgr_to_rgb(img1)
-
-        img2 = K.image_to_tensor(late_subframe, False).float() /255.
-        img2 = K.color.bgr_to_rgb(img2)
-        
-        matcher = KF.LoFTR(pretrained='outdoor')
-        # matcher.cuda()
-        matcher = matcher.cuda() if torch.cuda.is_available() else matcher
-        matcher.eval()
-
-        # input_dict = {"image0": K.color.rgb_to_grayscale(img1.cuda()), # LofTR works on grayscale images only 
-        #             "image1": K.color.rgb_to_grayscale(img2.cuda())}
-        input_dict = {
-            "image0": K.color.rgb_to_grayscale(img1.cuda() if torch.cuda.is_available() else img1),
-            "image1": K.color.rgb_to_grayscale(img2.cuda() if torch.cuda.is_available() else img2)
-        }
-        #在不计算梯度的上下文中进行特征匹配，以节省内存和计算资源。
-        with torch.no_grad():
-            correspondences = matcher(input_dict)
-
-        # for k,v in correspondences.items():
-        #     print (k)
-        mkpts0 = correspondences['keypoints0'].cpu().numpy()
-        mkpts1 = correspondences['keypoints1'].cpu().numpy()
-
-        _, inliers = cv2.findFundamentalMat(mkpts0, mkpts1, cv2.USAC_MAGSAC, 0.8, 0.9999, 100000)
+        return self.loftr_in_subframe_batch([(early_subframe, late_subframe)], [subframe_offset])[0]
+
+
+    # 批量LoFTR特征匹配 subframe_pairs为(early_subframe, late_subframe)列表 按匹配器的batch_size分批推理 缓存命中的图像对不再匹配
+    def loftr_in_subframe_batch(self, subframe_pairs, subframe_offsets):
+
+        # 匹配器只创建一次 权重从本地文件读取 设备自动选择
+        keys, features_by_pair, keypoints_by_pair = match_cache.match_subframes_with_cache(
+            self.match_cache, self.get_matcher(), subframe_pairs, subframe_offsets, ('fundamental_magsac',) + self.MAGSAC_PARAMETERS)
+
+        features_by_pair = [features if keypoints is None else self.filter_matches_in_subframe(*keypoints, subframe_offset)
+                            for features, keypoints, subframe_offset in zip(features_by_pair, keypoints_by_pair, subframe_offsets)]
+        match_cache.store_filtered_matches(self.match_cache, keys, features_by_pair, keypoints_by_pair)
+
+        return features_by_pair
+
+
+    # MAGSAC剔除误匹配 并将early特征点转换为整张图像坐标
+    def filter_matches_in_subframe(self, mkpts0, mkpts1, subframe_offset):
+
+        _, inliers = cv2.findFundamentalMat(mkpts0, mkpts1, cv2.USAC_MAGSAC, *self.MAGSAC_PARAMETERS)
         # print(inliers.flatten().astype(dtype = bool).shape)
         filter_mask = inliers.flatten().astype(dtype = bool)
         mkpts0_filtered = mkpts0[filter_mask]
@@ -88,6 +244,33 @@ class stitch_utils:
     #  获取重叠区域(裁切common field)对应的匹配特征点对以及全局H  #
     def get_matched_features_and_homography_for_stitch(self, early_frame, late_frame):
 
+        # 获得匹配特征点对
+        early_subframe, late_subframe, subframe_offset = self.get_overlap_subframes(early_frame, late_frame)
+        early_features, late_features = self.loftr_in_subframe(early_subframe, late_subframe, subframe_offset)
+
+        return self.get_features_and_homography_for_stitch(early_features, late_features)
+
+
+    #  批量获取多组相邻图像重叠区域的匹配特征点对以及全局H 所有图像对一次调用LoFTR  #
+    def get_matched_features_and_homography_for_stitch_batch(self, frame_pairs):
+
+        subframe_pairs = []
+        subframe_offsets = []
+        for early_frame, late_frame in frame_pairs:
+            early_subframe, late_subframe, subframe_offset = self.get_overlap_subframes(early_frame, late_frame)
+            subframe_pairs.append((early_subframe, late_subframe))
+            subframe_offsets.append(subframe_offset)
+
+        # 获得各图像对的匹配特征点对
+        features_by_pair = self.loftr_in_subframe_batch(subframe_pairs, subframe_offsets)
+
+        return [self.get_features_and_homography_for_stitch(early_features, late_features)
+                for early_features, late_features in features_by_pair]
+
+
+    #  裁切重叠区域  #
+    def get_overlap_subframes(self, early_frame, late_frame):
+
         frame_height, frame_width = early_frame.shape[:2]
         # 裁切重叠区域
         common_field = 540
@@ -95,8 +278,13 @@ class stitch_utils:
         late_subframe = late_frame[0: frame_height, 0: common_field]
         # 左上角坐标
         subframe_offset = [(frame_width - common_field), 0]
-        # 获得匹配特征点对
-        early_features, late_features = self.loftr_in_subframe(early_subframe, late_subframe, subframe_offset)
+
+        return (early_subframe, late_subframe, subframe_offset)
+
+
+    #  由匹配特征点对计算虚拟中点以及左右图像到中点的全局H  #
+    def get_features_and_homography_for_stitch(self, early_features, late_features):
+
         # 特征点对的虚拟中点
         middle_points = (early_features + late_features) / 2
 
@@ -111,53 +299,6 @@ class stitch_utils:
         return (early_features, late_features, middle_points, early_to_late_homography_l, early_to_late_homography_r)
     
 
-    #  获取各顶点在约定范围(椭圆)内由各特征点引起的运动向量  #
-    def get_vertex_nearby_feature_residual_velocities(self, frame_width, frame_height, early_features, late_features, early_to_late_homography): 
-    
-        #  初始化数组 存储各顶点在椭圆范围内传播的运动向量
-        vertex_nearby_feature_x_velocities_by_row_col = [
-            [[] for _ in range(self.mesh_col_count + 1)]
-            for _ in range(self.mesh_row_count + 1)
-        ]
-        vertex_nearby_feature_y_velocities_by_row_col = [
-            [[] for _ in range(self.mesh_col_count + 1)]
-            for _ in range(self.mesh_row_count + 1)
-        ]
-
-        if early_features is not None:
-
-            # 计算特征点自身的运动(去除全局运动) v_p~ = p - F_t*p^
-            feature_residual_velocities = late_features - cv2.perspectiveTransform(early_features, early_to_late_homography)
-            # 首列存当前帧特征点的位置 次列存帧间相对运动
-            feature_positions_and_residual_velocities = np.c_[late_features, feature_residual_velocities]
-
-            # 特征运动传播
-            for feature_position_and_residual_velocity in feature_positions_and_residual_velocities:
-                feature_x, feature_y, feature_residual_x_velocity, feature_residual_y_velocity = feature_position_and_residual_velocity[0]
-                feature_row = (feature_y / frame_height) * self.mesh_row_count
-                feature_col = (feature_x / frame_width) * self.mesh_col_count
-
-                # 顶行
-                ellipse_top_row_inclusive = max(0, math.ceil(feature_row - self.feature_ellipse_row_count / 2))
-                # 底行
-                ellipse_bottom_row_exclusive = 1 + min(self.mesh_row_count, math.floor(feature_row + self.feature_ellipse_row_count / 2))
-
-                for vertex_row in range(ellipse_top_row_inclusive, ellipse_bottom_row_exclusive):
-                    # 基于椭圆参数方程 计算每一行所包含的列
-                    ellipse_slice_half_width = self.feature_ellipse_col_count * \
-                        math.sqrt((1/4) - ((vertex_row - feature_row) / self.feature_ellipse_row_count) ** 2)
-                    # 左列
-                    ellipse_left_col_inclusive = max(0, math.ceil(feature_col - ellipse_slice_half_width))
-                    # 右列
-                    ellipse_right_col_exclusive = 1 + min(self.mesh_col_count, math.floor(feature_col + ellipse_slice_half_width))
-                    # 向对应网格点中存入运动向量
-                    for vertex_col in range(ellipse_left_col_inclusive, ellipse_right_col_exclusive):
-                        vertex_nearby_feature_x_velocities_by_row_col[vertex_row][vertex_col].append(feature_residual_x_velocity)
-                        vertex_nearby_feature_y_velocities_by_row_col[vertex_row][vertex_col].append(feature_residual_y_velocity)
-
-        return (vertex_nearby_feature_x_velocities_by_row_col, vertex_nearby_feature_y_velocities_by_row_col)
-    
-
     #  获取用于拼接的各网格顶点运动向量  #
     # @measure_performance
     def get_velocities_for_stitch(self, early_frame, early_features, late_features, early_to_late_homography): 
@@ -172,27 +313,10 @@ class stitch_utils:
         vertex_global_y_velocities_by_row_col = vertex_global_velocities_by_row_col[:, :, 1]
 
         # 获取各顶点在约定范围(椭圆)内由各特征点引起的运动向量
-        vertex_nearby_feature_residual_x_velocities_by_row_col, vertex_nearby_feature_residual_y_velocities_by_row_col = self.get_vertex_nearby_feature_residual_velocities(
-            frame_width, frame_height, early_features, late_features, early_to_late_homography)
-        
-        # 各顶点累积的运动向量取中位数放回
-        vertex_residual_x_velocities_by_row_col = np.array([
-            [
-                statistics.median(x_velocities)
-                if x_velocities else 0
-                for x_velocities in row
-            ]
-            for row in vertex_nearby_feature_residual_x_velocities_by_row_col
-        ])
-
-        vertex_residual_y_velocities_by_row_col = np.array([
-            [
-                statistics.median(y_velocities)
-                if y_velocities else 0
-                for y_velocities in row
-            ]
-            for row in vertex_nearby_feature_residual_y_velocities_by_row_col
-        ])
+        vertex_residual_x_velocities_by_row_col, vertex_residual_y_velocities_by_row_col = get_vertex_nearby_feature_residual_medians(
+            frame_width, frame_height, self.mesh_row_count, self.mesh_col_count,
+            self.feature_ellipse_row_count, self.feature_ellipse_col_count,
+            early_features, late_features, early_to_late_homography)
 
         # 累加全局运动量
         vertex_x_velocities_by_row_col = (vertex_global_x_velocities_by_row_col + vertex_residual_x_velocities_by_row_col).astype(np.float32)
@@ -208,103 +332,64 @@ class stitch_utils:
     def get_warped_frames_for_stitch(self, pos, unstabilized_frame, stabilized_motion_mesh, x_displacement):
 
         frame_height, frame_width = unstabilized_frame.shape[:2]
+        # 同一相机的网格与平移量不变时 映射表只计算一次 之后每帧仅需一次remap
+        warp_maps = self.get_warp_maps_for_stitch(pos, frame_width, frame_height, stabilized_motion_mesh, x_displacement)
+
+        return self.remap_for_stitch(unstabilized_frame, warp_maps)
+
+
+    #  用给定映射表变形图像 映射表可为预先计算的(如铰接角查找表)  #
+    def remap_for_stitch(self, unstabilized_frame, warp_maps):
+
+        map_x, map_y = warp_maps
+        # cv2.remap(img,map1,map2,interpolation) 浮点格式下map1为x坐标 map2为y坐标
+        # 定点格式下map1为CV_16SC2类型的整数坐标(x,y) map2为插值表索引
+        warped_frame = cv2.remap(unstabilized_frame, map_x, map_y, cv2.INTER_LINEAR, borderValue=(0, 0, 0))
+
+        return warped_frame
+
+
+    #  获取网格变形的映射表 按(pos, 网格, 平移量, 图像尺寸)缓存  #
+    def get_warp_maps_for_stitch(self, pos, frame_width, frame_height, stabilized_motion_mesh, x_displacement):
+
+        stabilized_motion_mesh = np.asarray(stabilized_motion_mesh)
+        key = (pos, frame_width, frame_height, x_displacement,
+               stabilized_motion_mesh.shape, stabilized_motion_mesh.dtype.str, stabilized_motion_mesh.tobytes())
+        if key in self.warp_map_cache:
+            self.warp_map_cache.move_to_end(key)
+            return self.warp_map_cache[key]
+
+        warp_maps = self.compute_warp_maps_for_stitch(pos, frame_width, frame_height, stabilized_motion_mesh, x_displacement)
+
+        if self.warp_map_cache_size > 0:
+            # 缓存的映射表被多帧共用 设为只读
+            for warp_map in warp_maps:
+                warp_map.flags.writeable = False
+            self.warp_map_cache[key] = warp_maps
+            while len(self.warp_map_cache) > self.warp_map_cache_size:
+                self.warp_map_cache.popitem(last=False)
+
+        return warp_maps
+
+
+    #  计算网格变形的映射表(稳定后图像各像素对应原图像的坐标)  #
+    def compute_warp_maps_for_stitch(self, pos, frame_width, frame_height, stabilized_motion_mesh, x_displacement, map_format=None):
 
         unstabilized_vertex_x_y = self.get_vertex_x_y(frame_width, frame_height)
         # shape ((mesh_row_count + 1)* (mesh_col_count + 1), 1, 2) -> (mesh_row_count + 1, mesh_col_count + 1, 2)
         row_col_to_unstabilized_vertex_x_y = np.reshape(
             unstabilized_vertex_x_y, (self.mesh_row_count + 1, self.mesh_col_count + 1, 2))
-        # shape  (mesh_row_count + 1 * mesh_col_count, 1, 2)
-        # stabilized_motion_mesh = np.reshape(stabilized_motion_mesh, (-1, 1, 2))
-
         # 将顶点前后运动向量的差值叠加到各顶点坐标上 得到拼接需求的顶点坐标
-        # unstabilized_vertex_x_y (mesh_row_count + 1 * mesh_col_count + 1, 1, 2)
-        # stabilized_motion_mesh (mesh_row_count + 1 * mesh_col_count + 1, 1, 2)
-        # stabilized_vertex_x_y = unstabilized_vertex_x_y + stabilized_motion_mesh
-
-        # 重构数组结构
-        # row_col_to_stabilized_vertex_x_y = np.reshape( stabilized_vertex_x_y, (self.mesh_row_count + 1, self.mesh_col_count + 1, 2))
         row_col_to_stabilized_vertex_x_y = row_col_to_unstabilized_vertex_x_y + stabilized_motion_mesh
 
-        # 数组形状 (frame_height, frame_width) 填充值为frame_width + 1/frame_height + 1
-        frame_stabilized_y_x_to_unstabilized_x = np.full((frame_height, frame_width), frame_width + 1)
-        frame_stabilized_y_x_to_unstabilized_y = np.full((frame_height, frame_width), frame_height + 1)
-
-        # shape(frame_stabilized_y_x_to_stabilized_x_y) = (frame_height, frame_width, 2)
-        frame_stabilized_y_x_to_stabilized_x_y = np.swapaxes(
-            np.indices((frame_width, frame_height), dtype=np.float32), 0, 2)
-        # shape(frame_stabilized_x_y) = (frame_height * frame_width, 1, 2)
-        # 存入像素点对应索引[frame_width列 frame_height行] 从左上角像素点开始 从左至右 先列后行
-        frame_stabilized_x_y = frame_stabilized_y_x_to_stabilized_x_y.reshape((-1, 1, 2))
-
-        # 平移矩阵
-        # x_displacement = self.overlap_region
+        # 平移量 右侧图像向左平移
         if pos > 0:
             x_displacement = -x_displacement
-        transform_dist = [x_displacement, 0]
-        transform_array = np.array([[1, 0, transform_dist[0]], [0, 1, transform_dist[1]], [0, 0, 1]])
-        transform_array1 = np.array([[1, 0, -transform_dist[0]], [0, 1, -transform_dist[1]], [0, 0, 1]])
-
-        # TODO parallelize
-        # 由稳定后的顶点坐标和稳定后的顶点坐标，计算单应性矩阵
-        for cell_top_left_row in range(self.mesh_row_count):
-            for cell_top_left_col in range(self.mesh_col_count):
-
-                # 计算通过运动向量变换后的网格的MASK 后续计算MASK中各像素与原图像对应网格中各像素的对应
-                # 取出4个顶点坐标 依次为top_left, top_right, bottom_left, bottom_right
-                # unstabilized为原图像各网格顶点坐标 stabilized为叠加运动向量后的各网格顶点坐标
-                unstabilized_cell_bounds = row_col_to_unstabilized_vertex_x_y[
-                    cell_top_left_row:cell_top_left_row+2, cell_top_left_col:cell_top_left_col+2].reshape(-1, 2)
-                stabilized_cell_bounds = row_col_to_stabilized_vertex_x_y[
-                    cell_top_left_row:cell_top_left_row+2, cell_top_left_col:cell_top_left_col+2].reshape(-1, 2)
-                # 计算单应性矩阵
-                unstabilized_to_stabilized_homography, _ = cv2.findHomography(unstabilized_cell_bounds, stabilized_cell_bounds)
-                stabilized_to_unstabilized_homography, _ = cv2.findHomography(stabilized_cell_bounds, unstabilized_cell_bounds)
-
-                # 行列互换 先列后行
-                unstabilized_cell_x_bounds, unstabilized_cell_y_bounds = np.transpose(unstabilized_cell_bounds)
-                unstabilized_cell_left_x = math.floor(np.min(unstabilized_cell_x_bounds))
-                unstabilized_cell_right_x = math.ceil(np.max(unstabilized_cell_x_bounds))
-                unstabilized_cell_top_y = math.floor(np.min(unstabilized_cell_y_bounds))
-                unstabilized_cell_bottom_y = math.ceil(np.max(unstabilized_cell_y_bounds))
-                # 设置掩膜 取原始图像(未稳定)中对应的某一网格
-                unstabilized_cell_mask = np.zeros((frame_height, frame_width))
-                unstabilized_cell_mask[unstabilized_cell_top_y:unstabilized_cell_bottom_y + 1,
-                                        unstabilized_cell_left_x:unstabilized_cell_right_x + 1] = 255
-
-                # dsize (x, y)
-                stabilized_cell_mask = cv2.warpPerspective(
-                    unstabilized_cell_mask, transform_array.dot(unstabilized_to_stabilized_homography), (frame_width, frame_height))
-                # 以下取全局变化
-                # 以稳定后的图像为基准 通过逆单应变换获得稳定后图像与稳定前图像间各像素的对应关系
-                # frame_stalizied_x_y中存储每个像素所在位置的索引 shape(-1, 1, 2)
-                # shape(cell_unstabilized_x_y) = (frame_height * frame_width, 1, 2)
-                cell_unstabilized_x_y = cv2.perspectiveTransform(frame_stabilized_x_y, stabilized_to_unstabilized_homography.dot(transform_array1))
- 
-                # shape(cell_stabilized_y_x_to_unstabilized_x_y) = (frame_height, frame_width, 2)
-                cell_stabilized_y_x_to_unstabilized_x_y = cell_unstabilized_x_y.reshape((frame_height, frame_width, 2))
-                # (2, frame_width, frame_height)
-                cell_stabilized_y_x_to_unstabilized_x, cell_stabilized_y_x_to_unstabilized_y = np.moveaxis(
-                    cell_stabilized_y_x_to_unstabilized_x_y, 2, 0)
-
-                # 以下取局部 将掩膜内的部分转换为经逆单应矩阵变换后的点的坐标
-                # frame_stabilized_y_x_to_unstabilized_x  np.full((frame_height, frame_width), frame_width + 1)
-                # (frame_height, frame_width) 填充值为frame_width + 1/frame_height + 1
-                # 向各网格在稳定图像中所对应的区域内存入各像素点对应未稳定图像像素的索引
-                frame_stabilized_y_x_to_unstabilized_x = np.where(
-                    stabilized_cell_mask, cell_stabilized_y_x_to_unstabilized_x, frame_stabilized_y_x_to_unstabilized_x)
-                frame_stabilized_y_x_to_unstabilized_y = np.where(
-                    stabilized_cell_mask, cell_stabilized_y_x_to_unstabilized_y, frame_stabilized_y_x_to_unstabilized_y)
-
-        # cv2.remap(img,map1,map2,interpolation) map1表示CV_32FC2类型(x,y)点的x map2表示CV_32FC2类型(x,y)点的y
-        warped_frame = cv2.remap(
-            unstabilized_frame,
-            frame_stabilized_y_x_to_unstabilized_x.reshape((frame_height, frame_width, 1)).astype(np.float32),
-            frame_stabilized_y_x_to_unstabilized_y.reshape((frame_height, frame_width, 1)).astype(np.float32),
-            cv2.INTER_LINEAR,
-            borderValue=(0, 0, 0)
-        )
 
-        return warped_frame
+        # 各网格只在其变形后的包围盒内计算 见mesh_warp.get_mesh_warp_maps
+        return mesh_warp.get_warp_maps(
+            frame_width, frame_height, row_col_to_unstabilized_vertex_x_y, row_col_to_stabilized_vertex_x_y, x_displacement,
+            map_format=self.warp_map_format if map_format is None else map_format)
     
     def proj_err(self, w, h, early_features, late_features, velocity):
         row_size = h // self.mesh_row_count
@@ -314,31 +399,18 @@ class stitch_utils:
         row_col_to_unstabilized_vertex_x_y = np.reshape(unstabilized_vertex_x_y, (self.mesh_row_count + 1, self.mesh_col_count + 1, 2))
         row_col_to_stabilized_vertex_x_y = row_col_to_unstabilized_vertex_x_y + velocity
 
-        H_index = np.empty((self.mesh_row_count, self.mesh_col_count), dtype=object)
-        for cell_top_left_row in range(self.mesh_row_count):
-            for cell_top_left_col in range(self.mesh_col_count):
-
-                # 计算通过运动向量变换后的网格的MASK 后续计算MASK中各像素与原图像对应网格中各像素的对应
-                # 取出4个顶点坐标 依次为top_left, top_right, bottom_left, bottom_right
-                # unstabilized为原图像各网格顶点坐标 stabilized为叠加运动向量后的各网格顶点坐标
-                unstabilized_cell_bounds = row_col_to_unstabilized_vertex_x_y[
-                    cell_top_left_row:cell_top_left_row+2, cell_top_left_col:cell_top_left_col+2].reshape(-1, 2)
-                stabilized_cell_bounds = row_col_to_stabilized_vertex_x_y[
-                    cell_top_left_row:cell_top_left_row+2, cell_top_left_col:cell_top_left_col+2].reshape(-1, 2)
-                # 计算单应性矩阵
-                unstabilized_to_stabilized_homography, _ = cv2.findHomography(unstabilized_cell_bounds, stabilized_cell_bounds)
-                H_index[cell_top_left_row, cell_top_left_col] = unstabilized_to_stabilized_homography
-        # print(H_index[0,0])
-        sum = 0
-        for i in range(early_features.shape[0]):
-            left = int(early_features[i,0,0] // col_size)
-            top = int(early_features[i,0,1] // row_size)
-            point = np.reshape(early_features[i,0], (1,1,2))
-            # print(point)
-            displace = cv2.perspectiveTransform(point, H_index[top,left]) - point
-            # print(displace.shape)
-            err = late_features[i,0] - displace[0,0] - early_features[i,0]
-            err1 = math.sqrt(err[0]**2 + err[1]**2)
-            sum = sum + err1
+        # 所有网格的单应性矩阵一次批量求解 shape (mesh_row_count, mesh_col_count, 3, 3)
+        # unstabilized为原图像各网格顶点坐标 stabilized为叠加运动向量后的各网格顶点坐标
+        H_index, _ = mesh_warp.get_cell_homographies(row_col_to_unstabilized_vertex_x_y, row_col_to_stabilized_vertex_x_y)
+
+        # 各特征点所在网格的单应性矩阵 shape (num_features, 3, 3)
+        points = early_features[:, 0].astype(np.float64)
+        left = (early_features[:, 0, 0] // col_size).astype(int)
+        top = (early_features[:, 0, 1] // row_size).astype(int)
+        point_homographies = H_index[top, left]
+        warped_points = np.matmul(point_homographies[:, :, :2], points[:, :, np.newaxis])[:, :, 0] + point_homographies[:, :, 2]
+        displace = warped_points[:, :2] / warped_points[:, 2:] - points
+        err = late_features[:, 0] - displace - points
+        sum = np.sum(np.sqrt(err[:, 0]**2 + err[:, 1]**2))
         print(sum/early_features.shape[0])
         return sum/early_features.shape[0]